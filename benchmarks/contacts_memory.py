@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+"""
+Memory of the contact store and cost of attribute access on the dispatch path
+
+GroupMember is compared with a dict-backed class of the same fields, which is how contacts were laid out before they
+got __slots__. The columnar member table is measured as well
+"""
+
+try:
+    import pyasyncbot
+except ModuleNotFoundError:
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    import pyasyncbot
+
+import argparse
+import gc
+import timeit
+import tracemalloc
+
+from pyasyncbot.Contacts import GroupMember
+from pyasyncbot.MemberTable import MemberTable
+from pyasyncbot.MsgContent import TextSegment
+
+
+class DictGroupMember:
+    """
+    GroupMember without __slots__
+    """
+
+    def __init__(self, contact, uid: int, nickname: str, gid: int):
+        self._id = uid
+        self._name = nickname
+        self._contact = contact
+        self._gid = gid
+
+    def get_id(self):
+        return self._id
+
+
+class DictTextSegment:
+    """
+    TextSegment without __slots__
+    """
+
+    def __init__(self, text: str):
+        self._text = text
+
+    def get_text(self):
+        return self._text
+
+
+def measure(build) -> int:
+    gc.collect()
+    tracemalloc.start()
+    store = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del store
+    return size
+
+
+def main(args):
+    # nicknames are shared by all layouts, so that only the per-member overhead is compared
+    nicks = {uid: 'member{uid}'.format(uid=uid) for uid in range(args.members)}
+    total = args.groups * args.members
+
+    def build_objects(cls):
+        return [{uid: cls(None, uid, nick, gid) for uid, nick in nicks.items()} for gid in range(args.groups)]
+
+    rows = [
+        ('dict-backed objects', lambda: build_objects(DictGroupMember)),
+        ('slotted objects', lambda: build_objects(GroupMember)),
+        ('columnar table', lambda: [MemberTable(lambda uid, nick: None, nicks) for _ in range(args.groups)]),
+    ]
+    print('{groups} groups x {members} members'.format(groups=args.groups, members=args.members))
+    for name, build in rows:
+        size = measure(build)
+        print('{name:<20} {mib:8.1f} MiB  {per:6.1f} bytes per member'.format(
+            name=name, mib=size / 1024 / 1024, per=size / total))
+
+    number = 1000000
+    for name, obj in (('dict-backed member', DictGroupMember(None, 1, 'a', 1)),
+                      ('slotted member', GroupMember(None, 1, 'a', 1)),
+                      ('dict-backed text', DictTextSegment('a')),
+                      ('slotted text', TextSegment.from_text('a'))):
+        getter = obj.get_id if hasattr(obj, 'get_id') else obj.get_text
+        cost = min(timeit.repeat(getter, number=number, repeat=5)) / number
+        print('{name:<20} {ns:6.1f} ns per getter call'.format(name=name, ns=cost * 1e9))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='contact store memory and attribute access cost')
+    parser.add_argument('-g', '--groups', help='number of groups', type=int, default=500)
+    parser.add_argument('-m', '--members', help='members of each group', type=int, default=2000)
+    main(parser.parse_args())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Peak memory of sending an image reply, with the image embedded as base64 and as a multipart part
+
+Messages go through MyBotProtocol to a fake backend running in a child process, which discards what it reads, so
+that only allocations of the sending side are traced
+"""
+
+try:
+    import pyasyncbot
+except ModuleNotFoundError:
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    import pyasyncbot
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tracemalloc
+
+from aiohttp import web
+from loguru import logger
+
+from pyasyncbot.commu.http import HTTPClient
+from pyasyncbot.MsgContent import MessageContent, ImageSegment
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+
+
+async def handle_send(request: web.Request) -> web.Response:
+    async for _ in request.content.iter_chunked(64 * 1024):
+        pass
+    return web.json_response({'status': {'code': 0}, 'msgID': 'm'})
+
+
+def serve(port: int):
+    app = web.Application(client_max_size=1024 * 1024 * 1024)
+    app.router.add_post('/sendMsg/group', handle_send)
+    web.run_app(app, host='127.0.0.1', port=port, print=None, access_log=None)
+
+
+async def measure(port: int, features: set, buffer: bytes, count: int) -> int:
+    http = HTTPClient('127.0.0.1', port)
+    proto = MyBotProtocol(None)
+    proto._http_hdl = await http.setup()
+    proto._features = features
+    content = MessageContent('look at this')
+    content.append_segment(ImageSegment.from_buffer(buffer))
+    try:
+        # the first send opens the connection and warms up the client
+        await proto.serv_group_message(1, content)
+        tracemalloc.start()
+        for _ in range(count):
+            if await proto.serv_group_message(1, content) is None:
+                raise Exception('send failed')
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    finally:
+        await http.cleanup()
+    return peak
+
+
+async def wait_server(port: int):
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise Exception('fake backend did not start')
+
+
+async def main(args):
+    buffer = os.urandom(args.size * 1024 * 1024)
+    await wait_server(args.port)
+    print('{size} MiB image, {n} sends'.format(size=args.size, n=args.count))
+    for name, features in (('base64', set()), ('multipart', {'multipartSend'})):
+        peak = await measure(args.port, features, buffer, args.count)
+        print('{name:<10} peak {mib:6.1f} MiB traced, {ratio:4.1f}x the image'.format(
+            name=name, mib=peak / 1024 / 1024, ratio=peak / len(buffer)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='peak memory of sending an image')
+    parser.add_argument('-s', '--size', help='image size in MiB', type=int, default=5)
+    parser.add_argument('-n', '--count', help='sends measured for each path', type=int, default=5)
+    parser.add_argument('-p', '--port', help='local TCP port of the fake backend', type=int, default=18081)
+    args = parser.parse_args()
+    logger.remove()
+    server = multiprocessing.Process(target=serve, args=(args.port,), daemon=True)
+    server.start()
+    try:
+        asyncio.run(main(args))
+    finally:
+        server.terminate()
+        server.join()
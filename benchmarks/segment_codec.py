@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""
+Per-segment cost of MyBotProtocol parsing and generating message content
+
+The if/elif chains MyBotProtocol used before the table-driven codec are kept here as the baseline. Segments are mixed
+in the proportions of typical chat traffic, with segment types late in the chain included
+"""
+
+try:
+    import pyasyncbot
+except ModuleNotFoundError:
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    import pyasyncbot
+
+import argparse
+import timeit
+
+from pyasyncbot.MsgContent import *
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+
+
+def chain_parse_msg_content(msg: list) -> MessageContent:
+    ret = MessageContent()
+    for seg in msg:
+        if seg['type'] == 'text':
+            ret.append_segment(TextSegment.from_text(seg['text']))
+        elif seg['type'] == 'image':
+            ret.append_segment(ImageSegment.from_url(seg['url']))
+        elif seg['type'] == 'emoji':
+            ret.append_segment(EmojiSegment.from_id(seg['id'], seg['replaceText']))
+        elif seg['type'] == 'mention':
+            ret.append_segment(MentionSegment.from_id(seg['target'], seg['displayText']))
+        elif seg['type'] == 'forwarded':
+            ret.append_segment(GroupedSegment.from_grouped_msg_id(seg['id']))
+        elif seg['type'] == 'json':
+            ret.append_segment(ApplicationSegment.from_data('qq', 'json', seg['data'], 'json消息'))
+        elif seg['type'] == 'xml':
+            ret.append_segment(ApplicationSegment.from_data('qq', 'xml', seg['data'], 'xml消息'))
+    return ret
+
+
+def chain_generate_message_content(msg_content: MessageContent) -> list:
+    ret = []
+    for msg in msg_content._msgs:
+        if isinstance(msg, TextSegment):
+            ret.append({'type': 'text', 'text': msg.get_text()})
+        elif isinstance(msg, ImageSegment):
+            seg = {'type': 'image'}
+            if msg.is_raw_data_available():
+                seg['base64'] = msg.get_base64()
+            else:
+                seg['url'] = msg.get_url()
+            ret.append(seg)
+        elif isinstance(msg, EmojiSegment):
+            ret.append({'type': 'emoji', 'id': msg.get_id()})
+        elif isinstance(msg, MentionSegment):
+            ret.append({'type': 'mention', 'target': msg.get_target_id()})
+        elif isinstance(msg, GroupedSegment):
+            ret.append({'type': 'forwarded', 'id': msg.get_id()})
+        elif isinstance(msg, ApplicationSegment):
+            ret.append({'type': msg.get_type(), 'data': msg.get_data()})
+    return ret
+
+
+WIRE_SEGMENTS = [
+    {'type': 'text', 'text': 'hello'},
+    {'type': 'mention', 'target': 10001, 'displayText': '@someone'},
+    {'type': 'text', 'text': ' look at this '},
+    {'type': 'emoji', 'id': 14, 'replaceText': '[smile]'},
+    {'type': 'image', 'url': 'https://example.com/a.png'},
+    {'type': 'text', 'text': 'and this'},
+    {'type': 'forwarded', 'id': 'fwd'},
+    {'type': 'json', 'data': '{}'},
+]
+
+
+def main(args):
+    wire = WIRE_SEGMENTS * args.repeat
+    content = MyBotProtocol.parse_msg_content(wire)
+    # forwarded segments are not sendable, leave them out of the outbound message
+    outbound = MessageContent()
+    outbound._msgs = [seg for seg in content.get_segments() if not isinstance(seg, GroupedSegment)]
+    n = len(wire)
+    rows = [
+        ('parse, if/elif', chain_parse_msg_content, wire, n),
+        ('parse, table', MyBotProtocol.parse_msg_content, wire, n),
+        ('generate, if/elif', chain_generate_message_content, outbound, len(outbound._msgs)),
+        ('generate, table', MyBotProtocol.generate_message_content, outbound, len(outbound._msgs)),
+    ]
+    # rows take turns, so that drift of the machine hits them alike
+    best = [float('inf')] * len(rows)
+    for _ in range(args.rounds):
+        for i, (name, func, arg, segments) in enumerate(rows):
+            cost = timeit.timeit(lambda: func(arg), number=args.number) / args.number / segments
+            best[i] = min(best[i], cost)
+    for (name, _, _, _), cost in zip(rows, best):
+        print('{name:<18} {ns:7.1f} ns per segment'.format(name=name, ns=cost * 1e9))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='segment parse and generate cost')
+    parser.add_argument('-r', '--repeat', help='copies of the sample segments in a message', type=int, default=1)
+    parser.add_argument('-n', '--number', help='messages per timing', type=int, default=5000)
+    parser.add_argument('--rounds', help='timings of each row, the best one is reported', type=int, default=20)
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Per-message send latency of MyBotProtocol over HTTP, through TCP and through a unix domain socket
+
+A local aiohttp server stands in for the backend and answers /sendMsg/group at once, so the numbers are the cost of
+the transport and the client stack
+"""
+
+try:
+    import pyasyncbot
+except ModuleNotFoundError:
+    import os
+    import sys
+
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+    import pyasyncbot
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from aiohttp import web
+from loguru import logger
+
+from pyasyncbot.commu.http import HTTPClient
+from pyasyncbot.MsgContent import MessageContent
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+
+
+async def handle_send(request: web.Request) -> web.Response:
+    await request.read()
+    return web.json_response({'status': {'code': 0}, 'msgID': 'm'})
+
+
+async def measure(http: HTTPClient, count: int, warmup: int) -> list:
+    proto = MyBotProtocol(None)
+    proto._http_hdl = await http.setup()
+    content = MessageContent('hello world')
+    samples = []
+    try:
+        for i in range(warmup + count):
+            begin = time.perf_counter()
+            await proto.serv_group_message(1, content)
+            if i >= warmup:
+                samples.append(time.perf_counter() - begin)
+    finally:
+        await http.cleanup()
+    return samples
+
+
+def report(name: str, samples: list):
+    samples = sorted(samples)
+    print('{name:<6} mean {mean:8.1f} us  p50 {p50:8.1f} us  p99 {p99:8.1f} us'.format(
+        name=name, mean=statistics.mean(samples) * 1e6, p50=samples[len(samples) // 2] * 1e6,
+        p99=samples[int(len(samples) * 0.99)] * 1e6))
+
+
+async def main(args):
+    app = web.Application()
+    app.router.add_post('/sendMsg/group', handle_send)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    with tempfile.TemporaryDirectory() as path:
+        sock_path = os.path.join(path, 'backend.sock')
+        await web.TCPSite(runner, '127.0.0.1', args.port).start()
+        await web.UnixSite(runner, sock_path).start()
+        try:
+            report('tcp', await measure(HTTPClient('127.0.0.1', args.port), args.count, args.warmup))
+            report('unix', await measure(HTTPClient('127.0.0.1', args.port, unix_socket_path=sock_path),
+                                         args.count, args.warmup))
+        finally:
+            await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='send latency over TCP and unix domain socket')
+    parser.add_argument('-n', '--count', help='messages sent through each transport', type=int, default=2000)
+    parser.add_argument('-w', '--warmup', help='messages sent before measuring', type=int, default=100)
+    parser.add_argument('-p', '--port', help='local TCP port of the fake backend', type=int, default=18080)
+    logger.remove()
+    asyncio.run(main(parser.parse_args()))
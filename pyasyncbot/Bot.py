@@ -12,10 +12,15 @@ import sys
 from .Message import ReceivedPrivateMessage, ReceivedGroupMessage, RevokedMessage
 from .Event import BotEvent
 from .CommunicationWare import CommunicationWare
+from .Dispatcher import EventDispatcher, ChannelSequencer, CallbackRunner
 from .commu.CommunicationBackend import CommunicationBackend
-from .FrameworkWrapper import BotWrapper
+from .FrameworkWrapper import BotWrapper, CoalescingProtocolWrapper
 from .BotConfig import BotConfig
 from .Contacts import Contacts
+from .MessageStore import MessageCache
+from .MessageJournal import MessageJournal
+from .SearchIndex import SearchIndex
+from .MediaCache import MediaCache
 from .proto.Protocol import Protocol
 
 
@@ -41,6 +46,28 @@ class Bot:
         # tasks stored in this set will receive task cancellation when exiting
         self.__task_set_ext: typing.Set[asyncio.Task] = set()
         self._contacts = None                                   # Get filled run-timely
+        self._dispatcher: EventDispatcher = None                # Get filled run-timely
+        self._callbacks: CallbackRunner = None                  # Get filled run-timely
+        self._sequencer: ChannelSequencer = None                # Only available in ordered dispatch mode
+        msg_store_setting = conf.message_store_setting
+        if msg_store_setting is None:
+            msg_store_setting = BotConfig.MessageStoreSetting()
+        self._msg_cache: MessageCache = MessageCache(msg_store_setting.cache_size)
+        self._journal: MessageJournal = None
+        if msg_store_setting.journal_dir is not None:
+            self._journal = MessageJournal(msg_store_setting.journal_dir, msg_store_setting.journal_segment_size,
+                                           msg_store_setting.journal_max_segments)
+        self._search: SearchIndex = None
+        if msg_store_setting.search_dir is not None:
+            self._search = SearchIndex(msg_store_setting.search_dir, msg_store_setting.search_flush_docs,
+                                       msg_store_setting.search_merge_factor, msg_store_setting.search_max_messages)
+        media_cache_setting = conf.media_cache_setting
+        if media_cache_setting is None:
+            media_cache_setting = BotConfig.MediaCacheSetting()
+        self._media_cache: MediaCache = None
+        if media_cache_setting.memory_size > 0 or media_cache_setting.disk_dir is not None:
+            self._media_cache = MediaCache(media_cache_setting.memory_size, media_cache_setting.disk_dir,
+                                           media_cache_setting.disk_size)
 
         # registered callbacks
         self._on_framework_ready: typing.Callable = None
@@ -148,18 +175,45 @@ class Bot:
             logger.critical('unsupported bot protocol: ' + self._config.bot_protocol)
             return -1
 
+        # message stores are written on delivery, so open them before any event could arrive
+        if self._journal is not None:
+            self._journal.open()
+        if self._search is not None:
+            self._search.open()
+        if self._media_cache is not None:
+            self._media_cache.open()
+
+        # bring up push event workers before any event could arrive
+        dispatch_setting = self._config.dispatch_setting
+        if dispatch_setting is None:
+            dispatch_setting = BotConfig.DispatchSetting()
+        self._dispatcher = EventDispatcher(dispatch_setting.worker_count, dispatch_setting.queue_size)
+        self._dispatcher.start()
+        self._callbacks = CallbackRunner(dispatch_setting.max_running_callbacks,
+                                         dispatch_setting.callback_queue_size)
+        self._callbacks.start()
+        if dispatch_setting.ordered_channels:
+            self._sequencer = ChannelSequencer(dispatch_setting.max_parallel_channels, dispatch_setting.lane_size,
+                                               self._create_bot_task)
+
         # initializing commuware with requested backends
         commus = dict()
         try:
             commus = await self._commuware.setup(bot_protocol.required_communication(), self._config)
         except CommunicationBackend.SetupFailed:
             logger.critical('failed to setup communication backend')
+            await self._dispatcher.stop()
+            await self._callbacks.stop()
+            await self.__close_stores()
             return -2
 
         # doing bot protocol initialization that doesn't require run-time interaction
         if not await bot_protocol.setup(commus):
             logger.critical(self._config.bot_protocol + ' setup failed')
             await self._commuware.cleanup()
+            await self._dispatcher.stop()
+            await self._callbacks.stop()
+            await self.__close_stores()
             return -3
 
         # bring up communication daemons
@@ -175,7 +229,14 @@ class Bot:
             retval = -4
 
         # bot protocol is ready, create protocol wrapper and initialize contacts
-        self._contacts = Contacts(bot_protocol)
+        self._contacts = Contacts(CoalescingProtocolWrapper(bot_protocol, self._msg_cache, self._journal),
+                                  self._config.contacts_setting, self.create_task, self._search)
+        contacts_setting = self._config.contacts_setting
+        snapshot_path = contacts_setting.snapshot_path if contacts_setting is not None else None
+        if snapshot_path is not None and retval == 0:
+            # serve from the saved contacts at first, and catch up with the backend in background
+            if self._contacts.load_snapshot(snapshot_path):
+                self.create_task(self._contacts.revalidate(), 'contacts_revalidate')
 
         # framework ready
         if self._on_framework_ready is not None:
@@ -184,6 +245,11 @@ class Bot:
         # wait until the daemon task finished
         await commu_task
 
+        # no more push events. finish queued ones
+        logger.info('commu tasks exited. wait for {d} of queued events to complete'.format(d=self._dispatcher.qsize()))
+        await self._dispatcher.stop()
+        await self._callbacks.stop()
+
         # cancel external tasks
         for task in self.__task_set_ext:
             task.cancel()
@@ -192,18 +258,56 @@ class Bot:
         logger.info('commu tasks exited. wait for {d} of sub-tasks to complete'.format(d=len(sub_tasks)))
         await asyncio.gather(*sub_tasks)
 
+        # keep contacts for next startup. Don't overwrite the snapshot with what a failed run has
+        if snapshot_path is not None and retval == 0:
+            try:
+                self._contacts.save_snapshot(snapshot_path)
+            except Exception as e:
+                logger.error('failed to save contacts snapshot: {reason}'.format(reason=str(e)))
+
         # do cleanups
         await bot_protocol.cleanup()
         await self._commuware.cleanup()
+        await self.__close_stores()
 
         return retval
 
+    async def __close_stores(self):
+        if self._journal is not None:
+            await self._journal.close()
+        if self._search is not None:
+            await self._search.close()
+        if self._media_cache is not None:
+            self._media_cache.close()
+
     def get_contacts(self) -> Contacts:
         """
         Get the contacts obj of this bot
         """
         return self._contacts
 
+    def get_message_cache(self) -> MessageCache:
+        """
+        Get the cache of recently delivered messages, e.g. to read its hit and miss counters
+        """
+        return self._msg_cache
+
+    def get_message_journal(self) -> typing.Union[MessageJournal, None]:
+        """
+        Get the on-disk journal of delivered messages, e.g. to scan the history of a channel
+
+        :return: None if not enabled
+        """
+        return self._journal
+
+    def get_media_cache(self) -> typing.Union[MediaCache, None]:
+        """
+        Get the content-addressed cache of fetched and sent images
+
+        :return: None if not enabled
+        """
+        return self._media_cache
+
     def on_framework_ready(self, deco):
         """
         Register callback for framework ready status
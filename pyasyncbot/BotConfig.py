@@ -6,14 +6,141 @@ from dataclasses import dataclass
 class BotConfig:
     @dataclass
     class HTTPClientSetting:
+        """
+        Args:
+            remote_addr: backend host
+            remote_port: backend port
+            connection_limit: max number of pooled connections in total, 0 for unlimited
+            connection_limit_per_host: max number of pooled connections to the same endpoint, 0 for unlimited
+            keepalive_timeout: how long an idle connection is kept for reusing, in second
+            dns_cache_ttl: how long a resolved address is cached, in second. None means forever
+            connect_timeout: timeout of establishing a new connection, in second. None means no limit
+            request_timeout: timeout of a whole request, in second. None explicitly disables it, so that a stalled
+                             backend can hang a request forever. The WebSocket connection is not affected
+            unix_socket_path: talk to the backend through this unix domain socket instead of TCP, if provided
+        """
         remote_addr: str
         remote_port: int
+        connection_limit: int = 100
+        connection_limit_per_host: int = 0
+        keepalive_timeout: float = 60
+        dns_cache_ttl: int = 300
+        connect_timeout: float = 10
+        request_timeout: float = 60
+        unix_socket_path: str = None
 
     @dataclass
     class WebSocketClientSetting:
+        """
+        Args:
+            remote_addr: backend host
+            remote_port: backend port
+            unix_socket_path: talk to the backend through this unix domain socket instead of TCP, if provided
+        """
         remote_addr: str
         remote_port: int
+        unix_socket_path: str = None
+
+    @dataclass
+    class MediaClientSetting:
+        """
+        Args:
+            proxy: proxy url for fetching media, such as 'http://127.0.0.1:7890'. None means direct
+            connection_limit: max number of pooled connections in total, 0 for unlimited
+            connection_limit_per_host: max number of pooled connections to the same host, 0 for unlimited
+            keepalive_timeout: how long an idle connection is kept for reusing, in second
+            dns_cache_ttl: how long a resolved address is cached, in second. None means forever
+            connect_timeout: timeout of establishing a new connection, in second. None means no limit
+            request_timeout: timeout of a whole request, in second. None means no limit
+        """
+        proxy: str = None
+        connection_limit: int = 100
+        connection_limit_per_host: int = 8
+        keepalive_timeout: float = 30
+        dns_cache_ttl: int = 300
+        connect_timeout: float = 10
+        request_timeout: float = 60
+
+    @dataclass
+    class MediaCacheSetting:
+        """
+        Args:
+            memory_size: max total bytes of images kept in memory by content. 0 means disabled
+            disk_dir: directory of the on-disk tier of the media cache. None means disabled
+            disk_size: max total bytes of the on-disk tier
+        """
+        memory_size: int = 0
+        disk_dir: str = None
+        disk_size: int = 512 * 1024 * 1024
+
+    @dataclass
+    class DispatchSetting:
+        """
+        Args:
+            worker_count: number of workers parsing and delivering push events concurrently
+            queue_size: max number of pending push events before the communication backend gets blocked
+            max_running_callbacks: number of workers running user callbacks, apart from the push event workers
+            callback_queue_size: max number of callbacks waiting for a callback worker before delivery gets blocked
+            ordered_channels: deliver messages of the same channel one by one in order
+            max_parallel_channels: max number of channels being delivered concurrently, if ordered_channels is set
+            lane_size: max number of callbacks queued for one channel before delivery gets blocked, if ordered_channels
+                       is set
+        """
+        worker_count: int = 16
+        queue_size: int = 1024
+        max_running_callbacks: int = 256
+        callback_queue_size: int = 1024
+        ordered_channels: bool = False
+        max_parallel_channels: int = 64
+        lane_size: int = 64
+
+    @dataclass
+    class ContactsSetting:
+        """
+        Args:
+            columnar_members: store group members in compact arrays and create member objects on demand
+            snapshot_path: file to save contacts at shutdown and load at startup. None means disabled
+            friends_ttl: friend list older than this is refreshed in background when read, in second. None means never
+            groups_ttl: group list older than this is refreshed in background when read, in second. None means never
+            members_ttl: member list older than this is refreshed in background when read, in second. None means never
+            refresh_retry_interval: after a failed background refresh, reads don't trigger another one for this long, in
+                second
+        """
+        columnar_members: bool = False
+        snapshot_path: str = None
+        friends_ttl: float = None
+        groups_ttl: float = None
+        members_ttl: float = None
+        refresh_retry_interval: float = 30
+
+    @dataclass
+    class MessageStoreSetting:
+        """
+        Args:
+            cache_size: max number of recently delivered messages kept in memory. 0 means disabled
+            journal_dir: directory of the on-disk journal of delivered messages. None means disabled
+            journal_segment_size: size of each journal segment file, in bytes
+            journal_max_segments: oldest journal segments beyond this count are deleted. None means keeping all
+            search_dir: directory of the full-text index of delivered messages. None means disabled
+            search_flush_docs: number of messages indexed in memory before written to disk
+            search_merge_factor: number of index segments of similar size merged into one in background
+            search_max_messages: oldest index segments are deleted once more messages than this are indexed. None means
+                keeping all
+        """
+        cache_size: int = 4096
+        journal_dir: str = None
+        journal_segment_size: int = 64 * 1024 * 1024
+        journal_max_segments: int = None
+        search_dir: str = None
+        search_flush_docs: int = 20000
+        search_merge_factor: int = 4
+        search_max_messages: int = None
 
     bot_protocol: str
     http_setting: HTTPClientSetting = None
-    ws_setting: WebSocketClientSetting = None
\ No newline at end of file
+    ws_setting: WebSocketClientSetting = None
+    media_setting: MediaClientSetting = None
+    media_cache_setting: MediaCacheSetting = None
+    dispatch_setting: DispatchSetting = None
+    contacts_setting: ContactsSetting = None
+    message_store_setting: MessageStoreSetting = None
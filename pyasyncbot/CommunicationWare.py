@@ -10,28 +10,41 @@ import typing
 from .BotConfig import BotConfig
 from .commu.http import *
 from .commu.websocket import *
+from .commu.media import MediaClient
 
 
 class CommunicationWare:
     _commus: typing.Dict[str, CommunicationBackend]
     _commu_tasks: typing.Set[asyncio.Task]
+    _media: MediaClient
 
     def __init__(self):
         self._commus = dict()
         self._commu_tasks = set()
+        self._media = None
 
     async def setup(self, reqs: typing.List[str], bot_conf: BotConfig) -> typing.Dict[str, typing.Any]:
         if 'http_client' in reqs:
             # create http client
-            self._commus['http_client'] = HTTPClient(bot_conf.http_setting.remote_addr,
-                                                     bot_conf.http_setting.remote_port)
+            self._commus['http_client'] = HTTPClient(
+                bot_conf.http_setting.remote_addr,
+                bot_conf.http_setting.remote_port,
+                connection_limit=bot_conf.http_setting.connection_limit,
+                connection_limit_per_host=bot_conf.http_setting.connection_limit_per_host,
+                keepalive_timeout=bot_conf.http_setting.keepalive_timeout,
+                dns_cache_ttl=bot_conf.http_setting.dns_cache_ttl,
+                connect_timeout=bot_conf.http_setting.connect_timeout,
+                request_timeout=bot_conf.http_setting.request_timeout,
+                unix_socket_path=bot_conf.http_setting.unix_socket_path
+            )
             reqs.remove('http_client')
         if 'ws_client' in reqs:
             # a simple 'break' point for convenience
             while True:
                 # check if http client shares the same endpoint configuration as ws client
                 if (bot_conf.http_setting.remote_addr == bot_conf.ws_setting.remote_addr
-                        and bot_conf.http_setting.remote_port == bot_conf.ws_setting.remote_port):
+                        and bot_conf.http_setting.remote_port == bot_conf.ws_setting.remote_port
+                        and bot_conf.http_setting.unix_socket_path == bot_conf.ws_setting.unix_socket_path):
                     # then make sure http client exists
                     if 'http_client' in self._commus:
                         # create ws on top of http
@@ -41,7 +54,8 @@ class CommunicationWare:
                 # create from parameter and let ws manage http base
                 self._commus['ws_client'] = WebSocketClient.from_parameters(
                     bot_conf.ws_setting.remote_addr,
-                    bot_conf.ws_setting.remote_port
+                    bot_conf.ws_setting.remote_port,
+                    bot_conf.ws_setting.unix_socket_path
                 )
                 reqs.remove('ws_client')
                 break
@@ -67,9 +81,29 @@ class CommunicationWare:
                 logger.error('failed to setup ws_client')
                 await self.cleanup()
                 raise e
+        # outbound media session is always available, it is not part of the bot protocol
+        media_setting = bot_conf.media_setting
+        if media_setting is None:
+            media_setting = BotConfig.MediaClientSetting()
+        self._media = MediaClient(
+            proxy=media_setting.proxy,
+            connection_limit=media_setting.connection_limit,
+            connection_limit_per_host=media_setting.connection_limit_per_host,
+            keepalive_timeout=media_setting.keepalive_timeout,
+            dns_cache_ttl=media_setting.dns_cache_ttl,
+            connect_timeout=media_setting.connect_timeout,
+            request_timeout=media_setting.request_timeout
+        )
+        await self._media.setup()
         return ret
 
+    def get_media_client(self) -> MediaClient:
+        return self._media
+
     async def cleanup(self):
+        if self._media is not None:
+            await self._media.cleanup()
+            self._media = None
         if 'ws_client' in self._commus:
             await self._commus['ws_client'].cleanup()
             del self._commus['ws_client']
@@ -2,25 +2,34 @@
 from __future__ import annotations
 
 import asyncio
+import datetime
+import os
+import time
 from typing import TYPE_CHECKING
 
 if TYPE_CHECKING:
     from .Message import MessageContent, RepliedMessageContext, ReceivedMessage, ReceivedGroupMessage, \
-        ReceivedPrivateMessage
+        ReceivedPrivateMessage, RevokedMessage
     from .FrameworkWrapper import ProtocolWrapper
+    from .SearchIndex import SearchIndex, SearchHit
 
 
 from loguru import logger
-from ujson import dumps
-from typing import Union, Dict, Any, List, TypedDict
+from .JsonCodec import dumps_str
+from . import JsonCodec
+from typing import Union, Dict, Any, Callable, Optional, Iterator, Tuple, Awaitable, List, Set
 from abc import ABC, abstractmethod
-import time
 from enum import Enum, auto
 
 from .Message import SentMessage
+from .MemberTable import MemberTable
+from .SingleFlight import SingleFlight
+from .BotConfig import BotConfig
 
 
 class User:
+    __slots__ = ('_id', '_name')
+
     def __init__(self, uid: int, name: str):
         self._id = uid
         self._name = name
@@ -32,18 +41,43 @@ class User:
             return self._id == other
         return False
 
+    def __str__(self):
+        return self.to_json()
+
     def get_id(self):
         return self._id
 
     def get_name(self):
         return self._name
 
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get a structured representation of the user
+
+        :return: dict of plain values
+        """
+        return {
+            'type': 'User',
+            'id': self._id,
+            'nick': self._name
+        }
+
+    def to_json(self) -> str:
+        """
+        Get the JSON representation of the user
+
+        :return: JSON string
+        """
+        return dumps_str(self.to_dict())
+
 
 class Channel(User, ABC):
     """
     Where messaging tasks is capable
     """
 
+    __slots__ = ('_contacts',)
+
     class ChannelType(Enum):
         P2P = auto()
         MultiUser = auto()
@@ -94,19 +128,21 @@ class Channel(User, ABC):
 
 
 class Me(User):
-    pass
+    __slots__ = ()
 
 
 class Friend(Channel):
+    __slots__ = ()
+
     def __init__(self, contact: Contacts, uid: int, nickname: str):
         Channel.__init__(self, contact, uid, nickname)
 
-    def __str__(self):
-        return dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             'type': 'Friend',
-            'id': self.get_id(),
-            'nick': self.get_name()
-        }, ensure_ascii=False)
+            'id': self._id,
+            'nick': self._name
+        }
 
     def get_type(self) -> Channel.ChannelType:
         return Channel.ChannelType.P2P
@@ -125,35 +161,32 @@ class Friend(Channel):
         return await self._contacts._proto_wrapper.serv_private_revoke(self.get_id(), msgid)
 
     async def wait_msg(self, timeout: float = None) -> Union[ReceivedPrivateMessage, None]:
-        wait_item: Contacts.WaitForItem = {
-            'channel_id': self.get_id(),
-            'payload': None,
-            'event': asyncio.Event()
-        }
-        self._contacts._wait_for_list['privmsg'].append(wait_item)
-        ret = None
-        try:
-            await asyncio.wait_for(wait_item['event'].wait(), timeout)
-            ret = wait_item['payload']
-        except asyncio.TimeoutError:
-            pass
-        self._contacts._wait_for_list['privmsg'][:] = [i for i in self._contacts._wait_for_list['privmsg'] if
-                                                       i is not wait_item]
-        return ret
+        return await self._contacts._waiters.wait('privmsg', self.get_id(), timeout)
+
+    async def wait_revoke(self, timeout: float = None) -> Union[RevokedMessage, None]:
+        """
+        Waiting for a message being revoked in this channel
+
+        :param timeout: how long should blocking here, in second. None means forever
+        :return: revoked message, or None if timeout
+        """
+        return await self._contacts._waiters.wait('privrevoke', self.get_id(), timeout)
 
 
 class Stranger(Channel):
+    __slots__ = ('_gid',)
+
     def __init__(self, contact: Contacts, uid: int, nickname: str, gid: int = None):
         Channel.__init__(self, contact, uid, nickname)
         self._gid = gid
 
-    def __str__(self):
-        return dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             'type': 'Stranger',
-            'id': self.get_id(),
-            'nick': self.get_name(),
+            'id': self._id,
+            'nick': self._name,
             'from_group_id': self._gid
-        }, ensure_ascii=False)
+        }
 
     def get_type(self) -> Channel.ChannelType:
         return Channel.ChannelType.P2P
@@ -165,36 +198,33 @@ class Stranger(Channel):
         raise Exception('Not implemented')
 
     async def wait_msg(self, timeout: float = None) -> Union[ReceivedPrivateMessage, None]:
-        wait_item: Contacts.WaitForItem = {
-            'channel_id': self.get_id(),
-            'payload': None,
-            'event': asyncio.Event()
-        }
-        self._contacts._wait_for_list['privmsg'].append(wait_item)
-        ret = None
-        try:
-            await asyncio.wait_for(wait_item['event'].wait(), timeout)
-            ret = wait_item['payload']
-        except asyncio.TimeoutError:
-            pass
-        self._contacts._wait_for_list['privmsg'][:] = [i for i in self._contacts._wait_for_list['privmsg'] if
-                                                       i is not wait_item]
-        return ret
+        return await self._contacts._waiters.wait('privmsg', self.get_id(), timeout)
+
+    async def wait_revoke(self, timeout: float = None) -> Union[RevokedMessage, None]:
+        """
+        Waiting for a message being revoked in this channel
+
+        :param timeout: how long should blocking here, in second. None means forever
+        :return: revoked message, or None if timeout
+        """
+        return await self._contacts._waiters.wait('privrevoke', self.get_id(), timeout)
 
 
 class GroupMember(User):
+    __slots__ = ('_contact', '_gid')
+
     def __init__(self, contact: Contacts, uid: int, nickname: str, gid: int):
         User.__init__(self, uid, nickname)
         self._contact = contact
         self._gid = gid
 
-    def __str__(self):
-        return dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             'type': 'GroupMember',
             'group_id': self._gid,
-            'nick': self.get_name(),
-            'sender_id': self.get_id(),
-        }, ensure_ascii=False)
+            'nick': self._name,
+            'sender_id': self._id,
+        }
 
     async def open_private_channel(self) -> Channel:
         """
@@ -209,26 +239,31 @@ class GroupMember(User):
 
 
 class GroupAnonymousMember(User):
+    __slots__ = ('_contact', '_gid')
+
     def __init__(self, contact: Contacts, uid: int, nickname: str, gid: int):
         User.__init__(self, uid, nickname)
         self._contact = contact
         self._gid = gid
 
-    def __str__(self):
-        return dumps({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             'type': 'GroupAnonymousMember',
             'group_id': self._gid,
-            'nick': self.get_name(),
-            'anonymous_id': self.get_id(),
-        }, ensure_ascii=False)
+            'nick': self._name,
+            'anonymous_id': self._id,
+        }
 
 
 class Group(Channel):
+    __slots__ = ('_members', '_members_tmp', '_members_fetched_at')
+
     def __init__(self, contact: Contacts, gid: int, name: str):
         super().__init__(contact, gid, name)
-        self._members_lock: asyncio.Lock = asyncio.Lock()
-        self._members: Dict[int, GroupMember] = None
+        self._members: Union[Dict[int, GroupMember], MemberTable] = None
         self._members_tmp: Dict[int, GroupMember] = dict()
+        # unix time of the last member list fetch
+        self._members_fetched_at: float = None
 
     def __eq__(self, other):
         if type(other) == Group:
@@ -237,11 +272,12 @@ class Group(Channel):
             return self._id == other
         return False
 
-    def __str__(self):
-        return str({
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'type': 'Group',
             'group_id': self._id,
             'name': self._name
-        })
+        }
 
     def get_type(self) -> Channel.ChannelType:
         return Channel.ChannelType.MultiUser
@@ -260,41 +296,43 @@ class Group(Channel):
         return await self._contacts._proto_wrapper.serv_group_revoke(self.get_id(), msgid)
 
     async def wait_msg(self, timeout: float = None) -> Union[ReceivedGroupMessage, None]:
-        wait_item: Contacts.WaitForItem = {
-            'channel_id': self.get_id(),
-            'payload': None,
-            'event': asyncio.Event()
-        }
-        self._contacts._wait_for_list['groupmsg'].append(wait_item)
-        ret = None
-        try:
-            await asyncio.wait_for(wait_item['event'].wait(), timeout)
-            ret = wait_item['payload']
-        except asyncio.TimeoutError:
-            pass
-        self._contacts._wait_for_list['groupmsg'][:] = [i for i in self._contacts._wait_for_list['groupmsg'] if
-                                                        i is not wait_item]
-        return ret
+        return await self._contacts._waiters.wait('groupmsg', self.get_id(), timeout)
+
+    async def wait_revoke(self, timeout: float = None) -> Union[RevokedMessage, None]:
+        """
+        Waiting for a message being revoked in this group
+
+        :param timeout: how long should blocking here, in second. None means forever
+        :return: revoked message, or None if timeout
+        """
+        return await self._contacts._waiters.wait('grouprevoke', self.get_id(), timeout)
 
     async def wait_member_message(self, member: Union[GroupMember, GroupAnonymousMember, int], timeout: float = None) -> Union[ReceivedGroupMessage, None]:
-        begin_time = time.time()
-        while True:
-            curr_time = time.time()
-            wait_time = None
-            if timeout is not None:
-                if curr_time - begin_time >= timeout:
-                    return None
-                else:
-                    wait_time = timeout - (curr_time - begin_time)
-            else:
-                pass
-            msg = await self.wait_msg(wait_time)
-            if msg is None:
-                continue
-            if type(member) is not int:
-                member = member.get_id()
-            if msg.get_sender().get_id() == member:
-                return msg
+        """
+        Waiting for a new message sent by the given member in this group
+
+        :param member: member object or user id
+        :param timeout: how long should blocking here, in second. None means forever
+        :return: received message, or None if timeout
+        """
+        if type(member) is not int:
+            member = member.get_id()
+        return await self._contacts.wait_for(self, lambda msg: msg.get_sender_id() == member, timeout)
+
+    def search(self, query: str, sender: Union[GroupMember, int] = None, since: datetime.datetime = None,
+               limit: int = 20) -> List[str]:
+        """
+        Search messages of this group containing all words of the query, newest first
+
+        Requires the search index being enabled
+
+        :param query: text to search
+        :param sender: only sent by this member, or user id. None means anyone
+        :param since: only messages not older than this. None means unbounded
+        :param limit: max number of results
+        :return: list of msgid
+        """
+        return [hit.msgid for hit in self._contacts.search(query, self, sender, since, limit)]
 
     async def get_member(self, id: int, nick: str = None) -> Union[GroupMember, None]:
         """
@@ -305,62 +343,149 @@ class Group(Channel):
         :param id: user id
         :param nick: user nickname
         """
-        async with self._members_lock:
-            if self._members is None:
-                # member list is not populated
-                if id in self._members_tmp:
-                    # but the member is in cache, that's all
-                    if nick is not None:
-                        # always update nick if possible
-                        self._members_tmp[id]._name = nick
-                    return self._members_tmp[id]
-                # if that member is also not in cache, so that we must get one
-                if nick is None:
-                    # no nick is provided so that the whole member list must be obtained
-                    self._members = dict()
-                    for uid, nick in (await self._contacts._proto_wrapper.get_group_members(self._id)).items():
-                        self._members[uid] = GroupMember(self._contacts, uid, nick, self._id)
-                    logger.debug('group member list initially forced fetched for {gid}, with {size} entries'.format(
-                        gid=self._id, size=len(self._members))
-                    )
-                    # disable the cached list
-                    self.__disable_cached_member_list()
-                    # return the requested member below later
-                else:
-                    # nick is also provided so that we find or create a mock member object
-                    self._members_tmp[id] = GroupMember(self._contacts, id, nick, self._id)
-                    logger.debug('mocked group member list of {gid}: append {uid}, total {size}'.format(
-                        gid=self._id, uid=id, size=len(self._members_tmp)))
-                    return self._members_tmp[id]
-            else:
-                # always use the populated list
-                pass
+        if self._members is None and nick is None and id not in self._members_tmp:
+            # no nick is provided so that the whole member list must be obtained
+            await self.__load_members()
+        return self._peek_member(id, nick)
+
+    def _peek_member(self, id: int, nick: str = None) -> Union[GroupMember, None]:
+        """
+        Pick a group member obj from given id, without fetching anything
+
+        A mock member is created if the member list is not populated and nick is provided
+
+        :param id: user id
+        :param nick: user nickname
+        :return: None if not found, or cannot be found without fetching
+        """
+        if self._members is None:
+            # member list is not populated
+            if id in self._members_tmp:
+                # but the member is in cache, that's all
+                if nick is not None:
+                    # always update nick if possible
+                    self._members_tmp[id]._name = nick
+                return self._members_tmp[id]
+            if nick is None:
+                return None
+            # nick is provided so that we create a mock member object
+            self._members_tmp[id] = GroupMember(self._contacts, id, nick, self._id)
+            logger.debug('mocked group member list of {gid}: append {uid}, total {size}'.format(
+                gid=self._id, uid=id, size=len(self._members_tmp)))
+            return self._members_tmp[id]
+        # always use the populated list, and refresh it in background if outdated
+        self._check_members_ttl()
+        if isinstance(self._members, MemberTable):
             if id in self._members:
                 if nick is not None:
                     # always update nick if possible
-                    self._members[id]._name = nick
+                    self._members.set_nick(id, nick)
                 return self._members[id]
             return None
+        member = self._members.get(id)
+        if member is not None and nick is not None:
+            # always update nick if possible
+            member._name = nick
+        return member
 
     async def get_members(self) -> Dict[int, GroupMember]:
         """
         Get all members in this group
 
+        Every member is materialized as an object. Prefer has_member() or iter_member_entries() on large groups
+
         :return: {uid, GroupMember} dict
         """
-        async with self._members_lock:
-            # always make sure the list is available
-            if self._members is None:
-                self._members = dict()
-                for uid, nick in (await self._contacts._proto_wrapper.get_group_members(self._id)).items():
-                    self._members[uid] = GroupMember(self._contacts, uid, nick, self._id)
-                logger.debug('group member list initially fetched for {gid}, with {size} entries'.format(
-                    gid=self._id, size=len(self._members))
-                )
-            if self._members_tmp is not None:
-                # there's something in cache, check and cleanup
-                self.__disable_cached_member_list()
-            return self._members
+        await self.__ensure_members()
+        if isinstance(self._members, MemberTable):
+            return self._members.to_dict()
+        return self._members
+
+    async def has_member(self, id: int) -> bool:
+        """
+        Check if the user is a member of this group, without creating member objects
+
+        :param id: user id
+        :return: True if is a member
+        """
+        await self.__ensure_members()
+        return id in self._members
+
+    async def iter_member_entries(self) -> Iterator[Tuple[int, str]]:
+        """
+        Iterate over all members as (uid, nickname) pairs, without creating member objects
+
+        :return: iterator of pairs
+        """
+        await self.__ensure_members()
+        if isinstance(self._members, MemberTable):
+            return self._members.entries()
+        return ((uid, member.get_name()) for uid, member in self._members.items())
+
+    async def __ensure_members(self):
+        # always make sure the list is available
+        if self._members is None:
+            await self.__load_members()
+        else:
+            self._check_members_ttl()
+
+    async def __load_members(self):
+        # concurrent callers share one fetch
+        await self._contacts._loader.do(('members', self._id), self.__fetch_members)
+
+    async def __fetch_members(self):
+        members = await self._contacts._proto_wrapper.get_group_members(self._id)
+        if self._members is not None:
+            # populated by others in the meantime
+            return
+        self._set_members(members, time.time())
+        logger.debug('group member list initially fetched for {gid}, with {size} entries'.format(
+            gid=self._id, size=len(self._members))
+        )
+        # disable the cached list
+        self.__disable_cached_member_list()
+
+    def _set_members(self, members: Dict[int, str], fetched_at: float):
+        """
+        Replace the populated member list with the given one
+
+        Existing member objects are kept and updated, so that references held by others stay valid
+
+        :param members: {id, nickname} dict
+        :param fetched_at: unix time when the list was fetched
+        """
+        if self._contacts._setting.columnar_members:
+            # member objects are views, nothing to keep
+            self._members = MemberTable(self._make_member, members)
+        else:
+            old = self._members if isinstance(self._members, dict) else dict()
+            self._members = dict()
+            for uid, nick in members.items():
+                member = old.get(uid)
+                if member is None:
+                    member = GroupMember(self._contacts, uid, nick, self._id)
+                else:
+                    member._name = nick
+                self._members[uid] = member
+        self._members_fetched_at = fetched_at
+
+    async def _revalidate_members(self):
+        """
+        Fetch the member list again and apply it, if the list is populated
+        """
+        members = await self._contacts._proto_wrapper.get_group_members(self._id)
+        if self._members is not None:
+            self._set_members(members, time.time())
+            logger.debug('group member list of {gid} refreshed, with {size} entries'.format(
+                gid=self._id, size=len(self._members))
+            )
+
+    def _check_members_ttl(self):
+        if self._contacts._is_stale(self._members_fetched_at, self._contacts._setting.members_ttl):
+            self._contacts._schedule_refresh(('members', self._id), self._revalidate_members)
+
+    def _make_member(self, uid: int, nick: str) -> GroupMember:
+        return GroupMember(self._contacts, uid, nick, self._id)
 
     def __disable_cached_member_list(self):
         logger.debug('group {gid} member cached list disabled'.format(gid=self._id))
@@ -373,39 +498,159 @@ class Group(Channel):
         self._members_tmp = None
 
 
-class Contacts:
-    class WaitForItem(TypedDict):
-        channel_id: int
-        payload: Any
-        event: asyncio.Event
+class WaitRegistry:
+    """
+    Pending waiters of incoming messages and revokes, indexed by kind and channel id
+
+    Waiters of the same channel are kept in an insertion-ordered dict used as an ordered set, so that both
+    delivering and leaving cost O(1) regardless of how many channels are being waited on.
+
+    Each waiter may carry a predicate, which is evaluated once per delivered payload. Waiters whose predicate does not
+    match stay registered and are not woken up at all.
+    """
+    KINDS = ('privmsg', 'groupmsg', 'privrevoke', 'grouprevoke')
+
+    def __init__(self):
+        self._waiters: Dict[str, Dict[int, Dict[asyncio.Future, Optional[Callable[[Any], bool]]]]] = {
+            kind: dict() for kind in self.KINDS
+        }
+
+    async def wait(self, kind: str, channel_id: int, timeout: float = None,
+                   predicate: Callable[[Any], bool] = None) -> Any:
+        """
+        Block until something is delivered to the channel
+
+        :param kind: one of KINDS
+        :param channel_id: channel id
+        :param timeout: how long should blocking here, in second. None means forever
+        :param predicate: only accept the payload if it returns True. None means accept anything
+        :return: delivered payload, or None if timeout
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[kind].setdefault(channel_id, dict())[fut] = predicate
+        try:
+            return await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            channel_waiters = self._waiters[kind].get(channel_id)
+            if channel_waiters is not None:
+                channel_waiters.pop(fut, None)
+                if len(channel_waiters) == 0:
+                    del self._waiters[kind][channel_id]
+
+    def deliver(self, kind: str, channel_id: int, payload: Any):
+        """
+        Wake up the waiters of the channel which accept the payload
+
+        :param kind: one of KINDS
+        :param channel_id: channel id
+        :param payload: received message or revoke
+        """
+        channel_waiters = self._waiters[kind].get(channel_id)
+        if channel_waiters is None:
+            return
+        for fut, predicate in list(channel_waiters.items()):
+            if fut.done():
+                continue
+            if predicate is not None:
+                try:
+                    if not predicate(payload):
+                        continue
+                except Exception as e:
+                    # let the waiter know its predicate is broken
+                    fut.set_exception(e)
+                    del channel_waiters[fut]
+                    continue
+            fut.set_result(payload)
+            del channel_waiters[fut]
+        if len(channel_waiters) == 0:
+            del self._waiters[kind][channel_id]
 
-    class WaitForList(TypedDict):
-        privmsg: List[Contacts.WaitForItem]
-        groupmsg: List[Contacts.WaitForItem]
-        privrevoke: List[Contacts.WaitForItem]
-        grouprevoke: List[Contacts.WaitForItem]
 
+class Contacts:
     # TODO: abstract and make lazy init unified
-    def __init__(self, protocol: ProtocolWrapper):
+    SNAPSHOT_VERSION = 1
+
+    def __init__(self, protocol: ProtocolWrapper, setting: BotConfig.ContactsSetting = None,
+                 create_task: Callable[[Awaitable, str], asyncio.Task] = None, search_index: SearchIndex = None):
+        """
+        :param protocol: protocol wrapper
+        :param setting: contacts setting
+        :param create_task: used to run background refreshes. None means creating plain tasks on the running loop
+        :param search_index: full-text index of delivered messages. None means search is not available
+        """
+        self._search: SearchIndex = search_index
         self._proto_wrapper: ProtocolWrapper = protocol
+        if setting is None:
+            setting = BotConfig.ContactsSetting()
+        self._setting: BotConfig.ContactsSetting = setting
+        if create_task is None:
+            def create_task(coro, name):
+                return asyncio.get_running_loop().create_task(coro, name=name)
+        self._create_task: Callable[[Awaitable, str], asyncio.Task] = create_task
+        # running background refreshes, keyed by the refreshed collection
+        self._refreshing: Dict[Any, asyncio.Task] = dict()
+        # unix time of the last failed background refresh, keyed the same way
+        self._refresh_failed_at: Dict[Any, float] = dict()
         # lazy init of dicts
-        # one mutex for both dicts
         self._me: Me = None
-        self._me_lock: asyncio.Lock = asyncio.Lock()
         self._friends: Dict[int, Friend] = None
-        self._friends_lock: asyncio.Lock = asyncio.Lock()
         self._groups: Dict[int, Group] = None
-        self._groups_lock: asyncio.Lock = asyncio.Lock()
+        # fetches of friends, groups and members of each group, shared by concurrent callers. Cached reads never wait
+        # for them
+        self._loader: SingleFlight = SingleFlight()
         self._friends_tmp: Dict[int, Friend] = dict()
+        # mocked friends kept in the populated list though the backend doesn't know them, never saved to snapshots
+        self._friends_mocked: Set[int] = set()
         self._groups_tmp: Dict[int, Group] = dict()
+        # unix time of the last list fetch
+        self._friends_fetched_at: float = None
+        self._groups_fetched_at: float = None
 
         # wait-for storage
-        self._wait_for_list: Contacts.WaitForList = {
-            'privmsg': [],
-            'groupmsg': [],
-            'privrevoke': [],
-            'grouprevoke': []
-        }
+        self._waiters: WaitRegistry = WaitRegistry()
+
+    async def wait_for(self, channel: Channel, predicate: Callable[[ReceivedMessage], bool] = None,
+                       timeout: float = None) -> Union[ReceivedMessage, None]:
+        """
+        Waiting for a new message coming to the channel which satisfies the predicate
+
+        The predicate is evaluated once for each message delivered to the channel, and the waiter is only woken up by
+        the matching one
+
+        :param channel: friend, stranger or group
+        :param predicate: filter of messages. None means any message
+        :param timeout: how long should blocking here, in second. None means forever
+        :return: received message, or None if timeout
+        """
+        if channel.get_type() == Channel.ChannelType.P2P:
+            kind = 'privmsg'
+        else:
+            kind = 'groupmsg'
+        return await self._waiters.wait(kind, channel.get_id(), timeout, predicate)
+
+    def search(self, query: str, channel: Channel = None, sender: Union[User, int] = None,
+               since: datetime.datetime = None, limit: int = 20) -> List[SearchHit]:
+        """
+        Search delivered messages containing all words of the query, newest first
+
+        Requires the search index being enabled
+
+        :param query: text to search
+        :param channel: only in this friend, stranger or group. None means everywhere
+        :param sender: only sent by this user, or user id. None means anyone
+        :param since: only messages not older than this. None means unbounded
+        :param limit: max number of results
+        :return: list of hits
+        """
+        if self._search is None:
+            raise Exception('search index is not enabled')
+        if isinstance(sender, User):
+            sender = sender.get_id()
+        if channel is None:
+            return self._search.search(query, sender_id=sender, since=since, limit=limit)
+        return self._search.search(query, channel.get_type(), channel.get_id(), sender, since, limit)
 
     async def get_myself(self) -> Me:
         """
@@ -413,10 +658,7 @@ class Contacts:
 
         :return: Me
         """
-        async with self._me_lock:
-            if self._me is None:
-                pass
-            return self._me
+        return self._me
 
     async def get_friend(self, id: int, nick: str = None) -> Union[Friend, None]:
         """
@@ -428,42 +670,43 @@ class Contacts:
         :param nick: user nickname
         :return: None if not found
         """
-        async with self._friends_lock:
-            if self._friends is None:
-                # friend list is not populated
-                if id in self._friends_tmp:
-                    # but the friend is in cache, that's all
-                    if nick is not None:
-                        # always update nick if possible
-                        self._friends_tmp[id]._name = nick
-                    return self._friends_tmp[id]
-                # if that member is also not in cache, so that we must get one
-                if nick is None:
-                    # no nick is provided so that the whole member list must be obtained
-                    self._friends = dict()
-                    for uid, nick in (await self._proto_wrapper.get_friend_list()).items():
-                        self._friends[uid] = Friend(self, uid, nick)
-                    logger.debug('friend list initially forced fetched, with {size} entries'.format(
-                        size=len(self._friends))
-                    )
-                    # disable the cached list
-                    self.__disable_cached_friends_list()
-                    # return the requested member below later
-                else:
-                    # nick is also provided so that we create a mock friend object
-                    self._friends_tmp[id] = Friend(self, id, nick)
-                    logger.debug(
-                        'mocked friend list: append {uid}, total {size}'.format(uid=id, size=len(self._friends_tmp)))
-                    return self._friends_tmp[id]
-            else:
-                # always use the populated list
-                pass
-            if id in self._friends:
+        if self._friends is None and nick is None and id not in self._friends_tmp:
+            # no nick is provided so that the whole friend list must be obtained
+            await self.__load_friends()
+        return self._peek_friend(id, nick)
+
+    def _peek_friend(self, id: int, nick: str = None) -> Union[Friend, None]:
+        """
+        Query the friend object from given id, without fetching anything
+
+        A mock friend is created if the friend list is not populated and nick is provided
+
+        :param id: user id
+        :param nick: user nickname
+        :return: None if not found, or cannot be found without fetching
+        """
+        if self._friends is None:
+            # friend list is not populated
+            if id in self._friends_tmp:
+                # but the friend is in cache, that's all
                 if nick is not None:
                     # always update nick if possible
-                    self._friends[id]._name = nick
-                return self._friends[id]
-            return None
+                    self._friends_tmp[id]._name = nick
+                return self._friends_tmp[id]
+            if nick is None:
+                return None
+            # nick is provided so that we create a mock friend object
+            self._friends_tmp[id] = Friend(self, id, nick)
+            logger.debug(
+                'mocked friend list: append {uid}, total {size}'.format(uid=id, size=len(self._friends_tmp)))
+            return self._friends_tmp[id]
+        # always use the populated list, and refresh it in background if outdated
+        self.__check_friends_ttl()
+        friend = self._friends.get(id)
+        if friend is not None and nick is not None:
+            # always update nick if possible
+            friend._name = nick
+        return friend
 
     async def get_friends(self) -> Dict[int, Friend]:
         """
@@ -471,25 +714,47 @@ class Contacts:
 
         :return: {uid, Friend} dict
         """
-        async with self._friends_lock:
-            # ensure list is available
-            if self._friends is None:
-                self._friends = dict()
-                for uid, nick in (await self._proto_wrapper.get_friend_list()).items():
-                    self._friends[uid] = Friend(self, uid, nick)
-                logger.debug('friend list initially fetched, with {size} entries'.format(
-                    size=len(self._friends))
-                )
-            if self._friends_tmp is not None:
-                # there's something in cache, check and cleanup
-                self.__disable_cached_friends_list()
-            return self._friends
+        # ensure list is available
+        if self._friends is None:
+            await self.__load_friends()
+        else:
+            self.__check_friends_ttl()
+        return self._friends
+
+    async def __load_friends(self):
+        # concurrent callers share one fetch
+        await self._loader.do('friends', self.__fetch_friends)
+
+    async def __fetch_friends(self):
+        friends = await self._proto_wrapper.get_friend_list()
+        if self._friends is not None:
+            # populated by others in the meantime
+            return
+        self.__set_friends(friends, time.time())
+        logger.debug('friend list initially fetched, with {size} entries'.format(size=len(self._friends)))
+        # disable the cached list
+        self.__disable_cached_friends_list()
+
+    def __set_friends(self, friends: Dict[int, str], fetched_at: float):
+        # keep existing objects so that references held by others stay valid
+        old = self._friends if self._friends is not None else dict()
+        self._friends = dict()
+        for uid, nick in friends.items():
+            friend = old.get(uid)
+            if friend is None:
+                friend = Friend(self, uid, nick)
+            else:
+                friend._name = nick
+            self._friends[uid] = friend
+        self._friends_mocked.clear()
+        self._friends_fetched_at = fetched_at
 
     def __disable_cached_friends_list(self):
         logger.debug('friend cached list disabled')
         for uid in self._friends_tmp:
             if uid not in self._friends:
                 logger.warning('friend {uid} doesn\' t exist'.format(uid=uid))
+                self._friends_mocked.add(uid)
             # use cached version
             self._friends[uid] = self._friends_tmp[uid]
         self._friends_tmp = None
@@ -504,42 +769,43 @@ class Contacts:
         :param name: group name
         :return: None if not found
         """
-        async with self._groups_lock:
-            if self._groups is None:
-                # group list is not populated
-                if id in self._groups_tmp:
-                    # but the friend is in cache, that's all
-                    if name is not None:
-                        # always update nick if possible
-                        self._groups_tmp[id]._name = name
-                    return self._groups_tmp[id]
-                # if that member is also not in cache, so that we must get one
-                if name is None:
-                    # no nick is provided so that the whole member list must be obtained
-                    self._groups = dict()
-                    for gid, name in (await self._proto_wrapper.get_group_list()).items():
-                        self._groups[gid] = Group(self, gid, name)
-                    logger.debug('group list initially forced fetched, with {size} entries'.format(
-                        size=len(self._groups))
-                    )
-                    # disable the cached list
-                    self.__disable_cached_groups_list()
-                    # return the requested member below later
-                else:
-                    # name is also provided so that we create a mock group object
-                    self._groups_tmp[id] = Group(self, id, name)
-                    logger.debug(
-                        'mocked group list: append {gid}, total {size}'.format(gid=id, size=len(self._groups_tmp)))
-                    return self._groups_tmp[id]
-            else:
-                # always use the populated list
-                pass
-            if id in self._groups:
+        if self._groups is None and name is None and id not in self._groups_tmp:
+            # no name is provided so that the whole group list must be obtained
+            await self.__load_groups()
+        return self._peek_group(id, name)
+
+    def _peek_group(self, id: int, name: str = None) -> Union[Group, None]:
+        """
+        Query the group object from given id, without fetching anything
+
+        A mock group is created if the group list is not populated and name is provided
+
+        :param id: group id
+        :param name: group name
+        :return: None if not found, or cannot be found without fetching
+        """
+        if self._groups is None:
+            # group list is not populated
+            if id in self._groups_tmp:
+                # but the group is in cache, that's all
                 if name is not None:
                     # always update nick if possible
-                    self._groups[id]._name = name
-                return self._groups[id]
-            return None
+                    self._groups_tmp[id]._name = name
+                return self._groups_tmp[id]
+            if name is None:
+                return None
+            # name is provided so that we create a mock group object
+            self._groups_tmp[id] = Group(self, id, name)
+            logger.debug(
+                'mocked group list: append {gid}, total {size}'.format(gid=id, size=len(self._groups_tmp)))
+            return self._groups_tmp[id]
+        # always use the populated list, and refresh it in background if outdated
+        self.__check_groups_ttl()
+        group = self._groups.get(id)
+        if group is not None and name is not None:
+            # always update nick if possible
+            group._name = name
+        return group
 
     async def get_groups(self) -> Dict[int, Group]:
         """
@@ -548,18 +814,38 @@ class Contacts:
         :return: {uid, Group} dict
         """
         # ensure list is available
-        async with self._groups_lock:
-            if self._groups is None:
-                self._groups = dict()
-                for gid, name in (await self._proto_wrapper.get_group_list()).items():
-                    self._groups[gid] = Group(self, gid, name)
-                logger.debug('group list initially fetched, with {size} entries'.format(
-                    size=len(self._groups))
-                )
-            if self._groups_tmp is not None:
-                # there's something in cache, check and cleanup
-                self.__disable_cached_groups_list()
-            return self._groups
+        if self._groups is None:
+            await self.__load_groups()
+        else:
+            self.__check_groups_ttl()
+        return self._groups
+
+    async def __load_groups(self):
+        # concurrent callers share one fetch
+        await self._loader.do('groups', self.__fetch_groups)
+
+    async def __fetch_groups(self):
+        groups = await self._proto_wrapper.get_group_list()
+        if self._groups is not None:
+            # populated by others in the meantime
+            return
+        self.__set_groups(groups, time.time())
+        logger.debug('group list initially fetched, with {size} entries'.format(size=len(self._groups)))
+        # disable the cached list
+        self.__disable_cached_groups_list()
+
+    def __set_groups(self, groups: Dict[int, str], fetched_at: float):
+        # keep existing objects so that references held by others stay valid
+        old = self._groups if self._groups is not None else dict()
+        self._groups = dict()
+        for gid, name in groups.items():
+            group = old.get(gid)
+            if group is None:
+                group = Group(self, gid, name)
+            else:
+                group._name = name
+            self._groups[gid] = group
+        self._groups_fetched_at = fetched_at
 
     def __disable_cached_groups_list(self):
         logger.debug('group cached list disabled')
@@ -570,3 +856,177 @@ class Contacts:
                 # use cached version
                 self._groups[gid] = self._groups_tmp[gid]
         self._groups_tmp = None
+
+    def save_snapshot(self, path: str) -> bool:
+        """
+        Save populated friend, group and member lists to disk, so that they can be loaded at next startup
+
+        Only lists fetched from the backend are saved, mocked entries are not. The file is replaced atomically.
+
+        :param path: snapshot file path
+        :return: False if there's nothing to save
+        """
+        snapshot = {
+            'version': self.SNAPSHOT_VERSION,
+            'saved_at': time.time(),
+        }
+        if self._friends is not None:
+            friends = [friend for uid, friend in self._friends.items() if uid not in self._friends_mocked]
+            snapshot['friends'] = {
+                'fetched_at': self._friends_fetched_at,
+                'ids': [friend._id for friend in friends],
+                'names': [friend._name for friend in friends],
+            }
+        if self._groups is not None:
+            groups = []
+            for group in self._groups.values():
+                entry = {
+                    'id': group._id,
+                    'name': group._name,
+                }
+                if group._members is not None:
+                    if isinstance(group._members, MemberTable):
+                        entries = group._members.entries()
+                    else:
+                        entries = ((uid, member._name) for uid, member in group._members.items())
+                    uids, nicks = [], []
+                    for uid, nick in entries:
+                        uids.append(uid)
+                        nicks.append(nick)
+                    entry['members'] = {
+                        'fetched_at': group._members_fetched_at,
+                        'ids': uids,
+                        'names': nicks,
+                    }
+                groups.append(entry)
+            snapshot['groups'] = {
+                'fetched_at': self._groups_fetched_at,
+                'list': groups,
+            }
+        if 'friends' not in snapshot and 'groups' not in snapshot:
+            return False
+        data = JsonCodec.dumps(snapshot)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        logger.info('contacts snapshot saved to {path}'.format(path=path))
+        return True
+
+    def load_snapshot(self, path: str) -> bool:
+        """
+        Load friend, group and member lists saved by save_snapshot()
+
+        Loaded lists are treated as populated ones. Should be called before any contact is queried, and followed by
+        revalidate() to catch up with changes happened while the bot was offline.
+
+        :param path: snapshot file path
+        :return: False if the snapshot doesn't exist or is unusable
+        """
+        try:
+            with open(path, 'rb') as f:
+                snapshot = JsonCodec.loads(f.read())
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            logger.warning('failed to read contacts snapshot {path}: {reason}'.format(path=path, reason=str(e)))
+            return False
+        if snapshot.get('version') != self.SNAPSHOT_VERSION:
+            logger.warning('contacts snapshot {path} has unsupported version, ignored'.format(path=path))
+            return False
+        friends = snapshot.get('friends')
+        if friends is not None:
+            self.__set_friends(dict(zip(friends['ids'], friends['names'])), friends['fetched_at'])
+            self.__disable_cached_friends_list()
+        groups = snapshot.get('groups')
+        if groups is not None:
+            self.__set_groups({entry['id']: entry['name'] for entry in groups['list']}, groups['fetched_at'])
+            self.__disable_cached_groups_list()
+            for entry in groups['list']:
+                members = entry.get('members')
+                if members is not None:
+                    group = self._groups[entry['id']]
+                    group._set_members(dict(zip(members['ids'], members['names'])), members['fetched_at'])
+                    group._members_tmp = None
+        logger.info('contacts snapshot loaded from {path}, with {f} friends and {g} groups'.format(
+            path=path, f=len(self._friends) if self._friends is not None else 0,
+            g=len(self._groups) if self._groups is not None else 0)
+        )
+        return True
+
+    async def revalidate(self):
+        """
+        Fetch again all populated lists from the backend and apply the changes
+
+        Cached objects are kept and updated in place. Lists which are not populated are left lazy.
+        """
+        if self._friends is not None:
+            try:
+                await self._loader.do('friends', self.__refresh_friends)
+            except Exception as e:
+                logger.warning('failed to revalidate friend list: {reason}'.format(reason=str(e)))
+        if self._groups is not None:
+            try:
+                await self._loader.do('groups', self.__refresh_groups)
+            except Exception as e:
+                logger.warning('failed to revalidate group list: {reason}'.format(reason=str(e)))
+            for group in list(self._groups.values()):
+                if group._members is None:
+                    continue
+                try:
+                    await self._loader.do(('members', group._id), group._revalidate_members)
+                except Exception as e:
+                    logger.warning('failed to revalidate member list of {gid}: {reason}'.format(
+                        gid=group._id, reason=str(e)))
+        logger.debug('contacts revalidated')
+
+    @staticmethod
+    def _is_stale(fetched_at: Optional[float], ttl: Optional[float]) -> bool:
+        if ttl is None:
+            return False
+        return fetched_at is None or time.time() - fetched_at >= ttl
+
+    def _schedule_refresh(self, key: Any, refresh: Callable[[], Awaitable]):
+        """
+        Run a refresh in background, unless the same one is already running
+
+        :param key: identifies the refreshed collection, shared with the loader
+        :param refresh: co-routine function doing the refresh
+        """
+        if key in self._refreshing or self._loader.running(key):
+            return
+        failed_at = self._refresh_failed_at.get(key)
+        if failed_at is not None and time.time() - failed_at < self._setting.refresh_retry_interval:
+            # the list stays stale, don't hit the backend on every read
+            return
+        self._refreshing[key] = self._create_task(self.__run_refresh(key, refresh), 'contacts_refresh')
+
+    async def __run_refresh(self, key: Any, refresh: Callable[[], Awaitable]):
+        try:
+            await self._loader.do(key, refresh)
+            self._refresh_failed_at.pop(key, None)
+        except Exception as e:
+            self._refresh_failed_at[key] = time.time()
+            logger.warning('failed to refresh {key}: {reason}'.format(key=key, reason=str(e)))
+        finally:
+            self._refreshing.pop(key, None)
+
+    def __check_friends_ttl(self):
+        if self._is_stale(self._friends_fetched_at, self._setting.friends_ttl):
+            self._schedule_refresh('friends', self.__refresh_friends)
+
+    def __check_groups_ttl(self):
+        if self._is_stale(self._groups_fetched_at, self._setting.groups_ttl):
+            self._schedule_refresh('groups', self.__refresh_groups)
+
+    async def __refresh_friends(self):
+        friends = await self._proto_wrapper.get_friend_list()
+        self.__set_friends(friends, time.time())
+        logger.debug('friend list refreshed, with {size} entries'.format(size=len(friends)))
+
+    async def __refresh_groups(self):
+        groups = await self._proto_wrapper.get_group_list()
+        self.__set_groups(groups, time.time())
+        logger.debug('group list refreshed, with {size} entries'.format(size=len(groups)))
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from loguru import logger
+import typing
+import asyncio
+import collections
+import traceback
+import sys
+
+
+class EventDispatcher:
+    """
+    A fixed number of workers fed by a bounded queue.
+
+    Push events are queued here instead of getting a task each, so that a burst of events will not create unbounded
+    amount of tasks. Once the queue is full, the producer will be blocked until some worker becomes free.
+
+    Workers only parse and deliver events. User callbacks are handed to CallbackRunner, since they may wait for later
+    events, which could never be delivered if the callbacks held all workers.
+    """
+
+    _worker_name: str = 'push_event_worker'
+
+    def __init__(self, worker_count: int, queue_size: int):
+        self._worker_count: int = worker_count
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._workers: typing.Set[asyncio.Task] = set()
+        self._stopped: bool = False
+
+    def start(self):
+        """
+        Bring up the workers. Must be called inside the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        for i in range(self._worker_count):
+            self._workers.add(loop.create_task(self._worker(), name='{name}_{i}'.format(name=self._worker_name, i=i)))
+
+    async def put(self, coro: typing.Awaitable, name: str):
+        """
+        Queue a co-routine for the workers. Block if the queue is full.
+
+        :param coro: co-routine
+        :param name: job name, used for logging
+        """
+        if self._stopped:
+            # nobody will run it
+            logger.warning('dropped {name} queued after shutdown'.format(name=name))
+            if asyncio.iscoroutine(coro):
+                coro.close()
+            return
+        try:
+            await self._queue.put((coro, name))
+        except asyncio.CancelledError:
+            # the job will never run, avoid the never awaited warning
+            if asyncio.iscoroutine(coro):
+                coro.close()
+            raise
+
+    async def stop(self):
+        """
+        Wait until all queued jobs are done, then shutdown the workers
+        """
+        await self._queue.join()
+        self._stopped = True
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers.clear()
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    async def _worker(self):
+        while True:
+            coro, name = await self._queue.get()
+            try:
+                await coro
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.error('Exception from {name}'.format(name=name))
+                traceback.print_exc(file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+
+class CallbackRunner(EventDispatcher):
+    """
+    A fixed number of workers running user callbacks, fed by a bounded queue apart from the push event queue.
+
+    Push workers wake waiters of an event before submitting its callback, so a callback waiting for a later message
+    never keeps that message from being delivered. Once the callback queue is full, submitting blocks the push
+    workers, which in turn blocks the communication backend, so slow callbacks throttle the producer instead of piling
+    up as tasks.
+    """
+    _worker_name = 'callback_worker'
+
+    async def submit(self, coro: typing.Awaitable, name: str):
+        """
+        Queue a callback. Block if the queue is full
+
+        :param coro: co-routine
+        :param name: job name, used for logging
+        """
+        await self.put(coro, name)
+
+
+class ChannelSequencer:
+    """
+    Run jobs sharing the same key one by one in submitting order, while jobs of different keys run concurrently.
+
+    Each key with pending jobs owns a lane task, which exits once the lane is drained. The number of jobs running at
+    the same time is limited across all lanes, and the number of jobs queued in each lane is bounded, so that a slow
+    channel throttles the producer instead of growing without limit.
+    """
+
+    def __init__(self, max_parallel: int, lane_size: int,
+                 create_task: typing.Callable[[typing.Awaitable, str], asyncio.Task]):
+        self._lanes: typing.Dict[typing.Hashable, typing.Deque[typing.Tuple[typing.Awaitable, str]]] = dict()
+        # submitters blocked by a full lane, woken one by one as the lane drains
+        self._blocked: typing.Dict[typing.Hashable, typing.Deque[asyncio.Future]] = dict()
+        self._semaphore: asyncio.Semaphore = asyncio.Semaphore(max_parallel)
+        self._lane_size: int = lane_size
+        self._create_task = create_task
+
+    async def submit(self, key: typing.Hashable, coro: typing.Awaitable, name: str):
+        """
+        Append a co-routine to the lane of the given key. Block if the lane is full
+
+        :param key: ordering key, such as channel id
+        :param coro: co-routine
+        :param name: job name, used for logging
+        """
+        try:
+            while True:
+                lane = self._lanes.get(key)
+                if lane is None:
+                    self._lanes[key] = collections.deque(((coro, name),))
+                    self._create_task(self._run_lane(key), 'channel_lane')
+                    return
+                if len(lane) < self._lane_size:
+                    lane.append((coro, name))
+                    return
+                fut = asyncio.get_running_loop().create_future()
+                blocked = self._blocked.setdefault(key, collections.deque())
+                blocked.append(fut)
+                try:
+                    await fut
+                except asyncio.CancelledError:
+                    if fut.cancelled():
+                        # still queued
+                        blocked.remove(fut)
+                        if len(blocked) == 0 and self._blocked.get(key) is blocked:
+                            del self._blocked[key]
+                    else:
+                        # woken up already, pass it on
+                        self.__wake_one(key)
+                    raise
+        except asyncio.CancelledError:
+            # the job will never run, avoid the never awaited warning
+            if asyncio.iscoroutine(coro):
+                coro.close()
+            raise
+
+    def __wake_one(self, key: typing.Hashable):
+        blocked = self._blocked.get(key)
+        if blocked is None:
+            return
+        fut = blocked.popleft()
+        if len(blocked) == 0:
+            del self._blocked[key]
+        if not fut.done():
+            fut.set_result(None)
+
+    async def _run_lane(self, key: typing.Hashable):
+        lane = self._lanes[key]
+        while len(lane) != 0:
+            coro, name = lane.popleft()
+            self.__wake_one(key)
+            async with self._semaphore:
+                try:
+                    await coro
+                except Exception:
+                    logger.error('Exception from {name}'.format(name=name))
+                    traceback.print_exc(file=sys.stderr)
+        del self._lanes[key]
@@ -19,6 +19,9 @@ from .Contacts import Channel
 from .Message import ReceivedMessage, RepliedMessage, RevokedMessage, RepliedMessageContext, \
     ReceivedPrivateMessage, ReceivedGroupMessage, PrivateMessageContext, GroupMessageContext
 from .MsgContent import MessageContent
+from .SingleFlight import SingleFlight
+from .MessageStore import MessageCache
+from .MessageJournal import MessageJournal
 
 
 class BotWrapper:
@@ -40,59 +43,93 @@ class BotWrapper:
         """
         return self.__bot._create_bot_task(coro, name)
 
+    async def dispatch(self, coro: typing.Awaitable, name: str):
+        """
+        Call this to queue a push event co-routine to the bounded worker pool
+
+        Will block if too many events are pending, so that the caller gets throttled
+
+        :param coro: event processing co-routine
+        :param name: job name
+        """
+        await self.__bot._dispatcher.put(coro, name)
+
+    async def __run_callback(self, key: typing.Hashable, coro: typing.Awaitable, name: str):
+        """
+        Run a user callback without holding the push event worker, which may be needed to deliver what the callback
+        waits for
+
+        In ordered dispatch mode the callback is queued behind earlier callbacks of the same channel, blocking if too
+        many are queued there
+
+        :param key: ordering key of the channel
+        :param coro: callback co-routine
+        :param name: job name
+        """
+        if self.__bot._sequencer is not None:
+            await self.__bot._sequencer.submit(key, coro, name)
+        else:
+            await self.__bot._callbacks.submit(coro, name)
+
     async def deliver_private_msg(self, ctx: PrivateMessageContext):
         """
         Call this func to deliver a private message event to bot payload
+
+        Waiters are woken at once. In ordered dispatch mode the callback is queued behind earlier ones of the same
+        channel
         """
+        # remember it at once, so that quotes and revokes of it can be resolved locally
+        self.__bot._msg_cache.put((Channel.ChannelType.P2P, ctx.channel_id, ctx.msgid), ctx)
+        if self.__bot._journal is not None:
+            self.__bot._journal.append(ctx)
+        if self.__bot._search is not None:
+            self.__bot._search.add(ctx)
+
         msg: ReceivedMessage = ReceivedPrivateMessage(self.__bot.get_contacts())
         msg._time = ctx.time
         msg._msgID = ctx.msgid
         msg._msgContent = ctx.msgcontent
         msg._summary = ctx.summary
+        msg._sender_id = ctx.sender_id
         if ctx.reply is not None:
             msg._reply = RepliedMessage(ctx.reply, msg)
-        if ctx.is_friend:
-            msg._channel = await self.__bot.get_contacts().get_friend(ctx.channel_id, ctx.channel_nick)
-            msg._sender = await self.__bot.get_contacts().get_friend(ctx.sender_id, ctx.sender_nick)
-        else:
-            msg._ref_channel = await self.__bot.get_contacts().get_group(ctx.from_channel, ctx.from_channel_name)
-            msg._channel = await (await msg._ref_channel.get_member(ctx.channel_id, ctx.channel_nick)).open_private_channel()
-            msg._sender = await (await msg._ref_channel.get_member(ctx.sender_id, ctx.sender_nick)).open_private_channel()
+        # channel and sender are resolved when first asked for
+        msg._ctx = ctx
 
-        for wait_item in self.__bot.get_contacts()._wait_for_list['privmsg']:
-            if wait_item['channel_id'] == ctx.channel_id and wait_item['payload'] is None:
-                wait_item['payload'] = msg
-                wait_item['event'].set()
+        self.__bot.get_contacts()._waiters.deliver('privmsg', ctx.channel_id, msg)
 
         if self.__bot._on_private_msg_cb is not None:
-            await self.__bot._on_private_msg_cb(msg)
+            await self.__run_callback(('private', ctx.channel_id), self.__bot._on_private_msg_cb(msg), 'private_msg')
 
     async def deliver_group_msg(self, ctx: GroupMessageContext):
         """
         Call this func to deliver a group message event to bot payload
+
+        Waiters are woken at once. In ordered dispatch mode the callback is queued behind earlier ones of the same
+        channel
         """
+        # remember it at once, so that quotes and revokes of it can be resolved locally
+        self.__bot._msg_cache.put((Channel.ChannelType.MultiUser, ctx.group_id, ctx.msgid), ctx)
+        if self.__bot._journal is not None:
+            self.__bot._journal.append(ctx)
+        if self.__bot._search is not None:
+            self.__bot._search.add(ctx)
+
         msg: ReceivedMessage = ReceivedGroupMessage(self.__bot._contacts)
         msg._time = ctx.time
         msg._msgID = ctx.msgid
         msg._msgContent = ctx.msgcontent
         msg._summary = ctx.summary
+        msg._sender_id = ctx.sender_id
         if ctx.reply is not None:
             msg._reply = RepliedMessage(ctx.reply, msg)
-        if ctx.is_anonymous:
-            msg._channel = await self.__bot.get_contacts().get_group(ctx.group_id, ctx.group_name)
-            msg._sender = GroupAnonymousMember(self.__bot.get_contacts(), ctx.sender_id, '',
-                                               ctx.group_id)  # TODO: temporarily use empty nick
-        else:
-            msg._channel = await self.__bot.get_contacts().get_group(ctx.group_id, ctx.group_name)
-            msg._sender = await msg._channel.get_member(ctx.sender_id, ctx.sender_nick)
+        # channel and sender are resolved when first asked for
+        msg._ctx = ctx
 
-        for wait_item in self.__bot.get_contacts()._wait_for_list['groupmsg']:
-            if wait_item['channel_id'] == ctx.group_id and wait_item['payload'] is None:
-                wait_item['payload'] = msg
-                wait_item['event'].set()
+        self.__bot.get_contacts()._waiters.deliver('groupmsg', ctx.group_id, msg)
 
         if self.__bot._on_group_msg_cb is not None:
-            await self.__bot._on_group_msg_cb(msg)
+            await self.__run_callback(('group', ctx.group_id), self.__bot._on_group_msg_cb(msg), 'group_msg')
 
     async def deliver_private_revoke(self, time: datetime.datetime, revoker_id: int, channel: int,
                                      is_friend: bool, msgid: str):
@@ -106,9 +143,12 @@ class BotWrapper:
         :param is_friend: is friend
         :param msgid: the message being revoked
         """
-        msg: RevokedMessage = RevokedMessage()
+        msg: RevokedMessage = RevokedMessage(self.__bot.get_contacts())
         msg._time = time
         msg._msgid = msgid
+        msg._msg_channel_type = Channel.ChannelType.P2P
+        # private messages from strangers are kept by the stranger id
+        msg._msg_channel_id = channel if is_friend else revoker_id
         if is_friend:
             msg._channel = await self.__bot.get_contacts().get_friend(channel)
             msg._revoker = msg._channel
@@ -116,8 +156,12 @@ class BotWrapper:
             msg._channel = await self.__bot.get_contacts().get_group(channel)
             msg._revoker = await (await msg._channel.get_member(revoker_id)).open_private_channel()
 
+        # waiters and ordering use the same private channel id as messages do, which is the stranger id for strangers
+        self.__bot.get_contacts()._waiters.deliver('privrevoke', msg._msg_channel_id, msg)
+
         if self.__bot._on_private_revoke_cb is not None:
-            await self.__bot._on_private_revoke_cb(msg)
+            await self.__run_callback(('private', msg._msg_channel_id), self.__bot._on_private_revoke_cb(msg),
+                                      'private_revoke')
 
     async def deliver_group_revoke(self, time: datetime.datetime, revoker_id: int, group: int,
                                    is_anonymous: bool, msgid: str):
@@ -132,9 +176,11 @@ class BotWrapper:
         :param msgid: message being revoked
         :return:
         """
-        msg: RevokedMessage = RevokedMessage()
+        msg: RevokedMessage = RevokedMessage(self.__bot.get_contacts())
         msg._time = time
         msg._msgid = msgid
+        msg._msg_channel_type = Channel.ChannelType.MultiUser
+        msg._msg_channel_id = group
         if is_anonymous:
             msg._channel = await self.__bot.get_contacts().get_group(group)
             msg._revoker = GroupAnonymousMember(self.__bot.get_contacts(), revoker_id, '', group)
@@ -142,22 +188,24 @@ class BotWrapper:
             msg._channel = await self.__bot.get_contacts().get_group(group)
             msg._revoker = await msg._channel.get_member(revoker_id)
 
+        self.__bot.get_contacts()._waiters.deliver('grouprevoke', group, msg)
+
         if self.__bot._on_group_revoke_cb is not None:
-            await self.__bot._on_group_revoke_cb(msg)
+            await self.__run_callback(('group', group), self.__bot._on_group_revoke_cb(msg), 'group_revoke')
 
     async def process_group_mute_event(self, group_id: int, user_id: int, duration: int):
         if self.__bot._on_event_cb is not None:
             ev = GroupMute(group_id, user_id, duration)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
 
     async def process_bot_online_event(self):
         if self.__bot._on_event_cb is not None:
-            await self.__bot._on_event_cb(OnlineEvent())
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(OnlineEvent()), 'event')
 
     async def process_bot_offline_event(self):
         if self.__bot._on_event_cb is not None:
-            await self.__bot._on_event_cb(OfflineEvent())
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(OfflineEvent()), 'event')
 
     async def process_friend_removed_event(self, id: int, nick: str):
         """
@@ -169,14 +217,14 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = FriendRemoved(id, nick)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-        async with self.__bot.get_contacts()._friends_lock:
-            if self.__bot.get_contacts()._friends is None:
-                if id in self.__bot.get_contacts()._friends_tmp:
-                    del self.__bot.get_contacts()._friends_tmp[id]
-                return
-            if id in self.__bot.get_contacts()._friends:
-                del self.__bot.get_contacts()._friends[id]
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+        contacts = self.__bot.get_contacts()
+        # let the running fetch land first, so that this change is applied on top of it
+        await contacts._loader.join('friends')
+        if contacts._friends is None:
+            contacts._friends_tmp.pop(id, None)
+            return
+        contacts._friends.pop(id, None)
 
     async def process_friend_added_event(self, id: int, nick: str):
         """
@@ -188,12 +236,14 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = FriendAdded(id, nick)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-        async with self.__bot.get_contacts()._friends_lock:
-            # ignore those event if contact is not used
-            if self.__bot.get_contacts()._friends is None:
-                return
-            self.__bot.get_contacts()._friends[id] = Friend(self.__bot.get_contacts(), id, nick)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+        contacts = self.__bot.get_contacts()
+        # let the running fetch land first, so that this change is applied on top of it
+        await contacts._loader.join('friends')
+        # ignore those event if contact is not used
+        if contacts._friends is None:
+            return
+        contacts._friends[id] = Friend(contacts, id, nick)
 
     async def process_new_friend_request_event(self, id: int, nick: str, comment: str, event_id: str, source: int = None):
         """
@@ -208,7 +258,7 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = NewFriendRequest(id, nick, comment, event_id, source)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
 
     async def process_group_invitation_event(self, gid: int, name: str, inviter: int, event_id: str):
         """
@@ -222,7 +272,7 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = NewGroupInvitation(gid, name, inviter, event_id)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
 
     async def process_group_removed_event(self, id: int, name: str, kicked_by: int = None):
         """
@@ -235,14 +285,14 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupRemoved(id, name, kicked_by)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-        async with self.__bot.get_contacts()._groups_lock:
-            if self.__bot.get_contacts()._groups is None:
-                if id in self.__bot.get_contacts()._groups_tmp:
-                    del self.__bot.get_contacts()._groups_tmp[id]
-                return
-            if id in self.__bot.get_contacts()._groups:
-                del self.__bot.get_contacts()._groups[id]
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+        contacts = self.__bot.get_contacts()
+        # let the running fetch land first, so that this change is applied on top of it
+        await contacts._loader.join('groups')
+        if contacts._groups is None:
+            contacts._groups_tmp.pop(id, None)
+            return
+        contacts._groups.pop(id, None)
 
     async def process_group_added_event(self, id: int, name: str):
         """
@@ -254,12 +304,14 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupAdded(id, name)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-        async with self.__bot.get_contacts()._groups_lock:
-            # ignore those event if contact is not used
-            if self.__bot.get_contacts()._groups is None:
-                return
-            self.__bot.get_contacts()._groups[id] = Group(self.__bot.get_contacts(), id, name)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+        contacts = self.__bot.get_contacts()
+        # let the running fetch land first, so that this change is applied on top of it
+        await contacts._loader.join('groups')
+        # ignore those event if contact is not used
+        if contacts._groups is None:
+            return
+        contacts._groups[id] = Group(contacts, id, name)
 
     async def process_group_member_added_event(self, uid: int, nick: str, gid: int, group_name: str):
         """
@@ -273,17 +325,18 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupMemberAdded(gid, group_name, uid, nick)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-        async with self.__bot.get_contacts()._groups_lock:
-            # ignore those event if contact is not used
-            if self.__bot.get_contacts()._groups is None:
-                return
-            if gid not in self.__bot.get_contacts()._groups:
-                return
-            async with self.__bot.get_contacts()._groups[gid]._members_lock:
-                if self.__bot.get_contacts()._groups[gid]._members is None:
-                    return
-                self.__bot.get_contacts()._groups[gid]._members[uid] = GroupMember(self.__bot.get_contacts(), uid, nick, gid)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+        contacts = self.__bot.get_contacts()
+        # let the running fetches land first, so that this change is applied on top of them
+        await contacts._loader.join('groups')
+        await contacts._loader.join(('members', gid))
+        # ignore those event if contact is not used
+        if contacts._groups is None:
+            return
+        group = contacts._groups.get(gid)
+        if group is None or group._members is None:
+            return
+        group._members[uid] = GroupMember(contacts, uid, nick, gid)
 
     async def process_group_member_removed_event(self, uid: int, gid: int, group_name: str):
         """
@@ -296,23 +349,27 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupMemberRemoved(gid, group_name, uid)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
-
-        async with self.__bot.get_contacts()._groups_lock:
-            if self.__bot.get_contacts()._groups is None:
-                if gid in self.__bot.get_contacts()._groups_tmp:
-                    del self.__bot.get_contacts()._groups_tmp[uid]
-                return
-            if gid not in self.__bot.get_contacts()._groups:
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
+
+        contacts = self.__bot.get_contacts()
+        # let the running fetches land first, so that this change is applied on top of them
+        await contacts._loader.join('groups')
+        await contacts._loader.join(('members', gid))
+        if contacts._groups is None:
+            group = contacts._groups_tmp.get(gid)
+        else:
+            group = contacts._groups.get(gid)
+            if group is None:
                 # it is already loaded list
                 logger.error('error: group {gid} doesn\' t exist!'.format(gid=gid))
                 return
-            async with self.__bot.get_contacts()._groups[gid]._members_lock:
-                if self.__bot.get_contacts()._groups[gid]._members is None:
-                    if uid in self.__bot.get_contacts()._groups[gid]._members_tmp:
-                        del self.__bot.get_contacts()._groups[gid]._members_tmp[uid]
-                    return
-                del self.__bot.get_contacts()._groups[gid]._members[uid]
+        if group is None:
+            return
+        if group._members is None:
+            group._members_tmp.pop(uid, None)
+            return
+        if uid in group._members:
+            del group._members[uid]
 
     async def process_group_member_join_request_event(self, uid: int, gid: int, comment: str, event_id: str, inviter: int = None):
         """
@@ -327,7 +384,7 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupMemberJoinRequest(uid, gid, event_id, comment, inviter)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
 
     async def process_group_admin_change_event(self, gid: int, uid: int, flag: bool):
         """
@@ -340,7 +397,7 @@ class BotWrapper:
         if self.__bot._on_event_cb is not None:
             ev = GroupAdminChange(gid, uid, flag)
             ev._contacts = self.__bot.get_contacts()
-            await self.__bot._on_event_cb(ev)
+            await self.__bot._callbacks.submit(self.__bot._on_event_cb(ev), 'event')
 
 
 class ProtocolWrapper(ABC):
@@ -491,3 +548,77 @@ class ProtocolWrapper(ABC):
         :return: success or not
         """
         pass
+
+
+class CoalescingProtocolWrapper(ProtocolWrapper):
+    """
+    Wrap a ProtocolWrapper, so that identical queries running at the same time share one backend request.
+
+    Query methods are coalesced by their arguments, other methods are passed through. Results of a coalesced query are
+    shared by all its callers and should be treated as read-only.
+
+    Messages are looked up in the message cache and the journal before asking the backend.
+    """
+
+    def __init__(self, proto: ProtocolWrapper, msg_cache: MessageCache = None, journal: MessageJournal = None):
+        """
+        :param proto: the wrapped protocol
+        :param msg_cache: recently delivered messages. None means not used
+        :param journal: on-disk journal of delivered messages. None means not used
+        """
+        self._proto: ProtocolWrapper = proto
+        self._flights: SingleFlight = SingleFlight()
+        self._msg_cache: MessageCache = msg_cache
+        self._journal: MessageJournal = journal
+
+    async def get_bot_basic_info(self) -> typing.Tuple[int, str]:
+        return await self._flights.do(('basic_info',), self._proto.get_bot_basic_info)
+
+    async def serv_private_message(self, id: int, msg_content: MessageContent, *, from_channel: int = None,
+                                   reply: RepliedMessageContext = None) -> str:
+        return await self._proto.serv_private_message(id, msg_content, from_channel=from_channel, reply=reply)
+
+    async def serv_group_message(self, id: int, msg_content: MessageContent, *, as_anonymous: bool = False,
+                                 reply: RepliedMessageContext = None) -> str:
+        return await self._proto.serv_group_message(id, msg_content, as_anonymous=as_anonymous, reply=reply)
+
+    async def serv_private_revoke(self, id: int, msgid: str) -> bool:
+        return await self._proto.serv_private_revoke(id, msgid)
+
+    async def serv_group_revoke(self, id: int, msgid: str) -> bool:
+        return await self._proto.serv_group_revoke(id, msgid)
+
+    async def query_packed_msg(self, id: str) -> typing.List[GroupedSegment.ContextFreeMessage]:
+        return await self._flights.do(('packed_msg', id), lambda: self._proto.query_packed_msg(id))
+
+    async def query_msg_by_id(self, channel_type: Channel.ChannelType, channel_id: int, msgid: str) -> Union[PrivateMessageContext, GroupMessageContext]:
+        if self._msg_cache is not None:
+            ctx = self._msg_cache.get((channel_type, channel_id, msgid))
+            if ctx is not None:
+                return ctx
+        if self._journal is not None:
+            ctx = self._journal.get(channel_type, channel_id, msgid)
+            if ctx is not None:
+                if self._msg_cache is not None:
+                    self._msg_cache.put((channel_type, channel_id, msgid), ctx)
+                return ctx
+        return await self._flights.do(('msg', channel_type, channel_id, msgid),
+                                      lambda: self._proto.query_msg_by_id(channel_type, channel_id, msgid))
+
+    async def get_friend_list(self) -> typing.Dict[int, str]:
+        return await self._flights.do(('friend_list',), self._proto.get_friend_list)
+
+    async def get_group_list(self) -> typing.Dict[int, str]:
+        return await self._flights.do(('group_list',), self._proto.get_group_list)
+
+    async def get_group_members(self, id: int) -> typing.Dict[int, str]:
+        return await self._flights.do(('group_members', id), lambda: self._proto.get_group_members(id))
+
+    async def deal_friend_request(self, id: int, event_id: str, is_accept: bool) -> bool:
+        return await self._proto.deal_friend_request(id, event_id, is_accept)
+
+    async def deal_group_invitation(self, id: int, event_id: str, is_accept: bool) -> bool:
+        return await self._proto.deal_group_invitation(id, event_id, is_accept)
+
+    async def deal_group_member_join_request(self, gid: int, event_id: str, is_accept: bool) -> bool:
+        return await self._proto.deal_group_member_join_request(gid, event_id, is_accept)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+JSON codec used across the framework
+
+orjson is picked if installed, otherwise ujson. Both accept str or bytes as input, so that data received from network
+can be parsed without being decoded to str at first.
+"""
+import typing
+
+try:
+    import orjson
+
+    BACKEND = 'orjson'
+
+    def loads(data: typing.Union[str, bytes, bytearray, memoryview]) -> typing.Any:
+        return orjson.loads(data)
+
+    def dumps(obj: typing.Any) -> typing.Union[str, bytes]:
+        """
+        Encode to whatever the backend produces natively, for transports accepting both str and bytes
+        """
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    def dumps_str(obj: typing.Any) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+
+except ImportError:
+    import ujson
+
+    BACKEND = 'ujson'
+
+    def loads(data: typing.Union[str, bytes, bytearray, memoryview]) -> typing.Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return ujson.loads(data)
+
+    def dumps(obj: typing.Any) -> typing.Union[str, bytes]:
+        """
+        Encode to whatever the backend produces natively, for transports accepting both str and bytes
+        """
+        return ujson.dumps(obj, ensure_ascii=False)
+
+    def dumps_str(obj: typing.Any) -> str:
+        return ujson.dumps(obj, ensure_ascii=False)
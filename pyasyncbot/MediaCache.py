@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+from loguru import logger
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import typing
+
+from . import JsonCodec
+
+Buffer = typing.Union[bytes, bytearray, memoryview]
+
+# cache of the running bot, used by media helpers without a bot context such as ImageSegment.fetch_from_url()
+_default_cache: typing.Optional[MediaCache] = None
+
+
+def get_default_cache() -> typing.Optional[MediaCache]:
+    """
+    Get the media cache of the running bot
+
+    :return: None if no bot is running or the cache is disabled
+    """
+    return _default_cache
+
+
+class MediaCache:
+    """
+    Content-addressed cache of media data
+
+    Data is stored by the sha256 of its content, in a memory LRU tier and optionally an on-disk tier, each bounded by
+    total size. URLs and backend image ids are mapped to content hashes, so the same image fetched from different urls
+    or sent many times is stored once.
+
+    Data is stored as immutable bytes, so callers are free to modify the buffers they passed in.
+    """
+    # max number of url and image id mappings kept
+    MAX_MAPPINGS = 65536
+    URL_INDEX_FILE = 'urls.json'
+
+    def __init__(self, memory_size: int = 32 * 1024 * 1024, disk_dir: str = None,
+                 disk_size: int = 512 * 1024 * 1024):
+        """
+        :param memory_size: max total bytes kept in memory. 0 disables the memory tier
+        :param disk_dir: directory of the on-disk tier. None disables it
+        :param disk_size: max total bytes kept on disk
+        """
+        self._memory_size: int = memory_size
+        self._disk_dir: str = disk_dir
+        self._disk_size: int = disk_size
+        self._memory: typing.OrderedDict[str, Buffer] = OrderedDict()
+        self._memory_used: int = 0
+        # digest -> file size, oldest first
+        self._disk: typing.OrderedDict[str, int] = OrderedDict()
+        self._disk_used: int = 0
+        # digests being written to or removed from disk
+        self._writing: typing.Set[str] = set()
+        self._urls: typing.OrderedDict[str, str] = OrderedDict()
+        self._image_ids: typing.OrderedDict[str, str] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @staticmethod
+    def digest(buffer: Buffer) -> str:
+        return hashlib.sha256(buffer).hexdigest()
+
+    def open(self):
+        """
+        Index the on-disk tier and load the url mappings saved by the last run, and become the default cache
+        """
+        global _default_cache
+        if self._disk_dir is not None:
+            os.makedirs(self._disk_dir, exist_ok=True)
+            files = []
+            for sub in os.scandir(self._disk_dir):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.is_file() and not entry.name.endswith('.tmp'):
+                        st = entry.stat()
+                        files.append((st.st_mtime, entry.name, st.st_size))
+            files.sort()
+            for _, digest, size in files:
+                self._disk[digest] = size
+                self._disk_used += size
+            self.__remove_files(self.__evict_disk())
+            try:
+                with open(os.path.join(self._disk_dir, self.URL_INDEX_FILE), 'rb') as f:
+                    for url, digest in JsonCodec.loads(f.read()):
+                        if digest in self._disk:
+                            self._urls[url] = digest
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning('failed to load media cache url index: {reason}'.format(reason=str(e)))
+            logger.info('media cache opened at {path}, with {n} files of {size} bytes'.format(
+                path=self._disk_dir, n=len(self._disk), size=self._disk_used))
+        _default_cache = self
+
+    def close(self):
+        """
+        Save the url mappings of the on-disk tier
+        """
+        global _default_cache
+        if _default_cache is self:
+            _default_cache = None
+        if self._disk_dir is None:
+            return
+        path = os.path.join(self._disk_dir, self.URL_INDEX_FILE)
+        try:
+            with open(path + '.tmp', 'wb') as f:
+                data = JsonCodec.dumps([[url, digest] for url, digest in self._urls.items() if digest in self._disk])
+                f.write(data.encode('utf-8') if isinstance(data, str) else data)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            logger.error('failed to save media cache url index: {reason}'.format(reason=str(e)))
+
+    async def get(self, digest: str) -> typing.Optional[Buffer]:
+        """
+        Look up data by content hash
+
+        :param digest: sha256 hex digest
+        :return: None if not cached
+        """
+        buffer = self._memory.get(digest)
+        if buffer is not None:
+            self._memory.move_to_end(digest)
+            self.hits += 1
+            return buffer
+        if digest in self._disk:
+            try:
+                buffer = await asyncio.get_running_loop().run_in_executor(None, self.__read_file, digest)
+            except OSError as e:
+                logger.warning('media cache file {digest} lost: {reason}'.format(digest=digest, reason=str(e)))
+                self.__drop_disk(digest)
+                buffer = None
+            if buffer is not None:
+                if digest in self._disk:
+                    self._disk.move_to_end(digest)
+                self.__put_memory(digest, buffer)
+                self.hits += 1
+                return buffer
+        self.misses += 1
+        return None
+
+    async def put(self, buffer: Buffer, digest: str = None) -> str:
+        """
+        Store data
+
+        :param buffer: media data
+        :param digest: content hash of the buffer if already known
+        :return: content hash
+        """
+        if digest is None:
+            digest = self.digest(buffer)
+        if not isinstance(buffer, bytes):
+            # entries are shared by everyone asking for the same content, don't let the caller change them
+            buffer = bytes(buffer)
+        self.__put_memory(digest, buffer)
+        if self._disk_dir is None or digest in self._writing:
+            # concurrent puts of the same data write it once
+            return digest
+        if digest not in self._disk and len(buffer) <= self._disk_size:
+            self._writing.add(digest)
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self.__write_file, digest, buffer)
+            except OSError as e:
+                logger.warning('failed to write media cache file: {reason}'.format(reason=str(e)))
+                return digest
+            finally:
+                self._writing.discard(digest)
+            self._disk[digest] = len(buffer)
+            self._disk_used += len(buffer)
+            evicted = self.__evict_disk()
+            if len(evicted) > 0:
+                # not written again until removed
+                self._writing.update(evicted)
+                try:
+                    await asyncio.get_running_loop().run_in_executor(None, self.__remove_files, evicted)
+                finally:
+                    self._writing.difference_update(evicted)
+        elif digest in self._disk:
+            self._disk.move_to_end(digest)
+        return digest
+
+    async def get_url(self, url: str) -> typing.Optional[typing.Tuple[str, Buffer]]:
+        """
+        Look up data fetched from the url before
+
+        :param url: url of the media
+        :return: (content hash, data), or None if not cached
+        """
+        digest = self._urls.get(url)
+        if digest is None:
+            self.misses += 1
+            return None
+        buffer = await self.get(digest)
+        if buffer is None:
+            del self._urls[url]
+            return None
+        self._urls.move_to_end(url)
+        return digest, buffer
+
+    async def put_url(self, url: str, buffer: Buffer) -> str:
+        """
+        Store data fetched from the url
+
+        :param url: url of the media
+        :param buffer: media data
+        :return: content hash
+        """
+        digest = await self.put(buffer)
+        self.__put_mapping(self._urls, url, digest)
+        return digest
+
+    def get_image_id(self, digest: str) -> typing.Optional[str]:
+        """
+        Get the id the backend gave to the image of the content hash, for sending it again without uploading
+
+        :param digest: content hash
+        :return: None if unknown
+        """
+        image_id = self._image_ids.get(digest)
+        if image_id is not None:
+            self._image_ids.move_to_end(digest)
+        return image_id
+
+    def set_image_id(self, digest: str, image_id: str):
+        self.__put_mapping(self._image_ids, digest, image_id)
+
+    def drop_image_id(self, digest: str):
+        """
+        Forget the backend id of the image of the content hash, e.g. after sending by the id failed
+
+        :param digest: content hash
+        """
+        self._image_ids.pop(digest, None)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """
+        Get the cache counters
+
+        :return: {'memory_used', 'memory_size', 'disk_used', 'disk_size', 'hits', 'misses'} dict
+        """
+        return {
+            'memory_used': self._memory_used,
+            'memory_size': self._memory_size,
+            'disk_used': self._disk_used,
+            'disk_size': self._disk_size if self._disk_dir is not None else 0,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def __put_mapping(self, mapping: typing.OrderedDict[str, str], key: str, value: str):
+        mapping[key] = value
+        mapping.move_to_end(key)
+        if len(mapping) > self.MAX_MAPPINGS:
+            mapping.popitem(last=False)
+
+    def __put_memory(self, digest: str, buffer: Buffer):
+        if len(buffer) > self._memory_size:
+            return
+        if digest in self._memory:
+            self._memory.move_to_end(digest)
+            return
+        self._memory[digest] = buffer
+        self._memory_used += len(buffer)
+        while self._memory_used > self._memory_size:
+            _, old = self._memory.popitem(last=False)
+            self._memory_used -= len(old)
+
+    def __path(self, digest: str) -> str:
+        return os.path.join(self._disk_dir, digest[:2], digest)
+
+    def __read_file(self, digest: str) -> bytes:
+        path = self.__path(digest)
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        # mtime orders the disk tier at the next startup
+        os.utime(path)
+        return buffer
+
+    def __write_file(self, digest: str, buffer: Buffer):
+        path = self.__path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(buffer)
+        os.replace(path + '.tmp', path)
+
+    def __drop_disk(self, digest: str):
+        size = self._disk.pop(digest, None)
+        if size is not None:
+            self._disk_used -= size
+
+    def __evict_disk(self) -> typing.List[str]:
+        """
+        Drop the oldest files from the disk tier until it fits
+
+        :return: digests of the dropped files, to be removed by __remove_files()
+        """
+        evicted = []
+        while self._disk_used > self._disk_size and len(self._disk) > 0:
+            digest, size = self._disk.popitem(last=False)
+            self._disk_used -= size
+            evicted.append(digest)
+        return evicted
+
+    def __remove_files(self, digests: typing.List[str]):
+        for digest in digests:
+            try:
+                os.remove(self.__path(digest))
+            except OSError:
+                pass
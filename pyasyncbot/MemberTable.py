@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .Contacts import GroupMember
+
+from array import array
+from bisect import bisect_left
+import sys
+import typing
+
+
+class MemberTable:
+    """
+    Array-backed member storage of a group
+
+    Holds a sorted uid array and the aligned nicknames, which are interned so that the same nickname seen in many groups
+    is stored once. GroupMember objects are only created on demand as views, and are not kept by the table.
+
+    Supports the mapping operations used on the dict based member storage, where values are GroupMember views
+    """
+    __slots__ = ('_make_member', '_uids', '_nicks')
+
+    def __init__(self, make_member: typing.Callable[[int, str], GroupMember],
+                 members: typing.Dict[int, str] = None):
+        """
+        :param make_member: create a GroupMember view from uid and nickname
+        :param members: initial {id, nickname} dict
+        """
+        self._make_member = make_member
+        self._uids: array = array('q')
+        self._nicks: typing.List[str] = []
+        if members is not None:
+            for uid in sorted(members):
+                self._uids.append(uid)
+                self._nicks.append(sys.intern(members[uid]))
+
+    def _index(self, uid: int) -> int:
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid:
+            return i
+        return -1
+
+    def __len__(self) -> int:
+        return len(self._uids)
+
+    def __contains__(self, uid: int) -> bool:
+        return self._index(uid) >= 0
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self._uids)
+
+    def __getitem__(self, uid: int) -> GroupMember:
+        i = self._index(uid)
+        if i < 0:
+            raise KeyError(uid)
+        return self._make_member(uid, self._nicks[i])
+
+    def __setitem__(self, uid: int, member: GroupMember):
+        self.set_nick(uid, member.get_name())
+
+    def __delitem__(self, uid: int):
+        i = self._index(uid)
+        if i < 0:
+            raise KeyError(uid)
+        del self._uids[i]
+        del self._nicks[i]
+
+    def get_nick(self, uid: int) -> typing.Union[str, None]:
+        """
+        Get the nickname of a member without creating the view
+
+        :param uid: user id
+        :return: nickname, or None if not a member
+        """
+        i = self._index(uid)
+        if i < 0:
+            return None
+        return self._nicks[i]
+
+    def set_nick(self, uid: int, nick: str):
+        """
+        Update the nickname of a member, or add the member if not exist
+
+        :param uid: user id
+        :param nick: nickname
+        """
+        nick = sys.intern(nick)
+        i = bisect_left(self._uids, uid)
+        if i < len(self._uids) and self._uids[i] == uid:
+            self._nicks[i] = nick
+        else:
+            self._uids.insert(i, uid)
+            self._nicks.insert(i, nick)
+
+    def entries(self) -> typing.Iterator[typing.Tuple[int, str]]:
+        """
+        Iterate over (uid, nickname) pairs without creating any view
+
+        :return: iterator of pairs
+        """
+        return zip(self._uids, self._nicks)
+
+    def items(self) -> typing.Iterator[typing.Tuple[int, GroupMember]]:
+        for uid, nick in zip(self._uids, self._nicks):
+            yield uid, self._make_member(uid, nick)
+
+    def to_dict(self) -> typing.Dict[int, GroupMember]:
+        """
+        Materialize all members as views
+
+        :return: {uid, GroupMember} dict
+        """
+        return {uid: self._make_member(uid, nick) for uid, nick in zip(self._uids, self._nicks)}
@@ -7,10 +7,11 @@ if TYPE_CHECKING:
     from .MsgContent import *
 
 import datetime
-from typing import Union
-import ast
+from typing import Union, Dict, Any
 import dataclasses
 
+from .JsonCodec import dumps_str
+
 
 @dataclasses.dataclass
 class PrivateMessageContext:
@@ -87,6 +88,16 @@ class RepliedMessage:
             return str(None)
         return str(self._content)
 
+    def to_dict(self) -> Union[Dict[str, Any], None]:
+        """
+        Get a structured representation of the reply reference
+
+        :return: dict of plain values, or None if empty
+        """
+        if self._content is None:
+            return None
+        return self._content.to_dict()
+
     def get_msgid(self):
         """
         Advanced: Get the message id of the message being replied
@@ -105,75 +116,9 @@ class RepliedMessage:
 
         :return: content or None
         """
-        ctx = await self._ctx._contacts._proto_wrapper.query_msg_by_id(self._ctx._channel.get_type(), self._ctx._channel.get_id(), self._content.to_msgid)
-        if isinstance(ctx, PrivateMessageContext):
-            msg: ReceivedMessage = ReceivedPrivateMessage(self._ctx._contacts)
-            msg._time = ctx.time
-            msg._msgID = ctx.msgid
-            msg._msgContent = ctx.msgcontent
-            msg._summary = ctx.summary
-            if ctx.reply is not None:
-                msg._reply = RepliedMessage(ctx.reply, msg)
-            # things may change and ctx.is_friend is useless now. must re-analyse the contacts
-
-            # try to find the channel in your friend list
-            msg._channel = await self._ctx._contacts.get_friend(ctx.channel_id)
-            if msg._channel is None:
-                # he is not your friend now
-                if ctx.from_channel is not None:
-                    # he wasn't your friend before, either
-                    # so he reached you from a group
-                    msg._ref_channel = await self._ctx._contacts.get_group(ctx.from_channel)
-                    if msg._ref_channel is None:
-                        # but you left that group
-                        pass
-                    else:
-                        # try to get touch with him by the group as group member
-                        he_as_group_member =  await msg._ref_channel.get_member(ctx.channel_id, ctx.channel_nick)
-                        if he_as_group_member is None:
-                            # but he left that group
-                            pass
-                        else:
-                            # he is in the group, a stranger channel is set up
-                            msg._channel = await he_as_group_member.open_private_channel()
-                else:
-                    # he was your friend
-                    pass
-            # deal with sender
-            if await (self._ctx._contacts.get_myself()).get_id() == ctx.sender_id:
-                msg._sender = await (self._ctx._contacts.get_myself())
-            else:
-                msg._sender = await self._ctx._contacts.get_friend(ctx.sender_id)
-                if msg._sender is None:
-                    msg._sender = User(ctx.sender_id, ctx.sender_nick)
-            return msg
-        elif isinstance(ctx, GroupMessageContext):
-            msg: ReceivedMessage = ReceivedGroupMessage(self._ctx._contacts)
-            msg._time = ctx.time
-            msg._msgID = ctx.msgid
-            msg._msgContent = ctx.msgcontent
-            msg._summary = ctx.summary
-            if ctx.reply is not None:
-                msg._reply = RepliedMessage(ctx.reply, msg)
-            if ctx.is_anonymous:
-                msg._channel = await self._ctx._contacts.get_group(ctx.group_id)
-                if msg._channel is None:
-                    # Seems you've left the group
-                    msg._sender = User(ctx.sender_id, ctx.sender_nick)
-                else:
-                    msg._sender = GroupAnonymousMember(self._ctx._contacts, ctx.sender_id, '',
-                                                   ctx.group_id)  # TODO: temporarily use empty nick
-            else:
-                msg._channel = await self._ctx._contacts.get_group(ctx.group_id, ctx.group_name)
-                if msg._channel is None:
-                    # Seems you've left the group
-                    msg._sender = User(ctx.sender_id, ctx.sender_nick)
-                else:
-                    msg._sender = await msg._channel.get_member(ctx.sender_id, ctx.sender_nick)
-                    if msg._sender is None:
-                        # Seems he had left the group
-                        msg._sender = User(ctx.sender_id, ctx.sender_nick)
-            return msg
+        channel = self._ctx.get_channel()
+        ctx = await self._ctx._contacts._proto_wrapper.query_msg_by_id(channel.get_type(), channel.get_id(), self._content.to_msgid)
+        return await _message_from_context(self._ctx._contacts, ctx)
 
     async def get_sender(self) -> Union[Friend, GroupMember, Stranger, GroupAnonymousMember]:
         """
@@ -187,6 +132,9 @@ class RepliedMessage:
 class ReceivedMessage:
     """
     Received message
+
+    Channel and sender are resolved against contacts on first access, so that messages nobody looks into cost no
+    contact lookup at all
     """
 
     def __init__(self, contacts):
@@ -194,20 +142,62 @@ class ReceivedMessage:
         self._time: datetime.datetime = None
         self._channel: Union[Friend, Stranger, Group] = None
         self._sender: Union[Friend, Stranger, GroupMember, GroupAnonymousMember] = None
+        self._sender_id: int = None
+        # raw context to resolve channel and sender from, dropped once resolved
+        self._ctx: Union[PrivateMessageContext, GroupMessageContext] = None
         self._msgID: str = None
         self._msgContent: MessageContent = None
         self._reply: RepliedMessage = None
         self._summary: str = None
+        # built on first use, received messages are not modified after delivery
+        self._dict: Dict[str, Any] = None
+        self._json: str = None
 
     def __str__(self):
-        return str({
+        return self.to_json()
+
+    def _ensure_resolved(self):
+        if self._ctx is not None:
+            ctx = self._ctx
+            self._ctx = None
+            self._resolve(ctx)
+
+    def _resolve(self, ctx: Union[PrivateMessageContext, GroupMessageContext]):
+        """
+        Fill channel and sender from the raw context, without fetching anything
+        """
+        pass
+
+    def _build_dict(self) -> Dict[str, Any]:
+        self._ensure_resolved()
+        return {
             'time': str(self._time),
-            'sender': str(self._sender),
-            'channel': str(self._channel),
+            'sender': _to_dict_or_none(self._sender),
+            'channel': _to_dict_or_none(self._channel),
             'msgID': self._msgID,
             'msgContent': str(self._msgContent),
-            'reply_to': str(self._reply),
-        })
+            'reply_to': _to_dict_or_none(self._reply),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get a structured representation of the message. Built once and cached, do not modify it
+
+        :return: dict of plain values
+        """
+        if self._dict is None:
+            self._dict = self._build_dict()
+        return self._dict
+
+    def to_json(self) -> str:
+        """
+        Get the JSON representation of the message. Built once and cached
+
+        :return: JSON string
+        """
+        if self._json is None:
+            self._json = dumps_str(self.to_dict())
+        return self._json
 
     def get_content(self) -> MessageContent:
         """
@@ -225,6 +215,14 @@ class ReceivedMessage:
         """
         return self._msgID
 
+    def get_sender_id(self) -> int:
+        """
+        Get the user id of the sender, without resolving the sender object
+
+        :return: user id
+        """
+        return self._sender_id
+
     def get_replied(self) -> Union[RepliedMessage, None]:
         """
         Get the replied message obj. None if not exist
@@ -240,6 +238,7 @@ class ReceivedMessage:
         :param content: message content
         :return: sent msg obj or None if failed
         """
+        self._ensure_resolved()
         return await self._channel.send_msg(content)
 
     async def quoted_reply(self, content: MessageContent) -> SentMessage:
@@ -249,9 +248,10 @@ class ReceivedMessage:
         :param content: message content
         :return: msgID of reply msg or None if failed
         """
+        self._ensure_resolved()
         reply_content = RepliedMessageContext(
             to_msgid=self._msgID,
-            to_uid=self._sender.get_id(),
+            to_uid=self._sender_id,
             text=self._summary,
             time=self._time
         )
@@ -263,10 +263,31 @@ class ReceivedPrivateMessage(ReceivedMessage):
         super().__init__(contacts)
         self._ref_channel: Group = None
 
-    def __str__(self):
-        dictionary = ast.literal_eval(super().__str__())
-        dictionary['ref_channel'] = str(self._ref_channel)
-        return str(dictionary)
+    def _resolve(self, ctx: PrivateMessageContext):
+        if ctx.is_friend:
+            self._channel = self._contacts._peek_friend(ctx.channel_id, ctx.channel_nick)
+            self._sender = self._contacts._peek_friend(ctx.sender_id, ctx.sender_nick)
+        else:
+            self._ref_channel = self._contacts._peek_group(ctx.from_channel, ctx.from_channel_name)
+            self._channel = self.__open_stranger_channel(ctx.channel_id, ctx.channel_nick)
+            self._sender = self.__open_stranger_channel(ctx.sender_id, ctx.sender_nick)
+
+    def __open_stranger_channel(self, uid: int, nick: str) -> Union[Friend, Stranger]:
+        # the private channel of a member of the referring group, who may have become a friend in the meantime
+        from .Contacts import Stranger
+        gid = None
+        if self._ref_channel is not None:
+            self._ref_channel._peek_member(uid, nick)
+            gid = self._ref_channel.get_id()
+        friend = self._contacts._peek_friend(uid)
+        if friend is not None:
+            return friend
+        return Stranger(self._contacts, uid, nick, gid)
+
+    def _build_dict(self) -> Dict[str, Any]:
+        ret = super()._build_dict()
+        ret['ref_channel'] = _to_dict_or_none(self._ref_channel)
+        return ret
 
     def get_ref_channel(self) -> Union[Group, None]:
         """
@@ -274,6 +295,7 @@ class ReceivedPrivateMessage(ReceivedMessage):
 
         :return: Group or None
         """
+        self._ensure_resolved()
         return self._ref_channel
 
     def get_channel(self) -> Union[Friend, Stranger]:
@@ -282,6 +304,7 @@ class ReceivedPrivateMessage(ReceivedMessage):
 
         :return: channel obj
         """
+        self._ensure_resolved()
         return self._channel
 
     def get_sender(self) -> Union[Friend, Stranger, User]:
@@ -290,16 +313,28 @@ class ReceivedPrivateMessage(ReceivedMessage):
 
         :return: sender object
         """
+        self._ensure_resolved()
         return self._sender
     
 
 class ReceivedGroupMessage(ReceivedMessage):
+    def _resolve(self, ctx: GroupMessageContext):
+        # imported here as Contacts depends on this module
+        from .Contacts import GroupAnonymousMember
+        self._channel = self._contacts._peek_group(ctx.group_id, ctx.group_name)
+        if ctx.is_anonymous:
+            self._sender = GroupAnonymousMember(self._contacts, ctx.sender_id, '',
+                                                ctx.group_id)  # TODO: temporarily use empty nick
+        elif self._channel is not None:
+            self._sender = self._channel._peek_member(ctx.sender_id, ctx.sender_nick)
+
     def get_channel(self) -> Union[Group, None]:
         """
         Get the group this message comes from
 
         :return: channel obj
         """
+        self._ensure_resolved()
         return self._channel
 
     def get_sender(self) -> Union[GroupMember, GroupAnonymousMember, User, None]:
@@ -308,6 +343,7 @@ class ReceivedGroupMessage(ReceivedMessage):
 
         :return: sender object
         """
+        self._ensure_resolved()
         return self._sender
 
 
@@ -322,6 +358,28 @@ class SentMessage:
         self._msgid = None
         self._channel = None
 
+    def __str__(self):
+        return self.to_json()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get a structured representation of the message
+
+        :return: dict of plain values
+        """
+        return {
+            'msgid': self._msgid,
+            'channel': _to_dict_or_none(self._channel),
+        }
+
+    def to_json(self) -> str:
+        """
+        Get the JSON representation of the message
+
+        :return: JSON string
+        """
+        return dumps_str(self.to_dict())
+
     async def revoke(self) -> bool:
         return await self._channel.revoke_msg(self._msgid)
 
@@ -331,19 +389,46 @@ class RevokedMessage:
     Revoked Message
     """
 
-    def __init(self):
+    def __init__(self, contacts):
+        self._contacts = contacts
         self._time: datetime.datetime = None
         self._msgid: str = None
         self._channel: Channel = None
+        # where the revoked message can be looked up, as ProtocolWrapper.query_msg_by_id() takes
+        self._msg_channel_type: Channel.ChannelType = None
+        self._msg_channel_id: int = None
         self._revoker: Union[Friend, Stranger, GroupMember, GroupAnonymousMember] = None
+        # built on first use, revoke events are not modified after delivery
+        self._dict: Dict[str, Any] = None
+        self._json: str = None
 
     def __str__(self):
-        return str({
-            'time': str(self._time),
-            'channel': str(self._channel),
-            'revoker': str(self._revoker),
-            'msgid': self._msgid,
-        })
+        return self.to_json()
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Get a structured representation of the revoke event. Built once and cached, do not modify it
+
+        :return: dict of plain values
+        """
+        if self._dict is None:
+            self._dict = {
+                'time': str(self._time),
+                'channel': _to_dict_or_none(self._channel),
+                'revoker': _to_dict_or_none(self._revoker),
+                'msgid': self._msgid,
+            }
+        return self._dict
+
+    def to_json(self) -> str:
+        """
+        Get the JSON representation of the revoke event. Built once and cached
+
+        :return: JSON string
+        """
+        if self._json is None:
+            self._json = dumps_str(self.to_dict())
+        return self._json
 
     def get_channel(self) -> Channel:
         """
@@ -369,7 +454,9 @@ class RevokedMessage:
 
         :return: message object, None if failed to get
         """
-        pass
+        ctx = await self._contacts._proto_wrapper.query_msg_by_id(self._msg_channel_type, self._msg_channel_id,
+                                                                  self._msgid)
+        return await _message_from_context(self._contacts, ctx)
 
 
 @dataclasses.dataclass
@@ -380,9 +467,104 @@ class RepliedMessageContext:
     to_msgid: str
 
     def __str__(self):
-        return str({
+        return dumps_str(self.to_dict())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
             'to': self.to_uid,
             'msgid': self.to_msgid,
             'time': str(self.time),
             'text': self.text
-        })
+        }
+
+
+def _to_dict_or_none(obj) -> Union[Dict[str, Any], None]:
+    if obj is None:
+        return None
+    return obj.to_dict()
+
+
+async def _message_from_context(contacts: Contacts, ctx: Union[PrivateMessageContext, GroupMessageContext, None]) \
+        -> Union[ReceivedMessage, None]:
+    """
+    Build a received message from a queried or cached message context, resolving channel and sender against current
+    contacts
+
+    :param contacts: contacts
+    :param ctx: message context
+    :return: message object, None if ctx is None
+    """
+    # imported here as Contacts depends on this module
+    from .Contacts import User, GroupAnonymousMember
+    if isinstance(ctx, PrivateMessageContext):
+        msg: ReceivedMessage = ReceivedPrivateMessage(contacts)
+        msg._time = ctx.time
+        msg._sender_id = ctx.sender_id
+        msg._msgID = ctx.msgid
+        msg._msgContent = ctx.msgcontent
+        msg._summary = ctx.summary
+        if ctx.reply is not None:
+            msg._reply = RepliedMessage(ctx.reply, msg)
+        # things may change and ctx.is_friend is useless now. must re-analyse the contacts
+
+        # try to find the channel in your friend list
+        msg._channel = await contacts.get_friend(ctx.channel_id)
+        if msg._channel is None:
+            # he is not your friend now
+            if ctx.from_channel is not None:
+                # he wasn't your friend before, either
+                # so he reached you from a group
+                msg._ref_channel = await contacts.get_group(ctx.from_channel)
+                if msg._ref_channel is None:
+                    # but you left that group
+                    pass
+                else:
+                    # try to get touch with him by the group as group member
+                    he_as_group_member =  await msg._ref_channel.get_member(ctx.channel_id, ctx.channel_nick)
+                    if he_as_group_member is None:
+                        # but he left that group
+                        pass
+                    else:
+                        # he is in the group, a stranger channel is set up
+                        msg._channel = await he_as_group_member.open_private_channel()
+            else:
+                # he was your friend
+                pass
+        # deal with sender
+        me = await contacts.get_myself()
+        if me is not None and me.get_id() == ctx.sender_id:
+            msg._sender = me
+        else:
+            msg._sender = await contacts.get_friend(ctx.sender_id)
+            if msg._sender is None:
+                msg._sender = User(ctx.sender_id, ctx.sender_nick)
+        return msg
+    elif isinstance(ctx, GroupMessageContext):
+        msg: ReceivedMessage = ReceivedGroupMessage(contacts)
+        msg._time = ctx.time
+        msg._sender_id = ctx.sender_id
+        msg._msgID = ctx.msgid
+        msg._msgContent = ctx.msgcontent
+        msg._summary = ctx.summary
+        if ctx.reply is not None:
+            msg._reply = RepliedMessage(ctx.reply, msg)
+        if ctx.is_anonymous:
+            msg._channel = await contacts.get_group(ctx.group_id)
+            if msg._channel is None:
+                # Seems you've left the group
+                msg._sender = User(ctx.sender_id, ctx.sender_nick)
+            else:
+                msg._sender = GroupAnonymousMember(contacts, ctx.sender_id, '',
+                                                   ctx.group_id)  # TODO: temporarily use empty nick
+        else:
+            msg._channel = await contacts.get_group(ctx.group_id, ctx.group_name)
+            if msg._channel is None:
+                # Seems you've left the group
+                msg._sender = User(ctx.sender_id, ctx.sender_nick)
+            else:
+                msg._sender = await msg._channel.get_member(ctx.sender_id, ctx.sender_nick)
+                if msg._sender is None:
+                    # Seems he had left the group
+                    msg._sender = User(ctx.sender_id, ctx.sender_nick)
+        return msg
+    return None
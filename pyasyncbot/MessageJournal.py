@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+from loguru import logger
+from array import array
+from bisect import bisect_left, bisect_right
+import asyncio
+import datetime
+import functools
+import mmap
+import os
+import typing
+
+from . import JsonCodec
+from .Contacts import Channel
+from .Message import PrivateMessageContext, GroupMessageContext, RepliedMessageContext
+from .MsgContent import MessageContent
+
+MessageContext = typing.Union[PrivateMessageContext, GroupMessageContext]
+
+
+class _ChannelIndex:
+    """
+    Messages of one channel ordered by time, as aligned arrays of time and record location
+    """
+    __slots__ = ('times', 'seqs', 'offsets', 'lengths')
+
+    def __init__(self):
+        self.times: array = array('d')
+        self.seqs: array = array('l')
+        self.offsets: array = array('q')
+        self.lengths: array = array('l')
+
+    def add(self, t: float, seq: int, offset: int, length: int):
+        if len(self.times) == 0 or t >= self.times[-1]:
+            i = len(self.times)
+        else:
+            # out-of-order arrival, rare
+            i = bisect_right(self.times, t)
+        self.times.insert(i, t)
+        self.seqs.insert(i, seq)
+        self.offsets.insert(i, offset)
+        self.lengths.insert(i, length)
+
+    def drop_segment(self, seq: int):
+        keep = [i for i in range(len(self.seqs)) if self.seqs[i] != seq]
+        self.times = array('d', (self.times[i] for i in keep))
+        self.seqs = array('l', (self.seqs[i] for i in keep))
+        self.offsets = array('q', (self.offsets[i] for i in keep))
+        self.lengths = array('l', (self.lengths[i] for i in keep))
+
+
+class MessageJournal:
+    """
+    Append-only on-disk journal of delivered messages
+
+    Messages are appended as JSON lines to segment files named by sequence number. A segment is sealed once it grows
+    over the size limit, and a sidecar index file is written next to it so that it can be indexed at startup without
+    being parsed. Sealed segments are read through mmap, so that nothing but the indexes is kept in memory.
+
+    Sealing and deleting old segments are file work done in the default executor, in order, so that appending never
+    blocks the event loop for more than the write of the record itself.
+
+    Two indexes are kept: msgid to record location, and per channel time to record location.
+    """
+    SEGMENT_SUFFIX = '.jsonl'
+    INDEX_SUFFIX = '.idx'
+    INDEX_VERSION = 1
+
+    def __init__(self, path: str, segment_size: int = 64 * 1024 * 1024, max_segments: int = None):
+        """
+        :param path: directory of segment files, created if not exist
+        :param segment_size: seal the active segment once it is larger than this, in bytes
+        :param max_segments: delete the oldest segments beyond this count. None means keeping all
+        """
+        self._path: str = path
+        self._segment_size: int = segment_size
+        self._max_segments: int = max_segments
+        # (channel type, channel id, msgid) -> (segment seq, offset, length)
+        self._ids: typing.Dict[typing.Tuple[Channel.ChannelType, int, str], typing.Tuple[int, int, int]] = dict()
+        self._channels: typing.Dict[typing.Tuple[Channel.ChannelType, int], _ChannelIndex] = dict()
+        # sealed segments: seq -> records as [kind, channel id, msgid, time, offset, length]
+        self._sealed: typing.Dict[int, typing.List[list]] = dict()
+        self._maps: typing.Dict[int, mmap.mmap] = dict()
+        self._active_seq: int = None
+        self._active_file: typing.BinaryIO = None
+        self._active_size: int = 0
+        self._active_records: typing.List[list] = []
+        self._dirty: bool = False
+        # file work waiting to be done in background, in order
+        self._jobs: typing.List[typing.Callable[[], None]] = []
+        self._worker: asyncio.Task = None
+
+    def open(self):
+        """
+        Load indexes of existing segments and start a new active segment
+
+        Segments left unsealed by the last run are indexed by scanning, and sealed
+        """
+        os.makedirs(self._path, exist_ok=True)
+        seqs = sorted(int(name[:-len(self.SEGMENT_SUFFIX)]) for name in os.listdir(self._path)
+                      if name.endswith(self.SEGMENT_SUFFIX) and name[:-len(self.SEGMENT_SUFFIX)].isdigit())
+        for seq in seqs:
+            records = self.__load_index(seq)
+            if records is None:
+                records = self.__scan_segment(seq)
+                self.__write_index(seq, records)
+            self._sealed[seq] = records
+            for record in records:
+                self.__index_record(seq, record)
+        self.__drop_old_segments()
+        self.__start_segment(seqs[-1] + 1 if len(seqs) > 0 else 0)
+        logger.info('message journal opened at {path}, with {n} messages in {s} segments'.format(
+            path=self._path, n=len(self._ids), s=len(self._sealed)))
+
+    async def close(self):
+        """
+        Wait for background work, seal the active segment and release files
+        """
+        if self._worker is not None:
+            await self._worker
+        for job in self._jobs:
+            job()
+        self._jobs.clear()
+        if self._active_file is not None:
+            self.__seal_active()()
+            self._active_file = None
+        for mm in self._maps.values():
+            mm.close()
+        self._maps.clear()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def append(self, ctx: MessageContext):
+        """
+        Write a delivered message to the journal
+
+        :param ctx: message context
+        """
+        if isinstance(ctx, GroupMessageContext):
+            channel_type = Channel.ChannelType.MultiUser
+            channel_id = ctx.group_id
+        else:
+            channel_type = Channel.ChannelType.P2P
+            channel_id = ctx.channel_id
+        if (channel_type, channel_id, ctx.msgid) in self._ids:
+            return
+        data = JsonCodec.dumps(_encode_context(ctx))
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data += b'\n'
+        offset = self._active_size
+        self._active_file.write(data)
+        self._active_size += len(data)
+        self._dirty = True
+        record = [channel_type.value, channel_id, ctx.msgid, ctx.time.timestamp(), offset, len(data)]
+        self._active_records.append(record)
+        self.__index_record(self._active_seq, record)
+        if self._active_size >= self._segment_size:
+            seq = self._active_seq
+            self._jobs.append(self.__seal_active())
+            self.__drop_old_segments(in_background=True)
+            self.__start_segment(seq + 1)
+            self.__kick()
+
+    def get(self, channel_type: Channel.ChannelType, channel_id: int, msgid: str) -> typing.Union[MessageContext, None]:
+        """
+        Look up a message by id
+
+        :param channel_type: type of channel
+        :param channel_id: where the message belongs to
+        :param msgid: msg ID
+        :return: message context, or None if not in the journal
+        """
+        loc = self._ids.get((channel_type, channel_id, msgid))
+        if loc is None:
+            return None
+        return self.__read(*loc)
+
+    def scan(self, channel_type: Channel.ChannelType, channel_id: int, since: datetime.datetime = None,
+             until: datetime.datetime = None, limit: int = None, newest_first: bool = False) \
+            -> typing.Iterator[MessageContext]:
+        """
+        Iterate over messages of a channel within a time range
+
+        Records are read lazily while iterating
+
+        :param channel_type: type of channel
+        :param channel_id: channel id
+        :param since: inclusive lower bound of message time. None means unbounded
+        :param until: inclusive upper bound of message time. None means unbounded
+        :param limit: max number of messages. None means unlimited
+        :param newest_first: iterate from the newest one
+        :return: iterator of message contexts
+        """
+        index = self._channels.get((channel_type, channel_id))
+        if index is None:
+            return
+        lo = 0 if since is None else bisect_left(index.times, since.timestamp())
+        hi = len(index.times) if until is None else bisect_right(index.times, until.timestamp())
+        positions = range(hi - 1, lo - 1, -1) if newest_first else range(lo, hi)
+        if limit is not None:
+            positions = positions[:limit]
+        # dropping a segment replaces the arrays, keep iterating over the current ones
+        seqs, offsets, lengths = index.seqs, index.offsets, index.lengths
+        for i in positions:
+            if seqs[i] != self._active_seq and seqs[i] not in self._sealed:
+                # segment dropped while iterating
+                continue
+            yield self.__read(seqs[i], offsets[i], lengths[i])
+
+    def __index_record(self, seq: int, record: list):
+        kind, channel_id, msgid, t, offset, length = record
+        channel_type = Channel.ChannelType(kind)
+        self._ids[(channel_type, channel_id, msgid)] = (seq, offset, length)
+        index = self._channels.get((channel_type, channel_id))
+        if index is None:
+            index = self._channels[(channel_type, channel_id)] = _ChannelIndex()
+        index.add(t, seq, offset, length)
+
+    def __read(self, seq: int, offset: int, length: int) -> MessageContext:
+        if seq == self._active_seq:
+            if self._dirty:
+                self._active_file.flush()
+                self._dirty = False
+            data = os.pread(self._active_file.fileno(), length, offset)
+        else:
+            mm = self._maps.get(seq)
+            if mm is None:
+                with open(self.__segment_path(seq), 'rb') as f:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[seq] = mm
+            data = mm[offset:offset + length]
+        return _decode_context(JsonCodec.loads(data))
+
+    def __segment_path(self, seq: int) -> str:
+        return os.path.join(self._path, '{seq:08d}{suffix}'.format(seq=seq, suffix=self.SEGMENT_SUFFIX))
+
+    def __index_path(self, seq: int) -> str:
+        return os.path.join(self._path, '{seq:08d}{suffix}'.format(seq=seq, suffix=self.INDEX_SUFFIX))
+
+    def __start_segment(self, seq: int):
+        self._active_seq = seq
+        self._active_file = open(self.__segment_path(seq), 'a+b')
+        self._active_size = self._active_file.tell()
+        self._active_records = []
+        self._dirty = False
+
+    def __seal_active(self) -> typing.Callable[[], None]:
+        """
+        Stop appending to the active segment. Its records are readable through mmap right away
+
+        :return: the file work left, closing the segment and writing its index
+        """
+        self._active_file.flush()
+        seq = self._active_seq
+        records = self._active_records if len(self._active_records) > 0 else None
+        if records is not None:
+            self._sealed[seq] = records
+        self._active_seq = None
+        self._active_records = []
+        return functools.partial(self.__finish_seal, self._active_file, seq, records)
+
+    def __finish_seal(self, file: typing.BinaryIO, seq: int, records: typing.Union[typing.List[list], None]):
+        file.close()
+        if records is None:
+            os.remove(self.__segment_path(seq))
+        else:
+            self.__write_index(seq, records)
+
+    def __kick(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self.__maintain(), name='message_journal')
+
+    async def __maintain(self):
+        loop = asyncio.get_running_loop()
+        while len(self._jobs) > 0:
+            try:
+                await loop.run_in_executor(None, self._jobs[0])
+            except Exception as e:
+                logger.error('message journal maintenance failed: {reason}'.format(reason=str(e)))
+            self._jobs.pop(0)
+
+    def __drop_old_segments(self, in_background: bool = False):
+        if self._max_segments is None:
+            return
+        while len(self._sealed) > self._max_segments:
+            seq = min(self._sealed)
+            for kind, channel_id, msgid, _, _, _ in self._sealed.pop(seq):
+                channel_type = Channel.ChannelType(kind)
+                loc = self._ids.get((channel_type, channel_id, msgid))
+                if loc is not None and loc[0] == seq:
+                    del self._ids[(channel_type, channel_id, msgid)]
+            for key in list(self._channels):
+                index = self._channels[key]
+                index.drop_segment(seq)
+                if len(index.times) == 0:
+                    del self._channels[key]
+            mm = self._maps.pop(seq, None)
+            if mm is not None:
+                mm.close()
+            if in_background:
+                self._jobs.append(functools.partial(self.__remove_segment_files, seq))
+            else:
+                self.__remove_segment_files(seq)
+            logger.debug('message journal segment {seq} dropped'.format(seq=seq))
+
+    def __remove_segment_files(self, seq: int):
+        for path in (self.__segment_path(seq), self.__index_path(seq)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __write_index(self, seq: int, records: typing.List[list]):
+        data = JsonCodec.dumps({'version': self.INDEX_VERSION, 'records': records})
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        tmp_path = self.__index_path(seq) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, self.__index_path(seq))
+
+    def __load_index(self, seq: int) -> typing.Union[typing.List[list], None]:
+        try:
+            with open(self.__index_path(seq), 'rb') as f:
+                index = JsonCodec.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning('broken message journal index {seq}: {reason}'.format(seq=seq, reason=str(e)))
+            return None
+        if index.get('version') != self.INDEX_VERSION:
+            return None
+        return index['records']
+
+    def __scan_segment(self, seq: int) -> typing.List[list]:
+        records = []
+        path = self.__segment_path(seq)
+        size = os.path.getsize(path)
+        if size == 0:
+            return records
+        with open(path, 'r+b') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                offset = 0
+                while offset < size:
+                    end = mm.find(b'\n', offset)
+                    if end < 0:
+                        break
+                    try:
+                        obj = JsonCodec.loads(mm[offset:end])
+                        records.append([obj['k'], obj['c'], obj['m'], obj['t'], offset, end + 1 - offset])
+                    except Exception as e:
+                        logger.warning('skip broken record at {off} of journal segment {seq}: {reason}'.format(
+                            off=offset, seq=seq, reason=str(e)))
+                    offset = end + 1
+            if offset < size:
+                # partially written record of a crashed run
+                logger.warning('truncate incomplete tail of journal segment {seq}'.format(seq=seq))
+                f.truncate(offset)
+        return records
+
+
+def _encode_context(ctx: MessageContext) -> dict:
+    ret = {
+        't': ctx.time.timestamp(),
+        'm': ctx.msgid,
+        's': ctx.sender_id,
+        'sn': ctx.sender_nick,
+        'sum': ctx.summary,
+        'body': ctx.msgcontent._gen_json_list(),
+    }
+    if isinstance(ctx, GroupMessageContext):
+        ret['k'] = Channel.ChannelType.MultiUser.value
+        ret['c'] = ctx.group_id
+        ret['cn'] = ctx.group_name
+        ret['anon'] = ctx.is_anonymous
+    else:
+        ret['k'] = Channel.ChannelType.P2P.value
+        ret['c'] = ctx.channel_id
+        ret['cn'] = ctx.channel_nick
+        ret['friend'] = ctx.is_friend
+        if not ctx.is_friend:
+            ret['from'] = ctx.from_channel
+            ret['fromName'] = ctx.from_channel_name
+    if ctx.reply is not None:
+        ret['reply'] = {
+            'to': ctx.reply.to_uid,
+            'time': ctx.reply.time.timestamp(),
+            'text': ctx.reply.text,
+            'msgid': ctx.reply.to_msgid,
+        }
+    return ret
+
+
+def _decode_context(obj: dict) -> MessageContext:
+    reply = None
+    if 'reply' in obj:
+        reply = RepliedMessageContext(
+            to_uid=obj['reply']['to'],
+            time=datetime.datetime.fromtimestamp(obj['reply']['time']),
+            text=obj['reply']['text'],
+            to_msgid=obj['reply']['msgid']
+        )
+    if obj['k'] == Channel.ChannelType.MultiUser.value:
+        return GroupMessageContext(
+            time=datetime.datetime.fromtimestamp(obj['t']),
+            sender_id=obj['s'],
+            sender_nick=obj['sn'],
+            group_id=obj['c'],
+            group_name=obj['cn'],
+            msgid=obj['m'],
+            msgcontent=MessageContent._parse_from_list(obj['body']),
+            summary=obj['sum'],
+            is_anonymous=obj['anon'],
+            reply=reply
+        )
+    return PrivateMessageContext(
+        time=datetime.datetime.fromtimestamp(obj['t']),
+        sender_id=obj['s'],
+        sender_nick=obj['sn'],
+        channel_id=obj['c'],
+        channel_nick=obj['cn'],
+        msgid=obj['m'],
+        msgcontent=MessageContent._parse_from_list(obj['body']),
+        summary=obj['sum'],
+        is_friend=obj['friend'],
+        from_channel=obj.get('from'),
+        from_channel_name=obj.get('fromName'),
+        reply=reply
+    )
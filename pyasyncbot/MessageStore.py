@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from .Contacts import Channel
+    from .Message import PrivateMessageContext, GroupMessageContext
+
+from collections import OrderedDict
+import typing
+
+MessageKey = typing.Tuple['Channel.ChannelType', int, str]
+
+
+class MessageCache:
+    """
+    Bounded LRU cache of recently delivered message contexts
+
+    Keyed by (channel type, channel id, msgid), the same arguments ProtocolWrapper.query_msg_by_id() takes. Cached
+    contexts are shared and should be treated as read-only.
+    """
+    __slots__ = ('_capacity', '_entries', 'hits', 'misses')
+
+    def __init__(self, capacity: int = 4096):
+        """
+        :param capacity: max number of messages kept. 0 disables the cache
+        """
+        self._capacity: int = capacity
+        self._entries: typing.OrderedDict[MessageKey, typing.Union[PrivateMessageContext, GroupMessageContext]] = \
+            OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: MessageKey) -> typing.Union[PrivateMessageContext, GroupMessageContext, None]:
+        """
+        Look up a message and mark it as recently used
+
+        :param key: (channel type, channel id, msgid)
+        :return: message context, or None if not cached
+        """
+        ctx = self._entries.get(key)
+        if ctx is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return ctx
+
+    def put(self, key: MessageKey, ctx: typing.Union[PrivateMessageContext, GroupMessageContext]):
+        """
+        Remember a message, evicting the least recently used one if full
+
+        :param key: (channel type, channel id, msgid)
+        :param ctx: message context
+        """
+        if self._capacity <= 0:
+            return
+        self._entries[key] = ctx
+        self._entries.move_to_end(key)
+        if len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """
+        Get the cache counters
+
+        :return: {'size', 'capacity', 'hits', 'misses'} dict
+        """
+        return {
+            'size': len(self._entries),
+            'capacity': self._capacity,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
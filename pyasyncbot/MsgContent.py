@@ -8,30 +8,67 @@ if TYPE_CHECKING:
     from .Bot import Bot
 
 from .Contacts import User, Group, GroupMember
+from .commu import media
+from .MediaCache import get_default_cache, MediaCache
 
 import base64
 import datetime
+import mmap
+import os
 import typing
 from typing import List
 from dataclasses import dataclass
 
 import aiofiles
+from loguru import logger
 
 
 class MessageSegment:
-    def _gen_json_dict(self):
-        pass
+    """
+    Base of all message segments
+
+    A subclass setting _seg_type is registered under that name, and MessageSegment._parse_from_dict() hands dicts of
+    that type to it. The dict form is the framework's own, protocols may map it to their wire format
+    """
+    __slots__ = ()
+    _seg_type: str = None
+    _registry: typing.Dict[str, typing.Type[MessageSegment]] = dict()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        seg_type = cls.__dict__.get('_seg_type')
+        if seg_type is not None:
+            MessageSegment._registry[seg_type] = cls
+
+    def _gen_json_dict(self) -> typing.Union[dict, None]:
+        """
+        Serialize the segment to a JSON-compatible dict with a 'type' field
+
+        :return: None if the segment can not be serialized
+        """
+        return None
 
     @classmethod
-    def _parse_from_dict(cls, obj):
-        pass
+    def _parse_from_dict(cls, obj: dict) -> typing.Union[MessageSegment, None]:
+        """
+        Create a segment from the dict made by _gen_json_dict()
+
+        :param obj: serialized segment
+        :return: None if the type is unknown
+        """
+        seg_cls = MessageSegment._registry.get(obj['type'])
+        if seg_cls is None or seg_cls is cls:
+            return None
+        return seg_cls._parse_from_dict(obj)
 
 
 class TextSegment(MessageSegment):
     """
     Part of a message where continuous characters belong to
     """
+    __slots__ = ('_text',)
     _text: str
+    _seg_type = 'text'
 
     def __init__(self):
         self._text = ''
@@ -58,10 +95,51 @@ class TextSegment(MessageSegment):
         """
         return self._text
 
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'text', 'text': self._text}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> TextSegment:
+        return TextSegment.from_text(obj['text'])
+
     def __str__(self):
         return self._text
 
 
+async def _read_chunks(chunks: typing.AsyncIterator[bytes], size_hint: typing.Optional[int],
+                       max_size: int) -> bytearray:
+    """
+    Collect chunks into one buffer, allocated once if the size is known in advance
+
+    :param chunks: data source
+    :param size_hint: expected total size, None if unknown
+    :param max_size: max bytes accepted
+    :return: buffer
+    """
+    if size_hint is not None and size_hint > max_size:
+        raise Exception('image larger than {max} bytes'.format(max=max_size))
+    buffer = bytearray(size_hint or 0)
+    length = 0
+    async for chunk in chunks:
+        end = length + len(chunk)
+        if end > max_size:
+            raise Exception('image larger than {max} bytes'.format(max=max_size))
+        # grows the buffer if the source turns out to be larger than the hint
+        buffer[length:end] = chunk
+        length = end
+    if length < len(buffer):
+        del buffer[length:]
+    return buffer
+
+
+async def _iter_file(f, chunk_size: int) -> typing.AsyncIterator[bytes]:
+    while True:
+        chunk = await f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
 class ImageSegment(MessageSegment):
     """
     Part of a message where there is an image
@@ -69,16 +147,27 @@ class ImageSegment(MessageSegment):
     URL will always be available when the message content is received
 
     Preferred sending priority:
-      1. image id (not implemented)
-      2. raw buffer as base64
+      1. image id, if the protocol supports it and the media cache is enabled
+      2. raw buffer
       3. url
     """
-    _buffer: bytes
+    __slots__ = ('_buffer', '_url', '_digest', '_image_id')
+    _buffer: typing.Union[bytes, bytearray, memoryview]
     _url: str
+    _digest: str
+    _image_id: str
+    _seg_type = 'image'
+
+    # default max size of images loaded from files or urls, in bytes
+    MAX_SIZE = 32 * 1024 * 1024
+    # size of each read when loading images, in bytes
+    CHUNK_SIZE = 64 * 1024
 
     def __init__(self):
         self._buffer = None
         self._url = None
+        self._digest = None
+        self._image_id = None
 
     @classmethod
     def from_base64(cls, b64: str):
@@ -93,11 +182,13 @@ class ImageSegment(MessageSegment):
         return ret
 
     @classmethod
-    def from_buffer(cls, buffer: bytes):
+    def from_buffer(cls, buffer: typing.Union[bytes, bytearray, memoryview]):
         """
         Create an image segment from raw binary buffer
 
-        :param buffer: image file content in base64 encoding
+        The buffer is kept by reference, do not modify it until the message is sent
+
+        :param buffer: image file content
         :return: an image segment
         """
         ret = ImageSegment()
@@ -105,20 +196,41 @@ class ImageSegment(MessageSegment):
         return ret
 
     @classmethod
-    async def from_file(cls, filename: str):
+    async def from_file(cls, filename: str, max_size: int = None, use_mmap: bool = True):
         """
         Create an image segment from local filesystem
 
+        The file is mapped instead of read by default, so its pages are loaded by the OS only when the image is sent,
+        and are never copied to the heap. The file should not be modified while the segment is alive, pass
+        use_mmap=False to read it into memory in chunks instead. Files that can't be mapped are read as well
+
+        The size is checked before anything is read
+
         :param filename: path of file
+        :param max_size: max file size in bytes, defaults to ImageSegment.MAX_SIZE
+        :param use_mmap: map the file instead of reading it
         :return: an image segment
         """
-        try:
-            ret = ImageSegment()
-            with aiofiles.open(filename, mode='rb') as f:
-                ret._buffer = await f.read()
-            return ret
-        except Exception as e:
-            raise e
+        if max_size is None:
+            max_size = ImageSegment.MAX_SIZE
+        ret = ImageSegment()
+        if use_mmap:
+            with open(filename, mode='rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if size > max_size:
+                    raise Exception('image larger than {max} bytes'.format(max=max_size))
+                if size == 0:
+                    raise Exception('Empty file')
+                try:
+                    # the mapping stays valid after the file is closed
+                    ret._buffer = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                    return ret
+                except (OSError, ValueError) as e:
+                    logger.debug('failed to map {name}, read instead: {reason}'.format(name=filename, reason=str(e)))
+        async with aiofiles.open(filename, mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            ret._buffer = await _read_chunks(_iter_file(f, ImageSegment.CHUNK_SIZE), size, max_size)
+        return ret
 
     @classmethod
     def from_url(cls, url: str):
@@ -140,26 +252,99 @@ class ImageSegment(MessageSegment):
         """
         return self._url
 
-    async def fetch_from_url(self, proxy: str = None) -> bool:
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'image', 'url': self._url}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> ImageSegment:
+        return ImageSegment.from_url(obj.get('url'))
+
+    async def fetch_from_url(self, proxy: str = None, max_size: int = None, use_cache: bool = True) -> bool:
         """
         Fetch the image data from url if the segment does not contain raw data
 
+        If the media cache is enabled, data fetched from the same url before is reused. Set use_cache to False for
+        urls whose content changes, such as random image APIs
+
+        The response is read in chunks and given up as soon as it exceeds max_size
+
+        Goes through the media session of the running bot, which pools connections and applies the configured proxy.
+        Without a running bot, a temporary session is used
+
+        :param proxy: http proxy, overrides the configured one
+        :param max_size: max image size in bytes, defaults to ImageSegment.MAX_SIZE
+        :param use_cache: look up and fill the media cache
         :return: True if success
         """
+        if self._buffer is not None:
+            return True
         if self._url is None:
             raise Exception('URL not available')
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self._url, proxy=proxy, allow_redirects=True) as resp:
-                if 'image' in resp.headers['Content-Type']:
-                    self._buffer = await resp.read()
-                    return True
-                else:
-                    return False
+        if max_size is None:
+            max_size = ImageSegment.MAX_SIZE
+
+        cache = get_default_cache() if use_cache else None
+        if cache is not None:
+            cached = await cache.get_url(self._url)
+            if cached is not None and len(cached[1]) <= max_size:
+                self._digest, self._buffer = cached
+                return True
+
+        client = media.get_default_client()
+        if client is not None:
+            async with client.get(self._url, proxy=proxy) as resp:
+                fetched = await self.__read_response(resp, max_size)
+        else:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(self._url, proxy=proxy, allow_redirects=True) as resp:
+                    fetched = await self.__read_response(resp, max_size)
+        if fetched and cache is not None:
+            self._digest = await cache.put_url(self._url, self._buffer)
+        return fetched
+
+    async def __read_response(self, resp: aiohttp.ClientResponse, max_size: int) -> bool:
+        if 'image' in resp.content_type:
+            self._buffer = await _read_chunks(resp.content.iter_chunked(ImageSegment.CHUNK_SIZE),
+                                              resp.content_length, max_size)
+            return True
+        else:
+            return False
 
     def is_raw_data_available(self) -> bool:
         return self._buffer is not None
 
+    def get_digest(self) -> str:
+        """
+        Get the content hash of the raw image data, as used by the media cache
+
+        :return: sha256 hex digest
+        """
+        if self._digest is None:
+            self._digest = MediaCache.digest(self.get_raw())
+        return self._digest
+
+    def get_image_id(self) -> typing.Union[str, None]:
+        """
+        Get the id the backend knows the image by
+
+        :return: None if not available
+        """
+        return self._image_id
+
+    def _with_image_id(self, image_id: str) -> ImageSegment:
+        """
+        Copy the segment with the image id set, sharing the raw data
+
+        :param image_id: id the backend knows the image by
+        :return: a new image segment
+        """
+        ret = ImageSegment()
+        ret._buffer = self._buffer
+        ret._url = self._url
+        ret._digest = self._digest
+        ret._image_id = image_id
+        return ret
+
     def get_base64(self) -> str:
         """
         Try to get the base64 of the image.
@@ -173,9 +358,9 @@ class ImageSegment(MessageSegment):
         else:
             raise Exception('Raw image data not available')
 
-    def get_raw(self) -> bytes:
+    def get_raw(self) -> typing.Union[bytes, bytearray, memoryview]:
         """
-        Get the image data as bytes buffer
+        Get the image data as the buffer it was created from
 
         :return: raw image
         """
@@ -192,8 +377,10 @@ class EmojiSegment(MessageSegment):
     """
     Part of a message where a single emoji exists
     """
+    __slots__ = ('_id', '_replacement')
     _id: int
     _replacement: str
+    _seg_type = 'emoji'
 
     def __init__(self):
         self._id = None
@@ -216,6 +403,13 @@ class EmojiSegment(MessageSegment):
     def get_id(self):
         return self._id
 
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'emoji', 'id': self._id, 'replaceText': self._replacement}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> EmojiSegment:
+        return EmojiSegment.from_id(obj['id'], obj.get('replaceText', ''))
+
     def __str__(self):
         return '[EMOJI:{text}]'.format(text=self._replacement)
 
@@ -224,8 +418,10 @@ class MentionSegment(MessageSegment):
     """
     Part of a message where an @xxx exists
     """
+    __slots__ = ('_target', '_replacement')
     _target: int
     _replacement: str
+    _seg_type = 'mention'
 
     def __init__(self):
         self._target = None
@@ -251,6 +447,13 @@ class MentionSegment(MessageSegment):
     async def get_target(self, group: Group) -> typing.Union[GroupMember, None]:
         return await group.get_member(self._target)
 
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'mention', 'target': self._target, 'displayText': self._replacement}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> MentionSegment:
+        return MentionSegment.from_id(obj['target'], obj.get('displayText', ''))
+
     def __str__(self):
         return self._replacement
 
@@ -259,6 +462,8 @@ class GroupedSegment(MessageSegment):
     """
     Part of a message where continuous characters belong to
     """
+    __slots__ = ('_grouped_msg_id',)
+    _seg_type = 'forwarded'
 
     class ContextFreeMessage(typing.TypedDict):
         id: int
@@ -304,6 +509,13 @@ class GroupedSegment(MessageSegment):
     def get_id(self) -> str:
         return self._grouped_msg_id
 
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'forwarded', 'id': self._grouped_msg_id}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> GroupedSegment:
+        return GroupedSegment.from_grouped_msg_id(obj['id'])
+
     async def get_contents(self, bot: Bot) -> typing.List[ContextFreeMessage]:
         """
         Fetch the actual contents of this grouped message
@@ -321,6 +533,8 @@ class ApplicationSegment(MessageSegment):
     """
     Advanced segment which is defined by bot protocol
     """
+    __slots__ = ('_base', '_type', '_data', '_bref')
+    _seg_type = 'application'
 
     def __init__(self):
         self._base: str = None
@@ -334,6 +548,7 @@ class ApplicationSegment(MessageSegment):
     @classmethod
     def from_data(cls, base: str, type: str, data, bref: str = ''):
         ret = ApplicationSegment()
+        ret._base = base
         ret._type = type
         ret._data = data
         ret._bref = bref
@@ -345,6 +560,14 @@ class ApplicationSegment(MessageSegment):
     def get_data(self):
         return self._data
 
+    def _gen_json_dict(self) -> dict:
+        return {'type': 'application', 'base': self._base, 'appType': self._type, 'data': self._data,
+                'bref': self._bref}
+
+    @classmethod
+    def _parse_from_dict(cls, obj: dict) -> ApplicationSegment:
+        return ApplicationSegment.from_data(obj.get('base'), obj['appType'], obj.get('data'), obj.get('bref', ''))
+
 
 class MessageContent:
     """
@@ -377,6 +600,34 @@ class MessageContent:
     def get_segments(self):
         return self._msgs
 
+    def _gen_json_list(self) -> list:
+        """
+        Serialize all segments, skipping those that can not be serialized
+
+        :return: list of segment dicts
+        """
+        ret = []
+        for seg in self._msgs:
+            obj = seg._gen_json_dict()
+            if obj is not None:
+                ret.append(obj)
+        return ret
+
+    @classmethod
+    def _parse_from_list(cls, segs: list) -> MessageContent:
+        """
+        Create a message content from the list made by _gen_json_list(), skipping unknown segments
+
+        :param segs: list of segment dicts
+        :return: MessageContent
+        """
+        ret = MessageContent()
+        for obj in segs:
+            seg = MessageSegment._parse_from_dict(obj)
+            if seg is not None:
+                ret._msgs.append(seg)
+        return ret
+
     def add_text(self, text: str) -> MessageContent:
         """
         Message Builder function for text content
@@ -0,0 +1,544 @@
+# -*- coding: utf-8 -*-
+from __future__ import annotations
+
+from loguru import logger
+from array import array
+from bisect import bisect_left
+import asyncio
+import dataclasses
+import datetime
+import heapq
+import itertools
+import mmap
+import os
+import re
+import typing
+
+from . import JsonCodec
+from .Contacts import Channel
+from .Message import PrivateMessageContext, GroupMessageContext
+from .MsgContent import TextSegment
+
+_WORD = re.compile(r'[0-9a-z]+|[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+')
+
+
+def tokenize(text: str, query: bool = False) -> typing.List[str]:
+    """
+    Split text into index terms
+
+    Latin letters and digits form words. Runs of CJK characters are split into overlapping bigrams, as there's no
+    space between words, and into single characters as well when indexing, so that a query of one character matches
+    it anywhere in a run. Queries of longer runs use the bigrams only, which are far more selective.
+
+    :param text: text
+    :param query: split a query instead of a message
+    :return: list of terms, may contain duplicates
+    """
+    ret = []
+    for match in _WORD.finditer(text.lower()):
+        word = match.group()
+        if word[0] < '\u3040':
+            ret.append(word)
+        elif len(word) == 1:
+            ret.append(word)
+        else:
+            ret.extend(word[i:i + 2] for i in range(len(word) - 1))
+            if not query:
+                ret.extend(word)
+    return ret
+
+
+def _channel_term(channel_type: Channel.ChannelType, channel_id: int) -> str:
+    # not producible by tokenize()
+    return '\0c{k}:{c}'.format(k=channel_type.value, c=channel_id)
+
+
+def _sender_term(sender_id: int) -> str:
+    return '\0s{u}'.format(u=sender_id)
+
+
+@dataclasses.dataclass
+class SearchHit:
+    """A message matching the search
+
+    Args:
+        channel_type: type of channel
+        channel_id: where the message belongs to
+        msgid: msg id
+        sender_id: who sent the message
+        time: time of message
+    """
+    channel_type: Channel.ChannelType
+    channel_id: int
+    msgid: str
+    sender_id: int
+    time: datetime.datetime
+
+
+class _MemorySegment:
+    """
+    Index of recent messages being built in memory
+    """
+    __slots__ = ('base', 'postings', 'times', 'docs')
+
+    def __init__(self, base: int):
+        self.base: int = base
+        self.postings: typing.Dict[str, array] = dict()
+        self.times: array = array('d')
+        # [channel type value, channel id, msgid, sender id, time]
+        self.docs: typing.List[list] = []
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def add(self, terms: typing.Iterable[str], doc: list):
+        docid = self.base + len(self.docs)
+        for term in terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = array('q')
+            posting.append(docid)
+        self.times.append(doc[4])
+        self.docs.append(doc)
+
+    def get_postings(self, term: str) -> typing.Sequence[int]:
+        return self.postings.get(term, ())
+
+    def get_time(self, docid: int) -> float:
+        return self.times[docid - self.base]
+
+    def get_doc(self, docid: int) -> list:
+        return self.docs[docid - self.base]
+
+
+class _DiskSegment:
+    """
+    Index segment saved to disk
+
+    Everything stays in files read through mmap: the term dictionary as a sorted block searched by bisection,
+    postings, per document time and offset, and documents. Memory used by a segment doesn't grow with its size
+    """
+    __slots__ = ('seq', 'base', '_maps', '_term_index', '_times', '_doc_offsets', '_term_count')
+
+    def __init__(self, path: str, seq: int):
+        self.seq: int = seq
+        with open(_segment_file(path, seq, '.meta'), 'rb') as f:
+            meta = JsonCodec.loads(f.read())
+        if meta.get('version') != _SEGMENT_VERSION:
+            raise Exception('unsupported index segment version')
+        self.base: int = meta['base']
+        self._term_count: int = meta['terms']
+        self._maps: typing.Dict[str, mmap.mmap] = dict()
+        for suffix in _SEGMENT_SUFFIXES:
+            if suffix != '.meta':
+                self._maps[suffix] = _map_file(_segment_file(path, seq, suffix))
+        # [term offset, postings offset in number of entries, number of entries] of each term, in term order
+        self._term_index: typing.Sequence[int] = self.__view('.tidx', 'q')
+        self._times: typing.Sequence[float] = self.__view('.time', 'd')
+        self._doc_offsets: typing.Sequence[int] = self.__view('.doff', 'q')
+
+    def __view(self, suffix: str, fmt: str) -> typing.Sequence:
+        mm = self._maps[suffix]
+        return memoryview(mm).cast(fmt) if mm is not None else ()
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    def close(self):
+        # views must go before the maps can be closed
+        for view in (self._term_index, self._times, self._doc_offsets):
+            if isinstance(view, memoryview):
+                view.release()
+        for mm in self._maps.values():
+            if mm is not None:
+                mm.close()
+        self._maps.clear()
+
+    def __term_at(self, i: int) -> bytes:
+        start = self._term_index[i * 3]
+        end = self._term_index[(i + 1) * 3] if i + 1 < self._term_count else len(self._maps['.term'])
+        return self._maps['.term'][start:end]
+
+    def __find(self, term: str) -> int:
+        key = term.encode('utf-8')
+        lo, hi = 0, self._term_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__term_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._term_count and self.__term_at(lo) == key:
+            return lo
+        return -1
+
+    def __postings_bytes_at(self, i: int) -> bytes:
+        offset, count = self._term_index[i * 3 + 1], self._term_index[i * 3 + 2]
+        return self._maps['.post'][offset * 8:(offset + count) * 8]
+
+    def get_postings(self, term: str) -> typing.Sequence[int]:
+        i = self.__find(term)
+        if i < 0:
+            return ()
+        ret = array('q')
+        ret.frombytes(self.__postings_bytes_at(i))
+        return ret
+
+    def iter_terms(self) -> typing.Iterator[typing.Tuple[str, bytes]]:
+        """
+        Iterate over terms in order, with their postings
+
+        :return: iterator of (term, postings as bytes)
+        """
+        for i in range(self._term_count):
+            yield self.__term_at(i).decode('utf-8'), self.__postings_bytes_at(i)
+
+    def get_time(self, docid: int) -> float:
+        return self._times[docid - self.base]
+
+    def get_times_bytes(self) -> bytes:
+        return self._maps['.time'][:] if self._maps['.time'] is not None else b''
+
+    def get_doc_offsets(self) -> typing.Sequence[int]:
+        return self._doc_offsets
+
+    def get_doc(self, docid: int) -> list:
+        i = docid - self.base
+        end = self._doc_offsets[i + 1] if i + 1 < len(self._doc_offsets) else len(self._maps['.docs'])
+        return JsonCodec.loads(self._maps['.docs'][self._doc_offsets[i]:end])
+
+    def get_docs_buffer(self) -> typing.Union[mmap.mmap, bytes]:
+        # written out as is, without being copied
+        return self._maps['.docs'] if self._maps['.docs'] is not None else b''
+
+
+_SEGMENT_VERSION = 2
+# meta goes first, as it marks the segment as complete and is removed first
+_SEGMENT_SUFFIXES = ('.meta', '.term', '.tidx', '.post', '.time', '.doff', '.docs')
+
+
+def _segment_file(path: str, seq: int, suffix: str) -> str:
+    return os.path.join(path, '{seq:08d}{suffix}'.format(seq=seq, suffix=suffix))
+
+
+def _map_file(filename: str) -> typing.Union[mmap.mmap, None]:
+    if os.path.getsize(filename) == 0:
+        # empty file cannot be mapped
+        return None
+    with open(filename, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _write_file(filename: str, data: typing.Union[str, bytes]):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def _write_segment(path: str, seq: int, base: int, terms: typing.Iterable[typing.Tuple[str, bytes]],
+                   times: bytes, docs: typing.Iterable[typing.Union[bytes, mmap.mmap]], doc_offsets: array):
+    """
+    Write a segment
+
+    :param path: index directory
+    :param seq: segment sequence number
+    :param base: doc id of the first document
+    :param terms: (term, postings as bytes) in term order
+    :param times: time of each document as bytes of doubles
+    :param docs: buffers of encoded documents, concatenated in order
+    :param doc_offsets: offset of each document in docs
+    """
+    term_index = array('q')
+    term_count = 0
+    term_size = 0
+    count = 0
+    with open(_segment_file(path, seq, '.term'), 'wb') as term_file, \
+            open(_segment_file(path, seq, '.post'), 'wb') as post_file:
+        for term, posting in terms:
+            data = term.encode('utf-8')
+            term_file.write(data)
+            n = len(posting) // 8
+            term_index.extend((term_size, count, n))
+            post_file.write(posting)
+            term_size += len(data)
+            count += n
+            term_count += 1
+    _write_file(_segment_file(path, seq, '.tidx'), term_index.tobytes())
+    _write_file(_segment_file(path, seq, '.time'), times)
+    _write_file(_segment_file(path, seq, '.doff'), doc_offsets.tobytes())
+    with open(_segment_file(path, seq, '.docs'), 'wb') as f:
+        for data in docs:
+            f.write(data)
+    # meta file marks the segment as complete, so it goes last
+    _write_file(_segment_file(path, seq, '.meta'), JsonCodec.dumps({
+        'version': _SEGMENT_VERSION,
+        'base': base,
+        'terms': term_count,
+    }))
+
+
+def _remove_segment_files(path: str, seq: int):
+    for suffix in _SEGMENT_SUFFIXES:
+        try:
+            os.remove(_segment_file(path, seq, suffix))
+        except FileNotFoundError:
+            pass
+
+
+class SearchIndex:
+    """
+    Incremental full-text inverted index of delivered messages
+
+    Text of new messages goes into a segment in memory. Once it holds enough messages it is frozen and written to disk
+    in background, and small disk segments are merged into larger ones in background as well, so that the number of
+    segments a query visits stays low. Both happen in the default executor and never block the event loop.
+
+    With max_docs set, the oldest disk segments are deleted once the index holds more messages than that, and merges
+    never build a segment larger than a merge_factor-th of it, so that old messages go away in small steps.
+
+    Document ids grow with arrival, so that newer messages always come first when iterating postings backwards.
+    """
+
+    def __init__(self, path: str, flush_docs: int = 20000, merge_factor: int = 4, max_docs: int = None):
+        """
+        :param path: directory of index segments, created if not exist
+        :param flush_docs: write the memory segment to disk once it holds this many messages
+        :param merge_factor: merge this many disk segments of the same level into one
+        :param max_docs: delete the oldest segments once more messages than this are indexed. None means keeping all
+        """
+        self._path: str = path
+        self._flush_docs: int = flush_docs
+        self._merge_factor: int = merge_factor
+        self._max_docs: int = max_docs
+        self._mem: _MemorySegment = None
+        # full memory segments waiting to be written
+        self._frozen: typing.List[_MemorySegment] = []
+        # ordered by doc id
+        self._disk: typing.List[_DiskSegment] = []
+        self._next_seq: int = 0
+        self._worker: asyncio.Task = None
+
+    def open(self):
+        """
+        Load index segments saved by previous runs
+        """
+        os.makedirs(self._path, exist_ok=True)
+        seqs = set()
+        for name in os.listdir(self._path):
+            stem, suffix = os.path.splitext(name)
+            if stem.isdigit():
+                seqs.add(int(stem))
+        for seq in sorted(seqs):
+            if not os.path.exists(_segment_file(self._path, seq, '.meta')):
+                # incomplete segment of an interrupted write or merge
+                _remove_segment_files(self._path, seq)
+                continue
+            try:
+                self._disk.append(_DiskSegment(self._path, seq))
+            except Exception as e:
+                logger.warning('dropped search index segment {seq}: {reason}'.format(seq=seq, reason=str(e)))
+                _remove_segment_files(self._path, seq)
+        self._disk.sort(key=lambda seg: seg.base)
+        # segments covered by a merged one are left over by an interrupted merge
+        kept = []
+        for seg in self._disk:
+            if len(kept) > 0 and seg.base < kept[-1].base + len(kept[-1]):
+                seg.close()
+                _remove_segment_files(self._path, seg.seq)
+                continue
+            kept.append(seg)
+        self._disk = kept
+        if len(seqs) > 0:
+            self._next_seq = max(seqs) + 1
+        base = self._disk[-1].base + len(self._disk[-1]) if len(self._disk) > 0 else 0
+        self._mem = _MemorySegment(base)
+        logger.info('search index opened at {path}, with {n} messages in {s} segments'.format(
+            path=self._path, n=base, s=len(self._disk)))
+
+    async def close(self):
+        """
+        Wait for background work, and write what is left in memory
+        """
+        if self._worker is not None:
+            await self._worker
+        if len(self._mem) > 0:
+            self._frozen.append(self._mem)
+            self._mem = _MemorySegment(self._mem.base + len(self._mem))
+        while len(self._frozen) > 0:
+            self._disk.append(self.__write_memory_segment(self._frozen[0], self.__alloc_seq()))
+            self._frozen.pop(0)
+        await self.__trim()
+        for seg in self._disk:
+            seg.close()
+        self._disk = []
+
+    def add(self, ctx: typing.Union[PrivateMessageContext, GroupMessageContext]):
+        """
+        Index the text of a delivered message
+
+        :param ctx: message context
+        """
+        text = ' '.join(seg.get_text() for seg in ctx.msgcontent.get_segments() if isinstance(seg, TextSegment))
+        terms = set(tokenize(text))
+        if len(terms) == 0:
+            return
+        if isinstance(ctx, GroupMessageContext):
+            channel_type = Channel.ChannelType.MultiUser
+            channel_id = ctx.group_id
+        else:
+            channel_type = Channel.ChannelType.P2P
+            channel_id = ctx.channel_id
+        terms.add(_channel_term(channel_type, channel_id))
+        terms.add(_sender_term(ctx.sender_id))
+        self._mem.add(terms, [channel_type.value, channel_id, ctx.msgid, ctx.sender_id, ctx.time.timestamp()])
+        if len(self._mem) >= self._flush_docs:
+            self._frozen.append(self._mem)
+            self._mem = _MemorySegment(self._mem.base + len(self._mem))
+            self.__kick()
+
+    def search(self, query: str, channel_type: Channel.ChannelType = None, channel_id: int = None,
+               sender_id: int = None, since: datetime.datetime = None, limit: int = 20) -> typing.List[SearchHit]:
+        """
+        Find messages containing all terms of the query, newest first
+
+        :param query: text to search
+        :param channel_type: only in channels of this type, must come with channel_id
+        :param channel_id: only in this channel
+        :param sender_id: only sent by this user
+        :param since: only messages not older than this. None means unbounded
+        :param limit: max number of results
+        :return: list of hits
+        """
+        terms = list(set(tokenize(query, query=True)))
+        if len(terms) == 0:
+            return []
+        if channel_id is not None:
+            terms.append(_channel_term(channel_type, channel_id))
+        if sender_id is not None:
+            terms.append(_sender_term(sender_id))
+        since_ts = since.timestamp() if since is not None else None
+        ret = []
+        for seg in [self._mem] + self._frozen[::-1] + self._disk[::-1]:
+            for docid in self.__match(seg, terms):
+                if since_ts is not None and seg.get_time(docid) < since_ts:
+                    continue
+                kind, cid, msgid, uid, t = seg.get_doc(docid)
+                ret.append(SearchHit(Channel.ChannelType(kind), cid, msgid, uid, datetime.datetime.fromtimestamp(t)))
+                if len(ret) >= limit:
+                    return ret
+        return ret
+
+    @staticmethod
+    def __match(seg: typing.Union[_MemorySegment, _DiskSegment], terms: typing.List[str]) -> typing.Iterator[int]:
+        postings = sorted((seg.get_postings(term) for term in terms), key=len)
+        if len(postings[0]) == 0:
+            return
+        # walk the shortest posting list backwards, probing the others
+        for docid in reversed(postings[0]):
+            for other in postings[1:]:
+                i = bisect_left(other, docid)
+                if i == len(other) or other[i] != docid:
+                    break
+            else:
+                yield docid
+
+    def __alloc_seq(self) -> int:
+        seq = self._next_seq
+        self._next_seq += 1
+        return seq
+
+    def __kick(self):
+        if self._worker is None or self._worker.done():
+            self._worker = asyncio.get_running_loop().create_task(self.__maintain(), name='search_index')
+
+    async def __maintain(self):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if len(self._frozen) > 0:
+                    # frozen segments are still searched until written
+                    seg = await loop.run_in_executor(None, self.__write_memory_segment, self._frozen[0],
+                                                     self.__alloc_seq())
+                    self._frozen.pop(0)
+                    self._disk.append(seg)
+                    await self.__trim()
+                    continue
+                group = self.__pick_merge()
+                if group is None:
+                    break
+                seg = await loop.run_in_executor(None, self.__merge_segments, group, self.__alloc_seq())
+                i = self._disk.index(group[0])
+                self._disk[i:i + len(group)] = [seg]
+                for old in group:
+                    old.close()
+                    await loop.run_in_executor(None, _remove_segment_files, self._path, old.seq)
+                logger.debug('search index merged {n} segments into {seq}, with {size} messages'.format(
+                    n=len(group), seq=seg.seq, size=len(seg)))
+        except Exception as e:
+            logger.error('search index maintenance failed: {reason}'.format(reason=str(e)))
+
+    async def __trim(self):
+        if self._max_docs is None:
+            return
+        loop = asyncio.get_running_loop()
+        end = self._mem.base + len(self._mem)
+        # the newest disk segment is always kept, messages in memory are not counted
+        while len(self._disk) > 1 and end - self._disk[0].base > self._max_docs:
+            old = self._disk.pop(0)
+            size = len(old)
+            old.close()
+            await loop.run_in_executor(None, _remove_segment_files, self._path, old.seq)
+            logger.debug('search index segment {seq} deleted, with {size} messages'.format(seq=old.seq, size=size))
+
+    def __pick_merge(self) -> typing.Union[typing.List[_DiskSegment], None]:
+        # merge adjacent segments of the same size level, so that every message is rewritten only a few times
+        levels = [self.__level(len(seg)) for seg in self._disk]
+        for i in range(len(levels) - self._merge_factor + 1):
+            if len(set(levels[i:i + self._merge_factor])) == 1:
+                group = self._disk[i:i + self._merge_factor]
+                if self._max_docs is not None and \
+                        sum(len(seg) for seg in group) * self._merge_factor > self._max_docs:
+                    # too large to be deleted in one step
+                    continue
+                return group
+        return None
+
+    def __level(self, size: int) -> int:
+        level = 0
+        while size >= self._flush_docs * self._merge_factor ** (level + 1):
+            level += 1
+        return level
+
+    def __write_memory_segment(self, mem: _MemorySegment, seq: int) -> _DiskSegment:
+        doc_offsets = array('q')
+        docs = []
+        size = 0
+        for doc in mem.docs:
+            doc_offsets.append(size)
+            data = JsonCodec.dumps(doc)
+            data = data.encode('utf-8') if isinstance(data, str) else data
+            docs.append(data)
+            size += len(data)
+        _write_segment(self._path, seq, mem.base,
+                       ((term, posting.tobytes()) for term, posting in sorted(mem.postings.items())),
+                       mem.times.tobytes(), docs, doc_offsets)
+        return _DiskSegment(self._path, seq)
+
+    def __merge_segments(self, group: typing.List[_DiskSegment], seq: int) -> _DiskSegment:
+        doc_offsets = array('q')
+        size = 0
+        for seg in group:
+            doc_offsets.extend(offset + size for offset in seg.get_doc_offsets())
+            size += len(seg.get_docs_buffer())
+        # doc ids of the segments are ascending and disjoint, so postings are merged by concatenating. Ties of the
+        # term merge keep the order of the segments
+        merged = heapq.merge(*(seg.iter_terms() for seg in group), key=lambda entry: entry[0])
+        terms = ((term, b''.join(posting for _, posting in entries))
+                 for term, entries in itertools.groupby(merged, key=lambda entry: entry[0]))
+        _write_segment(self._path, seq, group[0].base, terms,
+                       b''.join(seg.get_times_bytes() for seg in group),
+                       (seg.get_docs_buffer() for seg in group), doc_offsets)
+        return _DiskSegment(self._path, seq)
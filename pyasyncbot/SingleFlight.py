@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import typing
+
+
+class SingleFlight:
+    """
+    Share one in-flight call among concurrent callers asking for the same key
+
+    The first caller starts the call as a task, later callers with the same key await that task instead of starting
+    their own. Once the call finishes, the next caller starts a new one. A caller being cancelled does not cancel the
+    call shared with others.
+    """
+    __slots__ = ('_calls',)
+
+    def __init__(self):
+        self._calls: typing.Dict[typing.Hashable, asyncio.Future] = dict()
+
+    async def do(self, key: typing.Hashable, func: typing.Callable[[], typing.Awaitable]) -> typing.Any:
+        """
+        Run the call or join the running one
+
+        :param key: identifies the call
+        :param func: co-routine function to be called if no call of the key is running
+        :return: result of the call
+        """
+        fut = self._calls.get(key)
+        if fut is None:
+            fut = asyncio.ensure_future(func())
+            self._calls[key] = fut
+            fut.add_done_callback(lambda f: self.__done(key, f))
+        return await asyncio.shield(fut)
+
+    async def join(self, key: typing.Hashable):
+        """
+        Wait for the running call of the key, if any. Its result or error is ignored
+
+        :param key: identifies the call
+        """
+        fut = self._calls.get(key)
+        if fut is None:
+            return
+        try:
+            await asyncio.shield(fut)
+        except Exception:
+            pass
+
+    def running(self, key: typing.Hashable) -> bool:
+        return key in self._calls
+
+    def __done(self, key: typing.Hashable, fut: asyncio.Future):
+        if self._calls.get(key) is fut:
+            del self._calls[key]
+        if not fut.cancelled():
+            # mark the exception as retrieved, callers got it already
+            fut.exception()
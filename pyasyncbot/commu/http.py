@@ -4,6 +4,7 @@ from loguru import logger
 import asyncio
 import typing
 import aiohttp
+import yarl
 import sys
 
 from .CommunicationBackend import CommunicationBackend
@@ -15,15 +16,59 @@ class HTTPClient(CommunicationBackend):
     """
     _ahttp: aiohttp.ClientSession
 
-    def __init__(self, remote_addr: str, remote_port: int):
+    def __init__(self, remote_addr: str, remote_port: int, *, connection_limit: int = 100,
+                 connection_limit_per_host: int = 0, keepalive_timeout: float = 60, dns_cache_ttl: int = 300,
+                 connect_timeout: float = 10, request_timeout: float = 60, unix_socket_path: str = None):
         self._addr = remote_addr
         self._port = remote_port
         self._ahttp = None
+        self._connection_limit = connection_limit
+        self._connection_limit_per_host = connection_limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+        self._unix_socket_path = unix_socket_path
+        # resolved once, so that requests will not format and parse the url again and again
+        self._base_url: yarl.URL = yarl.URL.build(scheme='http', host=remote_addr, port=remote_port)
+        self._urls: typing.Dict[str, yarl.URL] = dict()
 
     async def setup(self) -> typing.Any:
-        self._ahttp = aiohttp.ClientSession(loop=asyncio.get_running_loop())
+        if self._unix_socket_path is not None:
+            # remote address is still used for the Host header, while the bytes go through the socket file
+            connector = aiohttp.UnixConnector(
+                path=self._unix_socket_path,
+                limit=self._connection_limit,
+                limit_per_host=self._connection_limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+            )
+        else:
+            # asyncio already enables TCP_NODELAY on every TCP transport, so only pooling needs to be tuned here
+            connector = aiohttp.TCPConnector(
+                limit=self._connection_limit,
+                limit_per_host=self._connection_limit_per_host,
+                keepalive_timeout=self._keepalive_timeout,
+                ttl_dns_cache=self._dns_cache_ttl,
+            )
+        self._ahttp = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._request_timeout, sock_connect=self._connect_timeout),
+        )
         return HTTPClientAPI(self)
 
+    def get_url(self, path: str) -> yarl.URL:
+        """
+        Get the absolute url of the given path on the remote
+
+        :param path: path starts with '/', or empty for the root
+        :return: url
+        """
+        url = self._urls.get(path)
+        if url is None:
+            url = self._base_url.join(yarl.URL(path))
+            self._urls[path] = url
+        return url
+
     async def cleanup(self):
         await self._ahttp.close()
 
@@ -33,10 +78,7 @@ class HTTPClient(CommunicationBackend):
 
     async def upgrade_ws(self) -> aiohttp.client.ClientWebSocketResponse:
         try:
-            return await self._ahttp.ws_connect('ws://{remote_addr}:{remote_port}'.format(
-                remote_addr=self._addr,
-                remote_port=self._port
-            ))
+            return await self._ahttp.ws_connect(self._base_url.with_scheme('ws'))
         except Exception as e:
             logger.error(e)
             return None
@@ -52,11 +94,8 @@ class HTTPClientAPI:
         retry_count = 0
         while True:
             try:
-                return await self.__base._ahttp.get('http://{addr}:{port}{path}'.format(
-                    addr=self.__base._addr,
-                    port=self.__base._port,
-                    path=path,
-                ), allow_redirects=allow_redirects, **kwargs)
+                return await self.__base._ahttp.get(self.__base.get_url(path),
+                                                    allow_redirects=allow_redirects, **kwargs)
             except aiohttp.ClientConnectorError as e:
                 # remote service down
                 raise e
@@ -71,11 +110,7 @@ class HTTPClientAPI:
         retry_count = 0
         while True:
             try:
-                return await self.__base._ahttp.post('http://{addr}:{port}{path}'.format(
-                    addr=self.__base._addr,
-                    port=self.__base._port,
-                    path=path,
-                ), data=data, **kwargs)
+                return await self.__base._ahttp.post(self.__base.get_url(path), data=data, **kwargs)
             except aiohttp.ClientConnectorError as e:
                 # remote service down
                 raise e
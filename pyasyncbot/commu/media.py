@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import typing
+import aiohttp
+
+# client of the running bot, used by media helpers without a bot context such as ImageSegment.fetch_from_url()
+_default_client: typing.Optional['MediaClient'] = None
+
+
+def get_default_client() -> typing.Optional['MediaClient']:
+    """
+    Get the media client of the running bot
+
+    :return: None if no bot is running
+    """
+    return _default_client
+
+
+class MediaClient:
+    """
+    Outbound HTTP session for fetching media from arbitrary hosts, such as images to be forwarded
+
+    Unlike HTTPClient, which talks to the bot backend only, this one connects to many hosts, so pooling is limited per
+    host and a proxy may be applied
+    """
+    _ahttp: aiohttp.ClientSession
+
+    def __init__(self, *, proxy: str = None, connection_limit: int = 100, connection_limit_per_host: int = 8,
+                 keepalive_timeout: float = 30, dns_cache_ttl: int = 300, connect_timeout: float = 10,
+                 request_timeout: float = 60):
+        self._ahttp = None
+        self._proxy = proxy
+        self._connection_limit = connection_limit
+        self._connection_limit_per_host = connection_limit_per_host
+        self._keepalive_timeout = keepalive_timeout
+        self._dns_cache_ttl = dns_cache_ttl
+        self._connect_timeout = connect_timeout
+        self._request_timeout = request_timeout
+
+    async def setup(self):
+        global _default_client
+        connector = aiohttp.TCPConnector(
+            limit=self._connection_limit,
+            limit_per_host=self._connection_limit_per_host,
+            keepalive_timeout=self._keepalive_timeout,
+            ttl_dns_cache=self._dns_cache_ttl,
+        )
+        self._ahttp = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=self._request_timeout, sock_connect=self._connect_timeout),
+        )
+        _default_client = self
+
+    async def cleanup(self):
+        global _default_client
+        if _default_client is self:
+            _default_client = None
+        if self._ahttp is not None:
+            await self._ahttp.close()
+            self._ahttp = None
+
+    def get(self, url: str, proxy: str = None, **kwargs: typing.Any):
+        """
+        Make a GET request through the shared session
+
+        Use as `async with client.get(url) as resp:`
+
+        :param url: absolute url
+        :param proxy: overrides the configured proxy if provided
+        :return: request context manager
+        """
+        return self._ahttp.get(url, proxy=proxy if proxy is not None else self._proxy, allow_redirects=True, **kwargs)
@@ -18,8 +18,9 @@ class WebSocketClient(CommunicationBackend):
         self._http_base: HTTPClient = None
         self._http_base_managed: bool = None
         self._aws: aiohttp.client.ClientWebSocketResponse = None
-        self._on_text_cb: typing.Callable[[str], None] = None
-        self._on_bin_cb: typing.Callable[[bytes], None] = None
+        self._on_text_cb: typing.Callable[[str], typing.Optional[typing.Awaitable]] = None
+        self._on_bin_cb: typing.Callable[[bytes], typing.Optional[typing.Awaitable]] = None
+        self._on_disconnect_cb: typing.Callable[[], None] = None
 
     @classmethod
     def from_http_client(cls, http_client: HTTPClient):
@@ -31,9 +32,9 @@ class WebSocketClient(CommunicationBackend):
         return ret
 
     @classmethod
-    def from_parameters(cls, remote_addr: str, remote_port: int):
+    def from_parameters(cls, remote_addr: str, remote_port: int, unix_socket_path: str = None):
         ret = cls()
-        ret._http_base = HTTPClient(remote_addr, remote_port)
+        ret._http_base = HTTPClient(remote_addr, remote_port, unix_socket_path=unix_socket_path)
         ret._http_base_managed = True
         ret._aws = None
         logger.debug('ws client use newly created http client')
@@ -63,6 +64,8 @@ class WebSocketClient(CommunicationBackend):
                     # TODO: should we do something here?
                 elif msg.type == aiohttp.WSMsgType.closed:
                     logger.error(self._aws.exception())
+                    if self._on_disconnect_cb is not None:
+                        self._on_disconnect_cb()
                     while True:
                         try:
                             logger.info('WebSocket disconnected. wait 10s before reconnect')
@@ -80,13 +83,20 @@ class WebSocketClient(CommunicationBackend):
                             logger.error(e)
                 elif msg.type == aiohttp.WSMsgType.text:
                     if self._on_text_cb is not None:
-                        self._on_text_cb(msg.data)
+                        ret = self._on_text_cb(msg.data)
+                        if ret is not None:
+                            # async callback applies backpressure to the receiving loop
+                            await ret
                 elif msg.type == aiohttp.WSMsgType.binary:
                     if self._on_bin_cb is not None:
-                        self._on_bin_cb(msg.data)
+                        ret = self._on_bin_cb(msg.data)
+                        if ret is not None:
+                            await ret
             except asyncio.CancelledError:
                 logger.info('WebSocket client stopped')
                 await self._aws.close()
+                if self._on_disconnect_cb is not None:
+                    self._on_disconnect_cb()
                 return
 
 
@@ -94,22 +104,34 @@ class WSClientAPI:
     def __init__(self, wsclient: WebSocketClient):
         self._ws: WebSocketClient = wsclient
 
-    def register_text_message_callback(self, callback: typing.Callable[[str], None]):
+    def register_text_message_callback(self, callback: typing.Callable[[str], typing.Optional[typing.Awaitable]]):
         """
         Call this function to register a text message callback
 
+        If the callback returns an awaitable, receiving will not continue until it is done
+
         :param callback: callback function
         """
         self._ws._on_text_cb = callback
 
-    def register_binary_message_callback(self, callback: typing.Callable[[bytes], None]):
+    def register_binary_message_callback(self, callback: typing.Callable[[bytes], typing.Optional[typing.Awaitable]]):
         """
         Call this function to register a binary message callback
 
+        If the callback returns an awaitable, receiving will not continue until it is done
+
         :param callback: callback function
         """
         self._ws._on_bin_cb = callback
 
+    def register_disconnect_callback(self, callback: typing.Callable[[], None]):
+        """
+        Call this function to register a callback invoked whenever the WebSocket is closed, before reconnecting
+
+        :param callback: callback function
+        """
+        self._ws._on_disconnect_cb = callback
+
     async def send_text_message(self, data: str) -> typing.Any:
         try:
             await self._ws._aws.send_str(data)
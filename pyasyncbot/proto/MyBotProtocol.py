@@ -6,22 +6,118 @@ if TYPE_CHECKING:
     pass
 
 from loguru import logger
-import ujson
+import aiohttp
+import asyncio
+import collections
 
+from .. import JsonCodec
 from ..commu.http import HTTPClientAPI
 from ..Message import *
 from ..MsgContent import *
 from .Protocol import Protocol, BotWrapper
+from .SendBatcher import SendBatcher
+from .WSRPC import WSRPCClient
+from ..commu.websocket import WSClientAPI
 from ..Event import *
 from ..FrameworkWrapper import PrivateMessageContext, GroupMessageContext, Channel
+from ..MediaCache import get_default_cache
+
+
+# Wire formats that differ from MessageSegment._gen_json_dict(), other segment types are sent and parsed as that form.
+# Generators take the segment and the list collecting binary parts of a multipart request, or None if not multipart
+
+def _generate_image(seg: ImageSegment, attachments: typing.Optional[list]) -> dict:
+    if seg.get_image_id() is not None:
+        return {'type': 'image', 'id': seg.get_image_id()}
+    if seg.is_raw_data_available():
+        if attachments is not None:
+            # the buffer goes into its own part as is, instead of being expanded to base64 inside the JSON body
+            name = 'image{n}'.format(n=len(attachments))
+            attachments.append((name, seg.get_raw()))
+            return {'type': 'image', 'part': name}
+        return {'type': 'image', 'base64': seg.get_base64()}
+    return {'type': 'image', 'url': seg.get_url()}
+
+
+def _generate_emoji(seg: EmojiSegment, attachments: typing.Optional[list]) -> dict:
+    return {'type': 'emoji', 'id': seg.get_id()}
+
+
+def _generate_mention(seg: MentionSegment, attachments: typing.Optional[list]) -> dict:
+    return {'type': 'mention', 'target': seg.get_target_id()}
+
+
+def _generate_application(seg: ApplicationSegment, attachments: typing.Optional[list]) -> dict:
+    return {'type': seg.get_type(), 'data': seg.get_data()}
+
+
+# segment types registered later are still parsed through MessageSegment._parse_from_dict()
+_SEGMENT_PARSERS: typing.Dict[str, typing.Callable[[dict], MessageSegment]] = {
+    **{seg_type: seg_cls._parse_from_dict for seg_type, seg_cls in MessageSegment._registry.items()},
+    'json': lambda seg: ApplicationSegment.from_data('qq', 'json', seg['data'], 'json消息'),
+    'xml': lambda seg: ApplicationSegment.from_data('qq', 'xml', seg['data'], 'xml消息'),
+}
+
+_SEGMENT_GENERATORS: typing.Dict[typing.Type[MessageSegment],
+                                  typing.Callable[[typing.Any, typing.Optional[list]], dict]] = {
+    ImageSegment: _generate_image,
+    EmojiSegment: _generate_emoji,
+    MentionSegment: _generate_mention,
+    ApplicationSegment: _generate_application,
+}
+
+
+# generator found for each concrete segment class, None for those sent as their own dict form
+_generator_cache: typing.Dict[typing.Type[MessageSegment],
+                              typing.Optional[typing.Callable[[typing.Any, typing.Optional[list]], dict]]] = dict()
+
+
+def _find_generator(seg_cls: typing.Type[MessageSegment]) \
+        -> typing.Union[typing.Callable[[typing.Any, typing.Optional[list]], dict], None]:
+    try:
+        return _generator_cache[seg_cls]
+    except KeyError:
+        pass
+    # subclasses of a segment type go out in its wire format
+    generator = None
+    for cls in seg_cls.__mro__:
+        generator = _SEGMENT_GENERATORS.get(cls)
+        if generator is not None:
+            break
+    _generator_cache[seg_cls] = generator
+    return generator
 
 
 class MyBotProtocol(Protocol):
     _http_hdl: HTTPClientAPI
+    _ws_hdl: WSClientAPI
+    _rpc: WSRPCClient
+    _features: typing.Set[str]
+    _send_batcher: SendBatcher
+    _backlog: typing.Deque[typing.Awaitable]
+    _feeder: asyncio.Task
+
+    # how long sends wait to be coalesced into one batch, in second
+    SEND_BATCH_WINDOW = 0.005
+    # max number of sends in one batch
+    SEND_BATCH_MAX = 50
+    # warn each time this many events are waiting for the event queue
+    EVENT_BACKLOG_WARN = 10000
+    # push events beyond this many waiting are dropped
+    EVENT_BACKLOG_LIMIT = 50000
 
     def __init__(self, bot_wrapper: BotWrapper):
         super().__init__(bot_wrapper)
         self._http_hdl = None
+        self._ws_hdl = None
+        self._rpc = None
+        self._features = set()
+        self._send_batcher = None
+        self._backlog = collections.deque()
+        self._feeder = None
+        self._backlog_warned = False
+        # push events dropped because the backlog was full
+        self.dropped_events = 0
 
     @staticmethod
     def required_communication() -> typing.List[str]:
@@ -32,38 +128,106 @@ class MyBotProtocol(Protocol):
 
     async def setup(self, commu: typing.Dict[str, typing.Any]):
         self._http_hdl = commu['http_client']
-        commu['ws_client'].register_text_message_callback(self.process_incoming_ws_data)
+        self._ws_hdl = commu['ws_client']
+        self._ws_hdl.register_text_message_callback(self.process_incoming_ws_data)
+        self._ws_hdl.register_binary_message_callback(self.process_incoming_ws_data)
+        self._ws_hdl.register_disconnect_callback(self.__on_ws_disconnected)
         return True
 
     async def cleanup(self):
+        if self._rpc is not None:
+            self._rpc.fail_pending()
+        while len(self._backlog) != 0:
+            # never dispatched, avoid the never awaited warning
+            self._backlog.popleft().close()
         self._http_hdl = None
-        pass
+        self._ws_hdl = None
+        self._rpc = None
+        self._send_batcher = None
 
     async def probe(self) -> bool:
         res = await self._http_hdl.get('')
         if 'application/json' in res.content_type:
-            data = ujson.loads(await res.text())
+            data = JsonCodec.loads(await res.read())
             if data['name'] == 'oicq2-webapid':
                 logger.info('remote version: {v}'.format(v=data['version']))
+                # optional features advertised by newer backends
+                self._features = set(data.get('features', []))
+                if 'batchSend' in self._features:
+                    logger.info('remote supports batched sending')
+                    self._send_batcher = SendBatcher(self._flush_send_batch,
+                                                     MyBotProtocol.SEND_BATCH_WINDOW, MyBotProtocol.SEND_BATCH_MAX)
+                if 'multipartSend' in self._features:
+                    logger.info('remote accepts images as multipart uploads')
+                if 'imageId' in self._features:
+                    logger.info('remote supports sending uploaded images by id')
+                if 'wsRPC' in self._features:
+                    logger.info('remote supports requests over WebSocket')
+                    self._rpc = WSRPCClient(self._ws_hdl)
                 return True
         return False
 
-    def process_incoming_ws_data(self, data: str):
+    async def process_incoming_ws_data(self, data: typing.Union[str, bytes]):
         try:
-            msg_dict = ujson.loads(data)
-            if msg_dict['type'] == 'msg':
-                self._bot_wrapper.create_task(self.parse_msg(msg_dict['data']), 'push_event_worker')
+            msg_dict = JsonCodec.loads(data)
+            if msg_dict['type'] == 'rpc':
+                # responses are resolved in place, callers are waiting for them
+                if self._rpc is None or not self._rpc.resolve(msg_dict['id'], msg_dict['data']):
+                    logger.warning('dropped unexpected rpc response: ' + str(msg_dict['id']))
+            elif msg_dict['type'] == 'msg':
+                await self.__dispatch(self.parse_msg(msg_dict['data']))
             elif msg_dict['type'] == 'revoke':
-                self._bot_wrapper.create_task(self.parse_revoke(msg_dict['data']), 'push_event_worker')
+                await self.__dispatch(self.parse_revoke(msg_dict['data']))
             elif msg_dict['type'] == 'user':
-                self._bot_wrapper.create_task(self.parse_user_event(msg_dict['data']), 'push_event_worker')
+                await self.__dispatch(self.parse_user_event(msg_dict['data']))
             elif msg_dict['type'] == 'group':
-                self._bot_wrapper.create_task(self.parse_group_event(msg_dict['data']), 'push_event_worker')
+                await self.__dispatch(self.parse_group_event(msg_dict['data']))
             else:
                 logger.warning('Unsupported packet type: ' + msg_dict['type'])
         except ValueError as e:
             logger.error(e)
 
+    async def __dispatch(self, coro: typing.Awaitable):
+        """
+        Queue a push event for the workers
+
+        Without WebSocket RPC, a full event queue blocks the WebSocket reading, which throttles the remote. With it,
+        RPC responses arrive on the same WebSocket and must never wait behind events, so events are kept in a backlog
+        fed to the event queue in order by a separate task. The WebSocket is never paused then, as callbacks holding
+        the event queue may be waiting for responses on it, so events beyond EVENT_BACKLOG_LIMIT are dropped and
+        counted in dropped_events
+        """
+        if self._rpc is None:
+            await self._bot_wrapper.dispatch(coro, 'push_event_worker')
+            return
+        if len(self._backlog) >= MyBotProtocol.EVENT_BACKLOG_LIMIT:
+            coro.close()
+            self.dropped_events += 1
+            if self.dropped_events % 1000 == 1:
+                logger.error('push event backlog is full, {n} events dropped so far'.format(n=self.dropped_events))
+            return
+        self._backlog.append(coro)
+        if len(self._backlog) >= MyBotProtocol.EVENT_BACKLOG_WARN and not self._backlog_warned:
+            self._backlog_warned = True
+            logger.warning('{n} push events are waiting for the event queue'.format(n=len(self._backlog)))
+        if self._feeder is None:
+            self._feeder = self._bot_wrapper.create_task(self.__feed_backlog(), 'push_event_feeder')
+
+    async def __feed_backlog(self):
+        try:
+            while len(self._backlog) != 0:
+                await self._bot_wrapper.dispatch(self._backlog.popleft(), 'push_event_worker')
+                if self._backlog_warned and len(self._backlog) < MyBotProtocol.EVENT_BACKLOG_WARN // 2:
+                    # warn again at the next crossing
+                    self._backlog_warned = False
+        finally:
+            self._feeder = None
+
+    def __on_ws_disconnected(self):
+        if self._rpc is not None:
+            # responses of requests sent over the dropped connection will never arrive
+            self._rpc.fail_pending()
+
     async def parse_msg(self, msgdata: dict):
         reply: typing.Union[RepliedMessageContext, None] = None
         if 'reply' in msgdata:
@@ -103,22 +267,17 @@ class MyBotProtocol(Protocol):
     def parse_msg_content(msg: list) -> MessageContent:
         ret = MessageContent()
         for seg in msg:
-            if seg['type'] == 'text':
-                ret.append_segment(TextSegment.from_text(seg['text']))
-            elif seg['type'] == 'image':
-                ret.append_segment(ImageSegment.from_url(seg['url']))
-            elif seg['type'] == 'emoji':
-                ret.append_segment(EmojiSegment.from_id(seg['id'], seg['replaceText']))
-            elif seg['type'] == 'mention':
-                ret.append_segment(MentionSegment.from_id(seg['target'], seg['displayText']))
-            elif seg['type'] == 'forwarded':
-                ret.append_segment(GroupedSegment.from_grouped_msg_id(seg['id']))
-            elif seg['type'] == 'json':
-                ret.append_segment(ApplicationSegment.from_data('qq', 'json', seg['data'], 'json消息'))
-            elif seg['type'] == 'xml':
-                ret.append_segment(ApplicationSegment.from_data('qq', 'xml', seg['data'], 'xml消息'))
-            else:
+            parser = _SEGMENT_PARSERS.get(seg['type'])
+            try:
+                # segments sent as the framework's own dict form
+                parsed = parser(seg) if parser is not None else MessageSegment._parse_from_dict(seg)
+            except Exception as e:
+                logger.error('unsupported msg segment: {type}, {reason}'.format(type=seg['type'], reason=str(e)))
+                continue
+            if parsed is None:
                 logger.error('unsupported msg segment: ' + seg['type'])
+                continue
+            ret._msgs.append(parsed)
         return ret
 
     @staticmethod
@@ -132,43 +291,23 @@ class MyBotProtocol(Protocol):
         return ret
 
     @staticmethod
-    def generate_message_content(msg_content: MessageContent) -> list:
+    def generate_message_content(msg_content: MessageContent, attachments: list = None) -> list:
+        """
+        Generate the msgContent field of a send request
+
+        :param msg_content: message to be sent
+        :param attachments: if given, raw image buffers are appended to it as (part name, buffer) instead of being
+                            embedded as base64
+        :return: list of wire segments
+        """
         ret = []
         for msg in msg_content._msgs:
-            if isinstance(msg, TextSegment):
-                ret.append({
-                    'type': 'text',
-                    'text': msg.get_text()
-                })
-            elif isinstance(msg, ImageSegment):
-                seg = {'type': 'image'}
-                if msg.is_raw_data_available():
-                    seg['base64'] = msg.get_base64()
-                else:
-                    seg['url'] = msg.get_url()
-                ret.append(seg)
-            elif isinstance(msg, EmojiSegment):
-                ret.append({
-                    'type': 'emoji',
-                    'id': msg.get_id()
-                })
-            elif isinstance(msg, MentionSegment):
-                ret.append({
-                    'type': 'mention',
-                    'target': msg.get_target_id()
-                })
-            elif isinstance(msg, GroupedSegment):
-                ret.append({
-                    'type': 'forwarded',
-                    'id': msg.get_id()
-                })
-            elif isinstance(msg, ApplicationSegment):
-                ret.append({
-                    'type': msg.get_type(),
-                    'data': msg.get_data()
-                })
-            else:
+            generator = _find_generator(type(msg))
+            seg = generator(msg, attachments) if generator is not None else msg._gen_json_dict()
+            if seg is None:
                 logger.error('unsupported msg segment: ' + str(type(msg)))
+                continue
+            ret.append(seg)
         return ret
 
     @staticmethod
@@ -245,35 +384,84 @@ class MyBotProtocol(Protocol):
         else:
             logger.warning('unsupported group event type: ' + data['type'])
 
+    async def _request(self, method: str, path: str, params: dict = None, data: typing.Any = None) -> dict:
+        """
+        Make an API request and get the decoded response
+
+        Goes through the WebSocket RPC if the remote supports it, otherwise through HTTP
+
+        Raise asyncio.TimeoutError or WSRPCClient.Disconnected if a POST over WebSocket ended with unknown outcome, as
+        it is not safe to repeat. Use _post() to get None in such case
+
+        :param method: 'GET' or 'POST'
+        :param path: API path
+        :param params: query parameters
+        :param data: request body, will be encoded as JSON
+        :return: response body
+        """
+        if self._rpc is not None:
+            try:
+                return await self._rpc.request(method, path, params, data)
+            except WSRPCClient.Disconnected:
+                if method != 'GET':
+                    # the request may have taken effect, do not repeat it
+                    raise
+                logger.warning('lost connection while requesting {path} over WebSocket, fallback to HTTP'.format(
+                    path=path))
+            except WSRPCClient.SendFailed:
+                # nothing was sent, safe to retry over HTTP
+                logger.warning('failed to request {path} over WebSocket, fallback to HTTP'.format(path=path))
+            except asyncio.TimeoutError:
+                if method != 'GET':
+                    # the request may have taken effect, do not repeat it
+                    raise
+                logger.warning('request {path} over WebSocket timed out, fallback to HTTP'.format(path=path))
+        if method == 'GET':
+            resp = await self._http_hdl.get(path, params=params)
+        else:
+            resp = await self._http_hdl.post(path, JsonCodec.dumps(data), params=params,
+                                             headers={'content-type': 'application/json'})
+        if 'application/json' in resp.content_type:
+            return JsonCodec.loads(await resp.read())
+        raise Exception('unexpected result from ' + path)
+
+    async def _post(self, path: str, data: typing.Any) -> typing.Union[dict, None]:
+        """
+        Make a POST API request, whose outcome may be unknown
+
+        :param path: API path
+        :param data: request body, will be encoded as JSON
+        :return: response body, or None if the request over WebSocket timed out or lost its connection
+        """
+        try:
+            return await self._request('POST', path, data=data)
+        except (asyncio.TimeoutError, WSRPCClient.Disconnected):
+            logger.warning('no response of {path}, it may or may not have taken effect'.format(path=path))
+            return None
+
     # below are abstract interfaces from protocol wrapper
 
     async def get_bot_basic_info(self) -> typing.Tuple[int, str]:
-        resp = await self._http_hdl.get('/user/basicInfo')
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                return data['basic']['id'], data['basic']['nick']
-            else:
-                raise Exception('remote returned status ' + data['status']['code'] + ' on /user/basicInfo')
-        raise Exception('unexpected result from /user/basicInfo')
+        data = await self._request('GET', '/user/basicInfo')
+        if data['status']['code'] == 0:
+            return data['basic']['id'], data['basic']['nick']
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/basicInfo')
 
     async def query_packed_msg(self, id: str) -> typing.List[GroupedSegment.ContextFreeMessage]:
-        resp = await self._http_hdl.get('/mesg/parseForwardedMsg', params={'id': id})
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                ret = []
-                for msg in data['msgs']:
-                    ret.append(GroupedSegment.ContextFreeMessage(
-                        id=msg['id'],
-                        time=msg['time'],
-                        nickname=msg['nickname'],
-                        content=MyBotProtocol.parse_msg_content(msg['msgContent'])
-                    ))
-                return ret
-            else:
-                raise Exception('remote returned status ' + data['status']['code'] + ' on /mesg/parseForwardedMsg')
-        raise Exception('unexpected result from /mesg/parseForwardedMsg')
+        data = await self._request('GET', '/mesg/parseForwardedMsg', params={'id': id})
+        if data['status']['code'] == 0:
+            ret = []
+            for msg in data['msgs']:
+                ret.append(GroupedSegment.ContextFreeMessage(
+                    id=msg['id'],
+                    time=msg['time'],
+                    nickname=msg['nickname'],
+                    content=MyBotProtocol.parse_msg_content(msg['msgContent'])
+                ))
+            return ret
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /mesg/parseForwardedMsg')
 
     async def query_msg_by_id(self, channel_type: Channel.ChannelType, channel_id: int, msgid: str) -> Union[PrivateMessageContext, GroupMessageContext]:
         channel_type_str = ''
@@ -281,191 +469,276 @@ class MyBotProtocol(Protocol):
             channel_type_str = 'private'
         elif channel_type == Channel.ChannelType.MultiUser:
             channel_type_str = 'group'
-        resp = await self._http_hdl.get('/mesg/queryMsg', params={'id': msgid, 'type': channel_type_str, 'channel': channel_id})
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                msgdata = data['data']
-                reply: typing.Union[RepliedMessageContext, None] = None
-                if 'reply' in msgdata:
-                    reply = MyBotProtocol.parse_reply_content(msgdata['reply'])
-                if msgdata['type'] == 'private':
-                    return PrivateMessageContext(
-                        time=datetime.datetime.fromtimestamp(msgdata['time']),
-                        sender_id=msgdata['sender'],
-                        sender_nick=msgdata['sender_nick'],
-                        channel_id=msgdata['channel'],
-                        channel_nick=msgdata['channel_name'],
-                        msgid=msgdata['msgID'],
-                        msgcontent=MyBotProtocol.parse_msg_content(msgdata['msgContent']),
-                        summary=msgdata['msgString'],
-                        is_friend=msgdata['known'],
-                        from_channel=msgdata['ref_channel'],
-                        from_channel_name=msgdata['ref_channel_name'],
-                        reply=reply
-                    )
-                elif msgdata['type'] == 'group':
-                    return GroupMessageContext(
-                        time=datetime.datetime.fromtimestamp(msgdata['time']),
-                        sender_id=msgdata['sender'],
-                        sender_nick=msgdata['sender_nick'],
-                        group_id=msgdata['channel'],
-                        group_name=msgdata['channel_name'],
-                        msgid=msgdata['msgID'],
-                        msgcontent=MyBotProtocol.parse_msg_content(msgdata['msgContent']),
-                        summary=msgdata['msgString'],
-                        is_anonymous=not msgdata['known'],
-                        reply=reply
-                    )
-            else:
-                raise Exception('remote returned status ' + str(data['status']['code']) + ' on /mesg/queryMsg')
-        raise Exception('unexpected result from /mesg/queryMsg')
+        data = await self._request('GET', '/mesg/queryMsg', params={'id': msgid, 'type': channel_type_str, 'channel': channel_id})
+        if data['status']['code'] == 0:
+            msgdata = data['data']
+            reply: typing.Union[RepliedMessageContext, None] = None
+            if 'reply' in msgdata:
+                reply = MyBotProtocol.parse_reply_content(msgdata['reply'])
+            if msgdata['type'] == 'private':
+                return PrivateMessageContext(
+                    time=datetime.datetime.fromtimestamp(msgdata['time']),
+                    sender_id=msgdata['sender'],
+                    sender_nick=msgdata['sender_nick'],
+                    channel_id=msgdata['channel'],
+                    channel_nick=msgdata['channel_name'],
+                    msgid=msgdata['msgID'],
+                    msgcontent=MyBotProtocol.parse_msg_content(msgdata['msgContent']),
+                    summary=msgdata['msgString'],
+                    is_friend=msgdata['known'],
+                    from_channel=msgdata['ref_channel'],
+                    from_channel_name=msgdata['ref_channel_name'],
+                    reply=reply
+                )
+            elif msgdata['type'] == 'group':
+                return GroupMessageContext(
+                    time=datetime.datetime.fromtimestamp(msgdata['time']),
+                    sender_id=msgdata['sender'],
+                    sender_nick=msgdata['sender_nick'],
+                    group_id=msgdata['channel'],
+                    group_name=msgdata['channel_name'],
+                    msgid=msgdata['msgID'],
+                    msgcontent=MyBotProtocol.parse_msg_content(msgdata['msgContent']),
+                    summary=msgdata['msgString'],
+                    is_anonymous=not msgdata['known'],
+                    reply=reply
+                )
+            raise Exception('unexpected result from /mesg/queryMsg')
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /mesg/queryMsg')
 
     async def get_friend_list(self) -> typing.Dict[int, str]:
-        resp = await self._http_hdl.get('/user/getFriendList')
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                ret = dict()
-                for friend in data['list']:
-                    ret[friend['id']] = friend['nickname']
-                return ret
-            else:
-                raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/getFriendList')
-        raise Exception('unexpected result from /user/getFriendList')
+        data = await self._request('GET', '/user/getFriendList')
+        if data['status']['code'] == 0:
+            ret = dict()
+            for friend in data['list']:
+                ret[friend['id']] = friend['nickname']
+            return ret
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/getFriendList')
 
     async def get_group_list(self) -> typing.Dict[int, str]:
-        resp = await self._http_hdl.get('/user/getGroupList')
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                ret = dict()
-                for group in data['list']:
-                    ret[group['id']] = group['name']
-                return ret
-            else:
-                raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/getGroupList')
-        raise Exception('unexpected result from /user/getGroupList')
+        data = await self._request('GET', '/user/getGroupList')
+        if data['status']['code'] == 0:
+            ret = dict()
+            for group in data['list']:
+                ret[group['id']] = group['name']
+            return ret
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/getGroupList')
 
     async def get_group_members(self, id: int) -> typing.Dict[int, str]:
-        resp = await self._http_hdl.get('/group/getMemberList', params={'group': id})
-        if 'application/json' in resp.content_type:
-            data = ujson.loads(await resp.text())
-            if data['status']['code'] == 0:
-                ret = dict()
-                for member in data['list']:
-                    if member['alias'] == '':
-                        ret[member['id']] = member['nickname']
-                    else:
-                        ret[member['id']] = member['alias']
-                return ret
-            else:
-                raise Exception('remote returned status ' + str(data['status']['code']) + ' on /user/getGroupList')
-        raise Exception('unexpected result from /user/getGroupList')
+        data = await self._request('GET', '/group/getMemberList', params={'group': id})
+        if data['status']['code'] == 0:
+            ret = dict()
+            for member in data['list']:
+                if member['alias'] == '':
+                    ret[member['id']] = member['nickname']
+                else:
+                    ret[member['id']] = member['alias']
+            return ret
+        else:
+            raise Exception('remote returned status ' + str(data['status']['code']) + ' on /group/getMemberList')
 
     async def serv_private_message(self, id: int, msg_content: MessageContent, *, from_channel: int = None, reply: RepliedMessageContext = None) -> str:
+        msg_content, digests = await self._resolve_image_ids(msg_content)
+        attachments = [] if 'multipartSend' in self._features else None
         post_data = {
             'dest': id,
             'from': from_channel,
-            'msgContent': self.generate_message_content(msg_content),
+            'msgContent': self.generate_message_content(msg_content, attachments),
             'reply': self.generate_reply_content(reply)
         }
         if from_channel is None:
             del post_data['from']
         if reply is None:
             del post_data['reply']
-        resp = await self._http_hdl.post('/sendMsg/private', ujson.dumps(post_data), headers={'content-type': 'application/json'})
-        resp = ujson.loads(await resp.text())
-        if resp['status']['code'] == 0:
-            return resp['msgID']
-        else:
-            return None
+        msgid = await self._send_msg('private', post_data, attachments)
+        if msgid is None:
+            self._forget_image_ids(digests)
+        return msgid
 
     async def serv_group_message(self, id: int, msg_content: MessageContent, *, as_anonymous: bool = False, reply: RepliedMessageContext = None) -> str:
+        msg_content, digests = await self._resolve_image_ids(msg_content)
+        attachments = [] if 'multipartSend' in self._features else None
         post_data = {
             'dest': id,
-            'msgContent': self.generate_message_content(msg_content),
+            'msgContent': self.generate_message_content(msg_content, attachments),
             'reply': self.generate_reply_content(reply)
         }
         if reply is None:
             del post_data['reply']
-        resp = await self._http_hdl.post('/sendMsg/group', ujson.dumps(post_data),
-                                         headers={'content-type': 'application/json'})
-        resp = ujson.loads(await resp.text())
+        msgid = await self._send_msg('group', post_data, attachments)
+        if msgid is None:
+            self._forget_image_ids(digests)
+        return msgid
+
+    async def _send_msg(self, channel_type: str, post_data: dict, attachments: list = None) -> str:
+        """
+        Send a message through the batch endpoint if available, otherwise request it alone
+
+        Messages carrying binary parts are always sent alone as a multipart request over HTTP
+
+        :param channel_type: 'private' or 'group'
+        :param post_data: request body of /sendMsg/{channel_type}
+        :param attachments: (part name, buffer) referenced by the image segments of post_data
+        :return: msgID or None if failed
+        """
+        if attachments:
+            resp = await self._post_multipart('/sendMsg/' + channel_type, post_data, attachments)
+        elif self._send_batcher is not None:
+            post_data['type'] = channel_type
+            try:
+                resp = await self._send_batcher.submit(post_data)
+            except (asyncio.TimeoutError, WSRPCClient.Disconnected):
+                logger.warning('no response of /sendMsg/batch, the message may or may not have been sent')
+                return None
+            except Exception as e:
+                # shared by every message of the batch, not repeated as they may have been sent
+                logger.error('failed to send message in batch: {reason}'.format(reason=str(e)))
+                return None
+        else:
+            resp = await self._post('/sendMsg/' + channel_type, post_data)
+            if resp is None:
+                return None
         if resp['status']['code'] == 0:
             return resp['msgID']
         else:
             return None
 
-    async def serv_private_revoke(self, id: int, msgid: str) -> bool:
-        resp = await self._http_hdl.post('/revoke/private',
-                                         ujson.dumps({
-                                             'channel': id,
-                                             'msgID': msgid,
-                                         }),
-                                         headers={'content-type': 'application/json'}
-                                         )
-        resp = ujson.loads(await resp.text())
+    async def _resolve_image_ids(self, msg_content: MessageContent) -> typing.Tuple[MessageContent, typing.List[str]]:
+        """
+        Give raw images the id the backend knows them by, so that an image sent before is not transferred again
+
+        Images sent for the first time are uploaded once and their ids are remembered in the media cache by content
+        hash. Only done if the remote supports image ids and the media cache is enabled
+
+        The given message is left untouched, resolved images are replaced in a copy of it
+
+        :param msg_content: message to be sent
+        :return: (message to be sent instead, content hashes of the images sent by id)
+        """
+        if 'imageId' not in self._features:
+            return msg_content, []
+        cache = get_default_cache()
+        if cache is None:
+            return msg_content, []
+        resolved = None
+        digests = []
+        for i, seg in enumerate(msg_content._msgs):
+            if type(seg) is not ImageSegment or seg._image_id is not None or not seg.is_raw_data_available():
+                continue
+            digest = seg.get_digest()
+            image_id = cache.get_image_id(digest)
+            if image_id is None:
+                try:
+                    image_id = await self._upload_image(seg.get_raw())
+                except Exception as e:
+                    # still sendable as raw data
+                    logger.warning('failed to upload image: {reason}'.format(reason=str(e)))
+                    continue
+                cache.set_image_id(digest, image_id)
+            if resolved is None:
+                resolved = MessageContent()
+                resolved._msgs = list(msg_content._msgs)
+            resolved._msgs[i] = seg._with_image_id(image_id)
+            digests.append(digest)
+        return (resolved if resolved is not None else msg_content), digests
+
+    def _forget_image_ids(self, digests: typing.List[str]):
+        """
+        Drop the remembered ids of images in a message failed to be sent, as the backend may no longer know them. They
+        are uploaded again next time
+
+        :param digests: content hashes returned by _resolve_image_ids()
+        """
+        cache = get_default_cache()
+        if cache is None:
+            return
+        for digest in digests:
+            cache.drop_image_id(digest)
+
+    async def _upload_image(self, buffer: typing.Union[bytes, bytearray, memoryview]) -> str:
+        resp = await self._post_multipart('/image/upload', {}, [('image', buffer)])
+        if resp['status']['code'] == 0:
+            return resp['imageID']
+        raise Exception('remote returned status ' + str(resp['status']['code']) + ' on /image/upload')
+
+    async def _post_multipart(self, path: str, data: dict, attachments: list) -> dict:
+        """
+        Make a multipart API request, whose 'data' part is the JSON body and the other parts are raw buffers
+
+        Buffers are referenced by the request payload and written to the socket without being copied
+
+        :param path: API path
+        :param data: request body, will be encoded as JSON
+        :param attachments: (part name, buffer)
+        :return: response body
+        """
+        form = aiohttp.FormData()
+        form.add_field('data', JsonCodec.dumps_str(data), content_type='application/json')
+        for name, buffer in attachments:
+            form.add_field(name, buffer, filename=name, content_type='application/octet-stream')
+        resp = await self._http_hdl.post(path, form)
+        if 'application/json' in resp.content_type:
+            return JsonCodec.loads(await resp.read())
+        raise Exception('unexpected result from ' + path)
+
+    async def _flush_send_batch(self, msgs: typing.List[dict]) -> typing.List[dict]:
+        resp = await self._request('POST', '/sendMsg/batch', data={'msgs': msgs})
         if resp['status']['code'] == 0:
+            return resp['results']
+        raise Exception('remote returned status ' + str(resp['status']['code']) + ' on /sendMsg/batch')
+
+    async def serv_private_revoke(self, id: int, msgid: str) -> bool:
+        resp = await self._post('/revoke/private', {
+            'channel': id,
+            'msgID': msgid,
+        })
+        if resp is not None and resp['status']['code'] == 0:
             return True
         else:
             return False
 
     async def serv_group_revoke(self, id: int, msgid: str) -> bool:
-        resp = await self._http_hdl.post('/revoke/group',
-                                         ujson.dumps({
-                                             'channel': id,
-                                             'msgID': msgid,
-                                         }),
-                                         headers={'content-type': 'application/json'}
-                                         )
-        resp = ujson.loads(await resp.text())
-        if resp['status']['code'] == 0:
+        resp = await self._post('/revoke/group', {
+            'channel': id,
+            'msgID': msgid,
+        })
+        if resp is not None and resp['status']['code'] == 0:
             return True
         else:
             return False
 
     async def deal_friend_request(self, id: int, event_id: str, is_accept: bool) -> bool:
-        resp = await self._http_hdl.post('/user/acceptFriend',
-                                         ujson.dumps({
-                                             'who': id,
-                                             'eventID': event_id,
-                                             'accept': is_accept
-                                         }),
-                                         headers={'content-type': 'application/json'}
-                                         )
-        resp = ujson.loads(await resp.text())
-        if resp['status']['code'] == 0:
+        resp = await self._post('/user/acceptFriend', {
+            'who': id,
+            'eventID': event_id,
+            'accept': is_accept
+        })
+        if resp is not None and resp['status']['code'] == 0:
             return True
         else:
             return False
 
     async def deal_group_invitation(self, id: int, event_id: str, is_accept: bool) -> bool:
-        resp = await self._http_hdl.post('/user/acceptGroupInvite',
-                                         ujson.dumps({
-                                             'who': id,
-                                             'eventID': event_id,
-                                             'accept': is_accept
-                                         }),
-                                         headers={'content-type': 'application/json'}
-                                         )
-        resp = ujson.loads(await resp.text())
-        if resp['status']['code'] == 0:
+        resp = await self._post('/user/acceptGroupInvite', {
+            'who': id,
+            'eventID': event_id,
+            'accept': is_accept
+        })
+        if resp is not None and resp['status']['code'] == 0:
             return True
         else:
             return False
 
     async def deal_group_member_join_request(self, gid: int, event_id: str, is_accept: bool) -> bool:
-        resp = await self._http_hdl.post('/group/acceptJoin',
-                                         ujson.dumps({
-                                             'group': gid,
-                                             'eventID': event_id,
-                                             'accept': is_accept
-                                         }),
-                                         headers={'content-type': 'application/json'}
-                                         )
-        resp = ujson.loads(await resp.text())
-        if resp['status']['code'] == 0:
+        resp = await self._post('/group/acceptJoin', {
+            'group': gid,
+            'eventID': event_id,
+            'accept': is_accept
+        })
+        if resp is not None and resp['status']['code'] == 0:
             return True
         else:
             return False
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import typing
+
+
+class SendBatcher:
+    """
+    Coalesce requests submitted within a small time window into one batch request.
+
+    A batch is flushed when the window since its first request expires, or when it is full. Each submitter still gets
+    its own result, picked from the batch response by position.
+    """
+
+    def __init__(self, flush: typing.Callable[[typing.List[typing.Any]], typing.Awaitable[typing.List[typing.Any]]],
+                 window: float = 0.005, max_size: int = 50):
+        """
+        :param flush: co-routine function to send a list of requests and return a list of results in the same order
+        :param window: how long a batch waits for more requests, in second
+        :param max_size: max number of requests in one batch
+        """
+        self._flush = flush
+        self._window: float = window
+        self._max_size: int = max_size
+        self._pending: typing.List[typing.Tuple[typing.Any, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle = None
+        self._flush_tasks: typing.Set[asyncio.Task] = set()
+
+    async def submit(self, request: typing.Any) -> typing.Any:
+        """
+        Queue a request into current batch and wait for its own result
+
+        :param request: request object
+        :return: result of the request
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._pending.append((request, fut))
+        if len(self._pending) >= self._max_size:
+            self._fire()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._fire)
+        return await fut
+
+    def _fire(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch = self._pending
+        self._pending = []
+        if len(batch) == 0:
+            return
+        task = asyncio.get_running_loop().create_task(self._run(batch), name='send_batch')
+        # keep a reference until it is done
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _run(self, batch: typing.List[typing.Tuple[typing.Any, asyncio.Future]]):
+        try:
+            results = await self._flush([request for request, _ in batch])
+            if len(results) != len(batch):
+                raise Exception('batch returned {r} results for {n} requests'.format(r=len(results), n=len(batch)))
+        except asyncio.CancelledError:
+            for _, fut in batch:
+                fut.cancel()
+            raise
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
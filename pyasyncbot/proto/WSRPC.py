@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import itertools
+import typing
+
+from .. import JsonCodec
+from ..commu.websocket import WSClientAPI
+
+
+class WSRPCClient:
+    """
+    Make requests over an already opened WebSocket.
+
+    Each request frame carries a correlation id, and the response frame with the same id resolves the awaiting caller.
+    Incoming frames must be routed to resolve() by the owner of the WebSocket.
+
+    Responses are read by the WebSocket receiving loop, so its owner must not block that loop, e.g. on a full event
+    queue, while requests are pending.
+    """
+
+    class SendFailed(Exception):
+        pass
+
+    class Disconnected(SendFailed):
+        """
+        The request was sent, but the WebSocket dropped before the response arrived
+        """
+        pass
+
+    def __init__(self, ws_hdl: WSClientAPI, timeout: float = 10):
+        """
+        :param ws_hdl: WebSocket API handle
+        :param timeout: how long a request waits for its response, in second
+        """
+        self._ws: WSClientAPI = ws_hdl
+        self._timeout: float = timeout
+        self._ids: typing.Iterator[int] = itertools.count()
+        self._pending: typing.Dict[int, asyncio.Future] = dict()
+
+    async def request(self, method: str, path: str, params: dict = None, data: typing.Any = None) -> typing.Any:
+        """
+        Send a request and wait for its response
+
+        Raise SendFailed if the request was not sent at all, Disconnected if the WebSocket dropped while waiting, or
+        asyncio.TimeoutError if no response in time
+
+        :param method: 'GET' or 'POST'
+        :param path: API path
+        :param params: query parameters
+        :param data: request body
+        :return: response body
+        """
+        rid = next(self._ids)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[rid] = fut
+        try:
+            frame = {
+                'type': 'rpc',
+                'id': rid,
+                'method': method,
+                'path': path,
+            }
+            if params is not None:
+                frame['params'] = params
+            if data is not None:
+                frame['data'] = data
+            if not await self._ws.send_text_message(JsonCodec.dumps_str(frame)):
+                raise WSRPCClient.SendFailed()
+            return await asyncio.wait_for(fut, self._timeout)
+        finally:
+            self._pending.pop(rid, None)
+
+    def fail_pending(self):
+        """
+        Fail all waiting callers with Disconnected, as their responses will never arrive
+        """
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.set_exception(WSRPCClient.Disconnected())
+
+    def resolve(self, rid: int, data: typing.Any) -> bool:
+        """
+        Deliver a response frame to its caller
+
+        :param rid: correlation id
+        :param data: response body
+        :return: False if nobody is waiting for it
+        """
+        fut = self._pending.get(rid)
+        if fut is None or fut.done():
+            return False
+        fut.set_result(data)
+        return True
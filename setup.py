@@ -22,6 +22,10 @@ setup(
         'aiofiles>=0.8.0',
         'loguru>=0.6.0',
     ],
+    extras_require={
+        # faster JSON codec, picked automatically if installed
+        'orjson': ['orjson>=3.6.0'],
+    },
     scripts=[
         './bin/pyasyncbotd'
     ],
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+In-process bot harness for tests, with the backend replaced by FakeProtocol and no communication backend
+"""
+import asyncio
+import datetime
+import typing
+
+from context import pyasyncbot
+
+from pyasyncbot import Bot, BotConfig
+from pyasyncbot.Contacts import Contacts
+from pyasyncbot.Dispatcher import EventDispatcher, CallbackRunner, ChannelSequencer
+from pyasyncbot.FrameworkWrapper import BotWrapper, CoalescingProtocolWrapper
+from pyasyncbot.Message import PrivateMessageContext, GroupMessageContext
+from pyasyncbot.MsgContent import MessageContent
+
+
+class FakeProtocol:
+    """
+    Serves fixed contact lists and records every call
+    """
+
+    def __init__(self):
+        self.calls: typing.List[typing.Any] = []
+        self.friends: typing.Dict[int, str] = {10: 'f10', 11: 'f11'}
+        self.groups: typing.Dict[int, str] = {1: 'g1', 2: 'g2', 3: 'g3'}
+        self.members: typing.Dict[int, str] = {100: 'm100', 101: 'm101'}
+        self.fail: bool = False
+
+    async def __fetch(self, what, result):
+        self.calls.append(what)
+        await asyncio.sleep(0)
+        if self.fail:
+            raise Exception('backend down')
+        return dict(result)
+
+    async def get_friend_list(self) -> typing.Dict[int, str]:
+        return await self.__fetch('friends', self.friends)
+
+    async def get_group_list(self) -> typing.Dict[int, str]:
+        return await self.__fetch('groups', self.groups)
+
+    async def get_group_members(self, id: int) -> typing.Dict[int, str]:
+        return await self.__fetch(('members', id), self.members)
+
+    async def query_msg_by_id(self, channel_type, channel_id: int, msgid: str):
+        self.calls.append(('msg', channel_id, msgid))
+        return None
+
+
+def make_bot(protocol: FakeProtocol = None, contacts_setting: BotConfig.ContactsSetting = None,
+             **dispatch_setting) -> typing.Tuple[Bot, BotWrapper]:
+    """
+    Create a bot whose push event path is running, the same way Bot._run() brings it up. Must be called inside the
+    running event loop
+
+    :param protocol: fake backend
+    :param contacts_setting: contacts setting
+    :param dispatch_setting: fields of BotConfig.DispatchSetting
+    :return: (bot, wrapper used by protocols to push events)
+    """
+    setting = BotConfig.DispatchSetting(**dispatch_setting)
+    bot = Bot(BotConfig(bot_protocol='MyBotProtocol', dispatch_setting=setting))
+    bot._async_loop = asyncio.get_running_loop()
+    protocol = protocol if protocol is not None else FakeProtocol()
+    bot._contacts = Contacts(CoalescingProtocolWrapper(protocol, bot._msg_cache, bot._journal), contacts_setting)
+    bot._dispatcher = EventDispatcher(setting.worker_count, setting.queue_size)
+    bot._dispatcher.start()
+    bot._callbacks = CallbackRunner(setting.max_running_callbacks, setting.callback_queue_size)
+    bot._callbacks.start()
+    if setting.ordered_channels:
+        bot._sequencer = ChannelSequencer(setting.max_parallel_channels, setting.lane_size, bot._create_bot_task)
+    return bot, BotWrapper(bot)
+
+
+def group_msg(group_id: int, msgid: str, sender_id: int = 100, text: str = 'hi') -> GroupMessageContext:
+    return GroupMessageContext(datetime.datetime.now(), sender_id, 'm{id}'.format(id=sender_id), group_id,
+                               'g{id}'.format(id=group_id), msgid, MessageContent(text), text)
+
+
+def private_msg(uid: int, msgid: str, is_friend: bool = True, group_id: int = None,
+                text: str = 'hi') -> PrivateMessageContext:
+    return PrivateMessageContext(datetime.datetime.now(), uid, 'u{id}'.format(id=uid), uid, 'u{id}'.format(id=uid),
+                                 msgid, MessageContent(text), text, is_friend, group_id,
+                                 'g{id}'.format(id=group_id) if group_id is not None else None)
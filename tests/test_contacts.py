@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime
+import os
+import tempfile
+import unittest
+
+from context import pyasyncbot
+from pyasyncbot import BotConfig, JsonCodec
+from pyasyncbot.Contacts import Channel, Stranger
+from pyasyncbot.FrameworkWrapper import CoalescingProtocolWrapper
+from pyasyncbot.MemberTable import MemberTable
+from pyasyncbot.MessageStore import MessageCache
+from fakes import FakeProtocol, make_bot, group_msg, private_msg
+
+
+class GatedProtocol(FakeProtocol):
+    """
+    Group list fetches wait until the gate is open
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.gate = asyncio.Event()
+
+    async def get_group_list(self):
+        await self.gate.wait()
+        return await super().get_group_list()
+
+    async def query_msg_by_id(self, channel_type, channel_id: int, msgid: str):
+        await self.gate.wait()
+        return await super().query_msg_by_id(channel_type, channel_id, msgid)
+
+
+class TestContacts(unittest.IsolatedAsyncioTestCase):
+    async def test_stranger_revoke_wakes_waiter(self):
+        bot, wrapper = make_bot(ordered_channels=True)
+        seen = []
+
+        async def on_private_revoke(msg):
+            seen.append(msg.get_revoker().get_id())
+
+        bot.on_private_revoke(on_private_revoke)
+        # a member of group 1 who is not a friend
+        await wrapper.deliver_private_msg(private_msg(100, 'm1', is_friend=False, group_id=1))
+        stranger = Stranger(bot.get_contacts(), 100, 'm100', 1)
+        waiter = asyncio.get_running_loop().create_task(stranger.wait_revoke(timeout=2))
+        await asyncio.sleep(0)
+        # revokes of strangers name the group as their channel
+        await wrapper.deliver_private_revoke(datetime.datetime.now(), 100, 1, False, 'm1')
+        revoked = await waiter
+        self.assertIsNotNone(revoked)
+        self.assertEqual(revoked._msg_channel_id, 100)
+        self.assertEqual((await revoked.get_remoked_msg()).get_msg_id(), 'm1')
+        await bot._dispatcher.stop()
+        while len(seen) == 0:
+            await asyncio.sleep(0.01)
+        self.assertEqual(seen, [100])
+
+    async def test_failed_refresh_is_not_retried_on_every_read(self):
+        proto = FakeProtocol()
+        bot, _ = make_bot(proto, BotConfig.ContactsSetting(friends_ttl=0, refresh_retry_interval=60))
+        contacts = bot.get_contacts()
+        await contacts.get_friends()
+        proto.fail = True
+        for _ in range(50):
+            self.assertIsNotNone(await contacts.get_friend(10))
+            await asyncio.sleep(0)
+        while len(contacts._refreshing) > 0:
+            await asyncio.sleep(0.01)
+        # the initial fetch and one failed refresh
+        self.assertEqual(proto.calls.count('friends'), 2)
+        await bot._dispatcher.stop()
+
+    async def test_snapshot_leaves_out_mocked_friends(self):
+        bot, _ = make_bot()
+        contacts = bot.get_contacts()
+        # seen before the list is fetched, but not a friend by the backend
+        contacts._peek_friend(99, 'ghost')
+        await contacts.get_friends()
+        self.assertIn(99, await contacts.get_friends())
+        with tempfile.TemporaryDirectory() as path:
+            path = os.path.join(path, 'contacts.json')
+            self.assertTrue(contacts.save_snapshot(path))
+            bot2, _ = make_bot()
+            self.assertTrue(bot2.get_contacts().load_snapshot(path))
+            self.assertEqual(sorted(await bot2.get_contacts().get_friends()), [10, 11])
+            await bot2._dispatcher.stop()
+        await bot._dispatcher.stop()
+
+    async def test_wait_for_filters_at_delivery(self):
+        bot, wrapper = make_bot()
+        contacts = bot.get_contacts()
+        group = await contacts.get_group(1)
+        checked = []
+
+        def from_101(msg):
+            checked.append(msg.get_msg_id())
+            return msg.get_sender_id() == 101
+
+        waiter = asyncio.get_running_loop().create_task(contacts.wait_for(group, from_101, timeout=2))
+        member_waiter = asyncio.get_running_loop().create_task(group.wait_member_message(100, timeout=2))
+        await asyncio.sleep(0)
+        await wrapper.deliver_group_msg(group_msg(1, 'm1', sender_id=100))
+        await wrapper.deliver_group_msg(group_msg(2, 'm2', sender_id=101))
+        self.assertFalse(waiter.done())
+        self.assertEqual((await member_waiter).get_msg_id(), 'm1')
+        await wrapper.deliver_group_msg(group_msg(1, 'm3', sender_id=101))
+        self.assertEqual((await waiter).get_msg_id(), 'm3')
+        # evaluated once per message of the group, and the waiter is gone afterwards
+        self.assertEqual(checked, ['m1', 'm3'])
+        self.assertNotIn(1, contacts._waiters._waiters['groupmsg'])
+        await bot._dispatcher.stop()
+
+    async def test_message_serialization_is_built_once(self):
+        bot, wrapper = make_bot()
+        contacts = bot.get_contacts()
+        waiter = asyncio.get_running_loop().create_task(contacts.wait_for(await contacts.get_friend(10), timeout=2))
+        await asyncio.sleep(0)
+        await wrapper.deliver_private_msg(private_msg(10, 'm1', text='hello'))
+        msg = await waiter
+        data = msg.to_dict()
+        self.assertEqual(data['msgID'], 'm1')
+        self.assertEqual((data['sender']['type'], data['sender']['id']), ('Friend', 10))
+        self.assertEqual(data['channel'], data['sender'])
+        self.assertIs(msg.to_dict(), data)
+        self.assertEqual(JsonCodec.loads(str(msg)), data)
+        self.assertIs(str(msg), msg.to_json())
+        await bot._dispatcher.stop()
+
+    async def test_columnar_members(self):
+        proto = FakeProtocol()
+        # equal nicknames from separate strings, as decoded from a response
+        proto.members = {102: ''.join(['sa', 'me']), 100: ''.join(['sa', 'me']), 101: 'm101'}
+        bot, _ = make_bot(proto, BotConfig.ContactsSetting(columnar_members=True))
+        group = await bot.get_contacts().get_group(1)
+        self.assertTrue(await group.has_member(101))
+        self.assertFalse(await group.has_member(999))
+        self.assertIsInstance(group._members, MemberTable)
+        self.assertEqual(list(await group.iter_member_entries()), [(100, 'same'), (101, 'm101'), (102, 'same')])
+        # the nickname is stored once
+        self.assertIs(group._members.get_nick(100), group._members.get_nick(102))
+        member = await group.get_member(101, 'renamed')
+        self.assertEqual((member.get_id(), member.get_name()), (101, 'renamed'))
+        self.assertIsNone(await group.get_member(999, 'ghost'))
+        self.assertEqual(sorted(await group.get_members()), [100, 101, 102])
+        self.assertEqual(proto.calls.count(('members', 1)), 1)
+        await bot._dispatcher.stop()
+
+    async def test_group_fetch_is_shared_and_cached_reads_do_not_wait(self):
+        proto = GatedProtocol()
+        bot, _ = make_bot(proto, BotConfig.ContactsSetting(groups_ttl=0))
+        contacts = bot.get_contacts()
+        loop = asyncio.get_running_loop()
+        readers = [loop.create_task(contacts.get_group(1)) for _ in range(10)]
+        await asyncio.sleep(0.01)
+        # known by name, no need to wait for the list
+        self.assertEqual((await asyncio.wait_for(contacts.get_group(3, 'g3'), 0.1)).get_id(), 3)
+        self.assertFalse(any(reader.done() for reader in readers))
+        proto.gate.set()
+        groups = await asyncio.gather(*readers)
+        self.assertTrue(all(group is groups[0] for group in groups))
+        self.assertEqual(proto.calls.count('groups'), 1)
+        # an outdated list is refreshed in background, reads keep using it meanwhile
+        proto.gate.clear()
+        for _ in range(10):
+            self.assertIs(await asyncio.wait_for(contacts.get_group(1), 0.1), groups[0])
+        self.assertEqual(len(contacts._refreshing), 1)
+        proto.gate.set()
+        while len(contacts._refreshing) > 0:
+            await asyncio.sleep(0.01)
+        self.assertEqual(proto.calls.count('groups'), 2)
+        await bot._dispatcher.stop()
+
+    async def test_identical_queries_share_one_request(self):
+        proto = GatedProtocol()
+        wrapper = CoalescingProtocolWrapper(proto)
+        loop = asyncio.get_running_loop()
+        group = Channel.ChannelType.MultiUser
+        queries = [loop.create_task(wrapper.query_msg_by_id(group, 1, 'm1')) for _ in range(10)]
+        other = loop.create_task(wrapper.query_msg_by_id(group, 2, 'm1'))
+        await asyncio.sleep(0.01)
+        # a caller giving up does not cancel the request shared with others
+        queries.pop().cancel()
+        await asyncio.sleep(0.01)
+        proto.gate.set()
+        await asyncio.gather(*queries, other)
+        self.assertEqual(proto.calls, [('msg', 1, 'm1'), ('msg', 2, 'm1')])
+        # finished queries are not reused
+        await wrapper.query_msg_by_id(group, 1, 'm1')
+        self.assertEqual(proto.calls.count(('msg', 1, 'm1')), 2)
+
+    async def test_delivered_messages_are_looked_up_locally(self):
+        proto = FakeProtocol()
+        bot, wrapper = make_bot(proto)
+        contacts = bot.get_contacts()
+        await wrapper.deliver_group_msg(group_msg(1, 'm1', text='quoted'))
+        group = Channel.ChannelType.MultiUser
+        ctx = await contacts._proto_wrapper.query_msg_by_id(group, 1, 'm1')
+        self.assertEqual(ctx.msgid, 'm1')
+        self.assertIsNone(await contacts._proto_wrapper.query_msg_by_id(group, 1, 'unknown'))
+        self.assertEqual(proto.calls.count(('msg', 1, 'm1')), 0)
+        self.assertEqual(proto.calls.count(('msg', 1, 'unknown')), 1)
+        stats = bot.get_message_cache().stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        await bot._dispatcher.stop()
+
+    def test_message_cache_evicts_least_recently_used(self):
+        cache = MessageCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.stats(), {'size': 2, 'capacity': 2, 'hits': 3, 'misses': 1})
+
+    async def test_sender_and_channel_are_resolved_on_first_access(self):
+        proto = FakeProtocol()
+        bot, wrapper = make_bot(proto)
+        received = asyncio.get_running_loop().create_future()
+
+        async def on_private_message(msg):
+            received.set_result(msg)
+
+        bot.on_private_message(on_private_message)
+        # a member of group 1 who is not a friend
+        await wrapper.deliver_private_msg(private_msg(100, 'm1', is_friend=False, group_id=1))
+        msg = await asyncio.wait_for(received, 2)
+        self.assertEqual(msg.get_sender_id(), 100)
+        self.assertEqual(proto.calls, [])
+        sender = msg.get_sender()
+        self.assertIsInstance(sender, Stranger)
+        self.assertEqual((sender.get_id(), sender.get_name()), (100, 'u100'))
+        self.assertIs(msg.get_sender(), sender)
+        self.assertIs(msg.get_channel(), msg.get_channel())
+        # resolved from what is already known, nothing fetched
+        self.assertEqual(proto.calls, [])
+        await bot._dispatcher.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
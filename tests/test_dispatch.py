@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+
+from context import pyasyncbot
+from pyasyncbot.Dispatcher import ChannelSequencer
+from fakes import make_bot, group_msg
+
+
+class TestDispatch(unittest.IsolatedAsyncioTestCase):
+    async def test_waiting_callbacks_do_not_hold_workers(self):
+        # as many conversations waiting for their next message as there are workers
+        bot, wrapper = make_bot(worker_count=2)
+        groups = (1, 2, 3)
+        replies = dict()
+        done = asyncio.Event()
+
+        async def on_group_message(msg):
+            if msg.get_msg_id().startswith('start'):
+                group = msg.get_channel()
+                nxt = await group.wait_msg(timeout=2)
+                replies[group.get_id()] = nxt.get_msg_id() if nxt is not None else None
+                if len(replies) == len(groups):
+                    done.set()
+
+        bot.on_group_message(on_group_message)
+        for gid in groups:
+            await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(gid, 'start{g}'.format(g=gid))), 'test')
+        await asyncio.sleep(0.05)
+        for gid in groups:
+            await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(gid, 'next{g}'.format(g=gid))), 'test')
+        await asyncio.wait_for(done.wait(), 5)
+        self.assertEqual(replies, {gid: 'next{g}'.format(g=gid) for gid in groups})
+        await bot._dispatcher.stop()
+
+    async def test_callbacks_running_are_limited(self):
+        bot, wrapper = make_bot(worker_count=4, max_running_callbacks=2)
+        running = 0
+        peak = 0
+
+        async def on_group_message(msg):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.01)
+            running -= 1
+
+        bot.on_group_message(on_group_message)
+        for i in range(10):
+            await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(1, 'm{i}'.format(i=i))), 'test')
+        await bot._dispatcher.stop()
+        while running or peak == 0:
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.1)
+        self.assertEqual(peak, 2)
+
+    async def test_slow_callbacks_block_dispatch(self):
+        bot, wrapper = make_bot(worker_count=4, queue_size=16, max_running_callbacks=2, callback_queue_size=16)
+        gate = asyncio.Event()
+        handled = 0
+
+        async def on_group_message(msg):
+            nonlocal handled
+            await gate.wait()
+            handled += 1
+
+        bot.on_group_message(on_group_message)
+        tasks_before = len(asyncio.all_tasks())
+        sent = 0
+
+        async def produce():
+            nonlocal sent
+            for i in range(5000):
+                await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(1, 'm{i}'.format(i=i))), 'test')
+                sent += 1
+
+        producer = asyncio.get_running_loop().create_task(produce())
+        await asyncio.sleep(0.1)
+        # running callbacks, queued callbacks, push workers holding one each and the push queue
+        self.assertFalse(producer.done())
+        self.assertLessEqual(sent, 2 + 16 + 4 + 16)
+        self.assertLessEqual(len(asyncio.all_tasks()) - tasks_before, 1)
+        gate.set()
+        await asyncio.wait_for(producer, 10)
+        await bot._dispatcher.stop()
+        await bot._callbacks.stop()
+        self.assertEqual(handled, 5000)
+
+    async def test_ordered_callback_waits_on_its_own_channel(self):
+        bot, wrapper = make_bot(worker_count=2, ordered_channels=True)
+        seen = []
+        result = asyncio.get_running_loop().create_future()
+
+        async def on_group_message(msg):
+            seen.append(msg.get_msg_id())
+            if msg.get_msg_id() == 'question':
+                nxt = await msg.get_channel().wait_msg(timeout=2)
+                result.set_result(nxt.get_msg_id() if nxt is not None else None)
+
+        bot.on_group_message(on_group_message)
+        await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(1, 'question')), 'test')
+        # the callback starts waiting before the answer arrives
+        await asyncio.sleep(0.05)
+        for msgid in ('answer', 'after'):
+            await wrapper.dispatch(wrapper.deliver_group_msg(group_msg(1, msgid)), 'test')
+        self.assertEqual(await asyncio.wait_for(result, 5), 'answer')
+        await bot._dispatcher.stop()
+        while len(seen) < 3:
+            await asyncio.sleep(0.01)
+        # callbacks of the channel still run in order
+        self.assertEqual(seen, ['question', 'answer', 'after'])
+
+    async def test_full_lane_blocks_submit(self):
+        tasks = []
+
+        def create_task(coro, name):
+            task = asyncio.get_running_loop().create_task(coro, name=name)
+            tasks.append(task)
+            return task
+
+        sequencer = ChannelSequencer(4, 2, create_task)
+        gate = asyncio.Event()
+        order = []
+
+        async def job(i):
+            await gate.wait()
+            order.append(i)
+
+        # the first job is taken by the lane task, two more fill the lane
+        await sequencer.submit('k', job(0), 'job')
+        await asyncio.sleep(0)
+        await sequencer.submit('k', job(1), 'job')
+        await sequencer.submit('k', job(2), 'job')
+        blocked = asyncio.get_running_loop().create_task(sequencer.submit('k', job(3), 'job'))
+        await asyncio.sleep(0.01)
+        self.assertFalse(blocked.done())
+        # other lanes are not affected
+        await asyncio.wait_for(sequencer.submit('other', job(9), 'job'), 1)
+        gate.set()
+        await asyncio.wait_for(blocked, 1)
+        await asyncio.gather(*tasks)
+        self.assertEqual([i for i in order if i != 9], [0, 1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from aiohttp import web
+
+from context import pyasyncbot
+from pyasyncbot import BotConfig
+from pyasyncbot.commu import media
+from pyasyncbot.commu.http import HTTPClient
+from pyasyncbot.commu.media import MediaClient
+from pyasyncbot.MsgContent import ImageSegment
+
+
+class TestHTTPClient(unittest.IsolatedAsyncioTestCase):
+    async def test_requests_time_out_by_default(self):
+        setting = BotConfig.HTTPClientSetting('127.0.0.1', 8888)
+        self.assertEqual(setting.request_timeout, 60)
+        client = HTTPClient('127.0.0.1', 8888)
+        await client.setup()
+        try:
+            self.assertEqual(client._ahttp.timeout.total, 60)
+        finally:
+            await client.cleanup()
+
+
+
+class TestMediaClient(unittest.IsolatedAsyncioTestCase):
+    async def test_image_fetches_share_pooled_connections(self):
+        peers = []
+
+        async def image(request):
+            peers.append(request.transport.get_extra_info('peername'))
+            return web.Response(body=b'png', content_type='image/png')
+
+        app = web.Application()
+        app.router.add_get('/a.png', image)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = runner.addresses[0][1]
+        client = MediaClient()
+        await client.setup()
+        try:
+            self.assertIs(media.get_default_client(), client)
+            for _ in range(3):
+                seg = ImageSegment.from_url('http://127.0.0.1:{port}/a.png'.format(port=port))
+                self.assertTrue(await seg.fetch_from_url(use_cache=False))
+                self.assertEqual(seg.get_base64(), 'cG5n')
+            self.assertEqual(len(peers), 3)
+            self.assertEqual(len(set(peers)), 1)
+        finally:
+            await client.cleanup()
+            await runner.cleanup()
+        self.assertIsNone(media.get_default_client())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+import tempfile
+import unittest
+
+from context import pyasyncbot
+from pyasyncbot.Contacts import Channel
+from pyasyncbot.MessageJournal import MessageJournal
+from fakes import group_msg
+
+
+class TestMessageJournal(unittest.IsolatedAsyncioTestCase):
+    async def test_sealing_is_done_in_background(self):
+        with tempfile.TemporaryDirectory() as path:
+            journal = MessageJournal(path, segment_size=1, max_segments=2)
+            journal.open()
+            journal.append(group_msg(1, 'm0'))
+            # the first segment is sealed, but its index is not written on the loop
+            self.assertFalse(os.path.exists(os.path.join(path, '00000000.idx')))
+            self.assertEqual(journal.get(Channel.ChannelType.MultiUser, 1, 'm0').msgid, 'm0')
+            for i in range(1, 5):
+                journal.append(group_msg(1, 'm{i}'.format(i=i)))
+            await journal.close()
+            self.assertEqual(sorted(os.listdir(path)), ['00000003.idx', '00000003.jsonl',
+                                                        '00000004.idx', '00000004.jsonl'])
+            journal = MessageJournal(path, segment_size=1)
+            journal.open()
+            self.assertEqual([ctx.msgid for ctx in journal.scan(Channel.ChannelType.MultiUser, 1)], ['m3', 'm4'])
+            await journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
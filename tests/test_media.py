@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from context import pyasyncbot
+from pyasyncbot.MediaCache import MediaCache
+from pyasyncbot.MsgContent import MessageContent, ImageSegment
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+
+
+class FakeImageProtocol(MyBotProtocol):
+    """
+    Uploads always succeed, sending fails while `reject` is set
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self._features = {'imageId'}
+        self.uploads = 0
+        self.sent = []
+        self.reject = False
+
+    async def _upload_image(self, buffer) -> str:
+        self.uploads += 1
+        return 'img{n}'.format(n=self.uploads)
+
+    async def _send_msg(self, channel_type: str, post_data: dict, attachments: list = None) -> str:
+        self.sent.append(post_data['msgContent'])
+        return None if self.reject else 'msg'
+
+
+class TestMediaCache(unittest.IsolatedAsyncioTestCase):
+    async def test_concurrent_puts_count_once(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = MediaCache(disk_dir=path)
+            cache.open()
+            try:
+                buffer = b'x' * 1000
+                await asyncio.gather(*(cache.put(buffer) for _ in range(5)))
+                self.assertEqual(cache.stats()['disk_used'], 1000)
+            finally:
+                cache.close()
+
+    async def test_cached_data_is_not_shared_with_the_caller(self):
+        cache = MediaCache()
+        buffer = bytearray(b'png')
+        digest = await cache.put(buffer)
+        buffer[0] = 0
+        self.assertEqual(await cache.get(digest), b'png')
+
+    async def test_evicted_files_are_removed(self):
+        with tempfile.TemporaryDirectory() as path:
+            cache = MediaCache(disk_dir=path, disk_size=1500)
+            cache.open()
+            try:
+                first = await cache.put(b'a' * 1000)
+                await cache.put(b'b' * 1000)
+                self.assertEqual(cache.stats()['disk_used'], 1000)
+                self.assertFalse(os.path.exists(os.path.join(path, first[:2], first)))
+            finally:
+                cache.close()
+
+    async def test_image_id_is_resolved_into_a_copy_and_dropped_on_failure(self):
+        cache = MediaCache()
+        cache.open()
+        try:
+            proto = FakeImageProtocol()
+            seg = ImageSegment.from_buffer(b'png')
+            content = MessageContent()
+            content.append_segment(seg)
+            self.assertEqual(await proto.serv_group_message(1, content), 'msg')
+            self.assertEqual(proto.sent[-1], [{'type': 'image', 'id': 'img1'}])
+            self.assertIsNone(seg.get_image_id())
+            self.assertIs(content.get_segments()[0], seg)
+            # the backend forgot the image, so is the cache
+            proto.reject = True
+            self.assertIsNone(await proto.serv_group_message(1, content))
+            self.assertIsNone(cache.get_image_id(seg.get_digest()))
+            proto.reject = False
+            self.assertEqual(await proto.serv_group_message(1, content), 'msg')
+            self.assertEqual(proto.sent[-1], [{'type': 'image', 'id': 'img2'}])
+        finally:
+            cache.close()
+
+
+class TestImageFile(unittest.IsolatedAsyncioTestCase):
+    async def test_file_is_mapped_by_default(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'a.png')
+            with open(filename, 'wb') as f:
+                f.write(b'png')
+            seg = await ImageSegment.from_file(filename)
+            self.assertIsInstance(seg._buffer, memoryview)
+            self.assertEqual(seg.get_base64(), 'cG5n')
+            seg = await ImageSegment.from_file(filename, use_mmap=False)
+            self.assertEqual(seg.get_base64(), 'cG5n')
+
+    async def test_large_file_is_rejected_before_reading(self):
+        with tempfile.TemporaryDirectory() as path:
+            filename = os.path.join(path, 'a.png')
+            with open(filename, 'wb') as f:
+                f.truncate(1 << 30)
+            reads = []
+
+            async def iter_file(f, chunk_size):
+                reads.append(chunk_size)
+                yield await f.read(chunk_size)
+
+            with mock.patch('pyasyncbot.MsgContent.mmap.mmap') as mapper, \
+                    mock.patch('pyasyncbot.MsgContent._iter_file', iter_file):
+                for use_mmap in (True, False):
+                    with self.assertRaises(Exception):
+                        await ImageSegment.from_file(filename, max_size=1024, use_mmap=use_mmap)
+                mapper.assert_not_called()
+                self.assertEqual(reads, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
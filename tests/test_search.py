@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import tempfile
+import unittest
+
+from context import pyasyncbot
+from pyasyncbot.SearchIndex import SearchIndex, tokenize
+from fakes import group_msg
+
+
+class TestSearchIndex(unittest.IsolatedAsyncioTestCase):
+    async def test_merge_and_reopen(self):
+        with tempfile.TemporaryDirectory() as path:
+            index = SearchIndex(path, flush_docs=2, merge_factor=2)
+            index.open()
+            for i in range(9):
+                index.add(group_msg(1, 'm{i}'.format(i=i), text='apple {w}'.format(w='pear' if i % 3 == 0 else 'fig')))
+            await index.close()
+            index = SearchIndex(path, flush_docs=2, merge_factor=2)
+            index.open()
+            # 4 flushes merged into 1 of level 2, the odd message written at close
+            self.assertEqual([len(seg) for seg in index._disk], [8, 1])
+            self.assertEqual([hit.msgid for hit in index.search('pear', limit=10)], ['m6', 'm3', 'm0'])
+            self.assertEqual(len(index.search('apple', limit=100)), 9)
+            self.assertEqual(index.search('banana'), [])
+            await index.close()
+
+    async def test_oldest_segments_are_deleted(self):
+        with tempfile.TemporaryDirectory() as path:
+            index = SearchIndex(path, flush_docs=2, merge_factor=2, max_docs=4)
+            index.open()
+            for i in range(10):
+                index.add(group_msg(1, 'm{i}'.format(i=i), text='apple'))
+            await index.close()
+            index = SearchIndex(path, flush_docs=2, merge_factor=2, max_docs=4)
+            index.open()
+            # segments are never merged beyond 2 messages, and only 2 of them are kept
+            self.assertEqual([hit.msgid for hit in index.search('apple', limit=100)], ['m9', 'm8', 'm7', 'm6'])
+            self.assertEqual(len([name for name in os.listdir(path) if name.endswith('.meta')]), 2)
+            await index.close()
+
+    async def test_single_cjk_character_matches_inside_a_run(self):
+        self.assertEqual(tokenize('你好世界', query=True), ['你好', '好世', '世界'])
+        with tempfile.TemporaryDirectory() as path:
+            index = SearchIndex(path, flush_docs=2)
+            index.open()
+            index.add(group_msg(1, 'm0', text='你好世界'))
+            index.add(group_msg(1, 'm1', text='再见'))
+            while len(index._disk) == 0:
+                await asyncio.sleep(0.01)
+            index.add(group_msg(1, 'm2', text='好'))
+            # found on disk and in memory
+            self.assertEqual([hit.msgid for hit in index.search('好')], ['m2', 'm0'])
+            self.assertEqual([hit.msgid for hit in index.search('见')], ['m1'])
+            self.assertEqual([hit.msgid for hit in index.search('世界')], ['m0'])
+            self.assertEqual(index.search('界世'), [])
+            await index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
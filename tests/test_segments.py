@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from context import pyasyncbot
+from pyasyncbot.MsgContent import MessageContent, MentionSegment, ImageSegment
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+
+
+class HighlightedMention(MentionSegment):
+    def __init__(self, uid: int):
+        super().__init__()
+        self._target = uid
+        self._replacement = '@{uid}'.format(uid=uid)
+
+
+class MultipartProtocol(MyBotProtocol):
+    """
+    Records multipart requests instead of sending them
+    """
+
+    def __init__(self):
+        super().__init__(None)
+        self._features = {'multipartSend'}
+        self.requests = []
+
+    async def _post_multipart(self, path: str, data: dict, attachments: list) -> dict:
+        self.requests.append((path, data, attachments))
+        return {'status': {'code': 0}, 'msgID': 'msg'}
+
+
+class TestSegments(unittest.IsolatedAsyncioTestCase):
+    async def test_subclass_uses_the_wire_format_of_its_base(self):
+        seg = HighlightedMention(42)
+        content = MessageContent()
+        content.append_segment(seg)
+        self.assertEqual(MyBotProtocol.generate_message_content(content), [{'type': 'mention', 'target': 42}])
+
+    async def test_malformed_segment_is_skipped(self):
+        content = MyBotProtocol.parse_msg_content([
+            {'type': 'application', 'data': '{}'},
+            {'type': 'text', 'text': 'hi'},
+        ])
+        self.assertEqual([str(seg) for seg in content.get_segments()], ['hi'])
+
+    async def test_images_are_sent_as_parts_without_copying(self):
+        buffer = memoryview(bytearray(b'png' * 1000))
+        content = MessageContent('look')
+        content.append_segment(ImageSegment.from_buffer(buffer))
+        content.append_segment(ImageSegment.from_url('http://example.com/a.png'))
+        proto = MultipartProtocol()
+        self.assertEqual(await proto.serv_group_message(1, content), 'msg')
+        path, data, attachments = proto.requests[0]
+        self.assertEqual(path, '/sendMsg/group')
+        self.assertEqual(data['msgContent'][1:], [{'type': 'image', 'part': 'image0'},
+                                                  {'type': 'image', 'url': 'http://example.com/a.png'}])
+        self.assertEqual(len(attachments), 1)
+        self.assertEqual(attachments[0][0], 'image0')
+        self.assertIs(attachments[0][1], buffer)
+        # without multipart support the buffer is embedded as base64
+        self.assertIn('base64', MyBotProtocol.generate_message_content(content)[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import unittest
+from unittest import mock
+
+from context import pyasyncbot
+from pyasyncbot import JsonCodec
+from pyasyncbot.MsgContent import MessageContent
+from pyasyncbot.proto.MyBotProtocol import MyBotProtocol
+from pyasyncbot.proto.SendBatcher import SendBatcher
+from pyasyncbot.proto.WSRPC import WSRPCClient
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+
+    async def send_text_message(self, data: str) -> bool:
+        self.sent.append(JsonCodec.loads(data))
+        return True
+
+
+class BlockedBotWrapper:
+    """
+    Bot wrapper whose event queue is always full
+    """
+
+    def __init__(self):
+        self.tasks = []
+
+    def create_task(self, coro, name):
+        task = asyncio.get_running_loop().create_task(coro, name=name)
+        self.tasks.append(task)
+        return task
+
+    async def dispatch(self, coro, name):
+        coro.close()
+        await asyncio.Event().wait()
+
+
+class TestWSRPC(unittest.IsolatedAsyncioTestCase):
+    async def test_disconnect_fails_pending_requests(self):
+        rpc = WSRPCClient(FakeWebSocket())
+        req = asyncio.get_running_loop().create_task(rpc.request('POST', '/sendMsg/group', data={}))
+        await asyncio.sleep(0)
+        rpc.fail_pending()
+        with self.assertRaises(WSRPCClient.SendFailed):
+            await req
+
+    async def test_full_event_queue_does_not_block_responses(self):
+        ws = FakeWebSocket()
+        proto = MyBotProtocol(BlockedBotWrapper())
+        proto._rpc = WSRPCClient(ws, timeout=1)
+        req = asyncio.get_running_loop().create_task(proto._request('GET', '/user/basicInfo'))
+        await asyncio.sleep(0)
+        for i in range(3):
+            event = {'type': 'user', 'data': {'type': 'unknown'}}
+            await asyncio.wait_for(proto.process_incoming_ws_data(JsonCodec.dumps_str(event)), 1)
+        response = {'type': 'rpc', 'id': ws.sent[0]['id'], 'data': {'status': {'code': 0}}}
+        await asyncio.wait_for(proto.process_incoming_ws_data(JsonCodec.dumps_str(response)), 1)
+        self.assertEqual(await req, {'status': {'code': 0}})
+        await proto.cleanup()
+        for task in proto._bot_wrapper.tasks:
+            task.cancel()
+
+    async def test_backlog_is_bounded(self):
+        ws = FakeWebSocket()
+        proto = MyBotProtocol(BlockedBotWrapper())
+        proto._rpc = WSRPCClient(ws, timeout=1)
+        req = asyncio.get_running_loop().create_task(proto._request('GET', '/user/basicInfo'))
+        await asyncio.sleep(0)
+        event = JsonCodec.dumps_str({'type': 'user', 'data': {'type': 'unknown'}})
+        with mock.patch.object(MyBotProtocol, 'EVENT_BACKLOG_LIMIT', 5):
+            for i in range(20):
+                await asyncio.wait_for(proto.process_incoming_ws_data(event), 1)
+        # one taken by the blocked feeder, five waiting
+        self.assertEqual(len(proto._backlog), 5)
+        self.assertEqual(proto.dropped_events, 14)
+        response = {'type': 'rpc', 'id': ws.sent[0]['id'], 'data': {'status': {'code': 0}}}
+        await asyncio.wait_for(proto.process_incoming_ws_data(JsonCodec.dumps_str(response)), 1)
+        self.assertEqual(await req, {'status': {'code': 0}})
+        await proto.cleanup()
+        for task in proto._bot_wrapper.tasks:
+            task.cancel()
+
+    async def test_binary_frames_are_parsed_as_bytes(self):
+        ws = FakeWebSocket()
+        proto = MyBotProtocol(BlockedBotWrapper())
+        proto._rpc = WSRPCClient(ws, timeout=1)
+        req = asyncio.get_running_loop().create_task(proto._request('GET', '/user/basicInfo'))
+        await asyncio.sleep(0)
+        response = {'type': 'rpc', 'id': ws.sent[0]['id'], 'data': {'status': {'code': 0}, 'nick': '机器人'}}
+        frame = JsonCodec.dumps_str(response).encode('utf-8')
+        await asyncio.wait_for(proto.process_incoming_ws_data(frame), 1)
+        self.assertEqual(await req, {'status': {'code': 0}, 'nick': '机器人'})
+        self.assertEqual(JsonCodec.loads(memoryview(frame)), response)
+        await proto.cleanup()
+
+    async def test_post_timeout_returns_none(self):
+        proto = MyBotProtocol(BlockedBotWrapper())
+        proto._rpc = WSRPCClient(FakeWebSocket(), timeout=0.01)
+        self.assertIsNone(await proto.serv_group_message(1, MessageContent('hi')))
+        self.assertFalse(await proto.serv_group_revoke(1, 'm'))
+
+    async def __send_batch(self, results):
+        ws = FakeWebSocket()
+        proto = MyBotProtocol(BlockedBotWrapper())
+        proto._rpc = WSRPCClient(ws, timeout=1)
+        proto._send_batcher = SendBatcher(proto._flush_send_batch, 0.01, 10)
+        sends = [asyncio.get_running_loop().create_task(proto.serv_group_message(gid, MessageContent('hi')))
+                 for gid in (1, 2)]
+        while len(ws.sent) == 0:
+            await asyncio.sleep(0.01)
+        response = {'type': 'rpc', 'id': ws.sent[0]['id'], 'data': {'status': {'code': 0}, 'results': results}}
+        await proto.process_incoming_ws_data(JsonCodec.dumps_str(response))
+        msgids = await asyncio.gather(*sends)
+        return ws.sent, msgids
+
+    async def test_sends_in_one_window_share_a_batch(self):
+        sent, msgids = await self.__send_batch([{'status': {'code': 0}, 'msgID': 'a'},
+                                                {'status': {'code': 0}, 'msgID': 'b'}])
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(sent[0]['path'], '/sendMsg/batch')
+        self.assertEqual([msg['dest'] for msg in sent[0]['data']['msgs']], [1, 2])
+        self.assertEqual(msgids, ['a', 'b'])
+
+    async def test_failures_in_a_batch_return_none(self):
+        # one of the batch is rejected
+        _, msgids = await self.__send_batch([{'status': {'code': 0}, 'msgID': 'a'}, {'status': {'code': 1}}])
+        self.assertEqual(msgids, ['a', None])
+        # the whole batch has a bad response
+        _, msgids = await self.__send_batch([{'status': {'code': 0}, 'msgID': 'a'}])
+        self.assertEqual(msgids, [None, None])
+
+
+if __name__ == '__main__':
+    unittest.main()